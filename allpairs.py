@@ -0,0 +1,285 @@
+#
+# Similarity of every pair of fonts of a corpus, to find near duplicates and
+# clusters of similar fonts.
+#
+# Pairs are scored in blocks of fonts, so the renders of a font stay in the
+# memory cache while its row and column of the block are scored. Scores are
+# stored on a memory mapped matrix as they are computed, so interrupted runs
+# resume where they stopped, and clusters can be computed again at any other
+# threshold without scoring anything.
+#
+import sys
+import os
+import time
+import json
+import math
+import argparse
+
+import lazy
+import util
+import phash
+import metrics
+import scriptcoverage
+import fontdiff
+
+numpy = lazy.lazyImport('numpy')
+
+# pairs skipped by the prefilters, or that failed, get this score. Pairs not
+# scored yet are NaN
+SKIPPED_SCORE = float('-inf')
+
+# pairs of fonts with more distant probe hashes than this are not scored
+PHASH_MAX_DISTANCE = 16
+
+# pairs sharing less than this fraction of the symbols of the font with less
+# symbols are not scored (same as fontdiff.py)
+MIN_SHARED_FRACTION = 0.5
+
+DEFAULT_THRESHOLD = 0.5
+
+class UnionFind:
+  """ Disjoint sets of the integers 0..n-1
+  """
+  def __init__(self, n):
+    self.parent = list(range(n))
+
+  def find(self, i):
+    root = i
+    while self.parent[root] != root:
+      root = self.parent[root]
+    # path compression
+    while self.parent[i] != root:
+      (self.parent[i], i) = (root, self.parent[i])
+    return root
+
+  def union(self, i, j):
+    (root_i, root_j) = (self.find(i), self.find(j))
+    if root_i != root_j:
+      self.parent[max(root_i, root_j)] = min(root_i, root_j)
+
+def iterBlocks(n, block_size):
+  """ (rows, columns) ranges of the blocks on and above the diagonal of a
+  n x n matrix
+  """
+  starts = range(0, n, block_size)
+  for i in starts:
+    for j in starts:
+      if j >= i:
+        yield (range(i, min(n, i + block_size)), range(j, min(n, j + block_size)))
+
+def clusterFonts(matrix, threshold, block_size = 256):
+  """ Single linkage clusters of fonts whose pair scores are at least
+  threshold. Returns lists of font indexes, biggest clusters first, without
+  the fonts that are on their own
+  """
+  n = matrix.shape[0]
+  sets = UnionFind(n)
+  # read the matrix in row blocks, so huge matrices are never loaded whole
+  for start in range(0, n, block_size):
+    rows = numpy.asarray(matrix[start:start + block_size])
+    for (i, j) in numpy.argwhere(rows >= threshold):
+      if start + i < j:
+        sets.union(start + i, int(j))
+
+  clusters = {}
+  for i in range(n):
+    clusters.setdefault(sets.find(i), []).append(i)
+  return sorted([cluster for cluster in clusters.values() if len(cluster) > 1], key=len, reverse=True)
+
+class PairScorer:
+  """ Scores pairs of corpus fonts, skipping those the prefilters (script
+  coverage, probe hashes, shared symbols) tell apart without rendering
+  """
+  def __init__(self, font_files, args, alphabet):
+    self.font_files = font_files
+    self.args = args
+    self.alphabet = alphabet
+    self.metric = metrics.getMetric(args.metric)
+
+    self.symbols = []
+    scripts = []
+    index = phash.PerceptualHashIndex()
+    for font_file in font_files:
+      try:
+        symbols = util.getSymbolIds(font_file)
+        hashes = phash.getFontHashes(font_file)
+      except Exception as e:
+        print(f"ERROR reading {font_file}: {e}")
+        (symbols, hashes) = (set(), {})
+      if alphabet:
+        symbols = set(c for c in symbols if chr(c) in alphabet)
+      self.symbols.append(symbols)
+      scripts.append(scriptcoverage.getFontCoverage(font_file) >= scriptcoverage.MIN_SCRIPT_COVERAGE if symbols else numpy.zeros(len(scriptcoverage.SCRIPTS), dtype=bool))
+      index.add(font_file, hashes)
+
+    self.scripts = numpy.array(scripts, dtype=bool).reshape(len(font_files), len(scriptcoverage.SCRIPTS))
+    self.index = index
+    self.hashes = index.rows
+
+  def candidates(self, rows, columns):
+    """ Boolean mask of the pairs of the block worth scoring
+    """
+    mask = (self.scripts[rows.start:rows.stop].astype(numpy.uint8) @ self.scripts[columns.start:columns.stop].T.astype(numpy.uint8)) > 0
+    if self.args.phash_max_distance is not None:
+      for i in rows:
+        distances = self.index.distances(self.hashes[i], columns.start, columns.stop)
+        mask[i - rows.start] &= distances <= self.args.phash_max_distance
+    return mask
+
+  def score(self, i, j):
+    """ Score of font j aligned over font i, or SKIPPED_SCORE if they share too
+    few symbols
+    """
+    (font1, font2) = (self.font_files[i], self.font_files[j])
+    shared = self.symbols[i] & self.symbols[j]
+    if not shared or len(shared) < MIN_SHARED_FRACTION*min(len(self.symbols[i]), len(self.symbols[j])):
+      return SKIPPED_SCORE
+
+    (best_x, best_y) = (0, 0)
+    if self.args.best_fit:
+      (best_x, best_y, _) = util.fastSearchBestAlignment(font1, font2, step = 3, metric = self.metric)
+      (best_x, best_y, _) = util.fastSearchBestAlignment(font1, font2, step = 1, search_space = 3, x = best_x, y = best_y, metric = self.metric)
+
+    codepoints_shared = [chr(c) for c in sorted(shared)]
+    (score, _) = util.getFontDiffScore(
+      codepoints_shared,
+      math.ceil(len(codepoints_shared)**0.5),
+      font1,
+      font2,
+      best_x,
+      best_y,
+      metric = self.metric,
+      skip_identical = True,
+      with_diff = False
+    )
+    return score
+
+def openMatrix(out_dir, font_files, settings):
+  """ Memory mapped matrix of scores of out_dir, created (all NaN) unless a
+  previous run with the same fonts and settings left one to resume
+  """
+  matrix_path = f"{out_dir}/scores.npy"
+  info_path = f"{out_dir}/fonts.json"
+  info = {'settings': settings, 'fonts': font_files}
+
+  if os.path.isfile(matrix_path) and os.path.isfile(info_path):
+    with open(info_path, 'rt') as f:
+      if json.load(f) == info:
+        return numpy.lib.format.open_memmap(matrix_path, mode='r+')
+    print(f"Fonts or settings changed since the last run, scoring {out_dir} again")
+
+  n = len(font_files)
+  matrix = numpy.lib.format.open_memmap(matrix_path, mode='w+', dtype=numpy.float32, shape=(n, n))
+  matrix[:] = numpy.nan
+  matrix.flush()
+  with open(info_path, 'wt') as f:
+    json.dump(info, f)
+  return matrix
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""
+Score every pair of fonts of a folder and group similar fonts in clusters
+    """,
+    epilog="""
+Examples:
+  $ python3 allpairs.py google-fonts
+  $ python3 allpairs.py -b -t 0.8 -d outdir folder/containing/fonts
+    """
+  )
+
+  parser.add_argument('-a', '--alphabet', default=fontdiff.STANDARD_ALPHABET, help="Letters used for scoring (default: fontdiff's standard alphabet, 'all' for all shared symbols)")
+  parser.add_argument('-m', '--metric', default=metrics.DEFAULT_METRIC, choices=sorted(metrics.METRICS), help="Similarity metric used for scoring and alignment")
+  parser.add_argument('-b', '--best-fit', action='store_true', help="Align every pair before scoring it")
+  parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD, help=f"Fonts scoring at least this are put in the same cluster (default {DEFAULT_THRESHOLD})")
+  parser.add_argument('--block-size', type=int, default=32, help="Fonts per block, the renders of a block are kept in memory (default 32)")
+  parser.add_argument('--phash-max-distance', type=float, default=PHASH_MAX_DISTANCE, help=f"Skip pairs with more distant probe hashes (default {PHASH_MAX_DISTANCE}, -1 to score all pairs)")
+  parser.add_argument('-d', '--out-dir', help="Output folder for the score matrix and clusters")
+  parser.add_argument('-v', '--verbose', action='store_true')
+  parser.add_argument('--profile-startup', action='store_true', help="Report time spent starting up and importing modules")
+  parser.add_argument('font_search_path')
+
+  args = parser.parse_args()
+  if args.profile_startup:
+    lazy.profileStartup()
+
+  alphabet = None if args.alphabet == 'all' else args.alphabet
+  if args.phash_max_distance is not None and args.phash_max_distance < 0:
+    args.phash_max_distance = None
+
+  util.init()
+
+  out_dir = args.out_dir or f"tmp/allpairs-{os.path.basename(os.path.normpath(args.font_search_path))}".lower()
+  os.makedirs(out_dir, exist_ok=True)
+
+  font_files = sorted(fontdiff.findFontFiles(args.font_search_path))
+  settings = {
+    'metric': args.metric,
+    'alphabet': alphabet,
+    'best_fit': args.best_fit,
+    'phash_max_distance': args.phash_max_distance
+  }
+  matrix = openMatrix(out_dir, font_files, settings)
+
+  script_start_time = time.time()
+  with open(f"{out_dir}/analysis.txt", "at") as f:
+    util.log(f, f"Scoring all pairs of {len(font_files)} fonts of {args.font_search_path}")
+    scorer = PairScorer(font_files, args, alphabet)
+    perfect_score = float(scorer.metric.score(scorer.metric.perfect_value))
+
+    nscored = 0
+    nskipped = 0
+    blocks = list(iterBlocks(len(font_files), args.block_size))
+    for (nblock, (rows, columns)) in enumerate(blocks):
+      block = matrix[rows.start:rows.stop, columns.start:columns.stop]
+      pending = numpy.isnan(block)
+      if not pending.any():
+        continue
+
+      mask = scorer.candidates(rows, columns)
+      block_start_time = time.time()
+      for i in rows:
+        for j in columns:
+          if j < i or not pending[i - rows.start, j - columns.start]:
+            continue
+
+          if i == j:
+            score = perfect_score
+          elif not mask[i - rows.start, j - columns.start]:
+            score = SKIPPED_SCORE
+            nskipped += 1
+          else:
+            try:
+              score = scorer.score(i, j)
+            except Exception as e:
+              util.log(f, f"  ERROR scoring {font_files[i]} vs {font_files[j]}: {e}")
+              score = SKIPPED_SCORE
+            nscored += 1
+            if args.verbose:
+              util.log(f, f"  {font_files[i]:<32} {font_files[j]:<32} score={score:.3f}")
+
+          matrix[i, j] = score
+          matrix[j, i] = score
+
+      matrix.flush()
+      util.log(f, f"[{nblock+1}/{len(blocks)}] Block ({rows.start}-{rows.stop-1}, {columns.start}-{columns.stop-1}) took {time.time()-block_start_time:.3f} seconds")
+
+    util.log(f, f"\nPairs scored: {nscored}, skipped by the prefilters: {nskipped}")
+
+    clusters = clusterFonts(matrix, args.threshold)
+    util.log(f, f"\n{len(clusters)} clusters of fonts scoring at least {args.threshold:g}:")
+    for (i, cluster) in enumerate(clusters):
+      util.log(f, f"  #{i+1:<3d} {', '.join(font_files[font] for font in cluster)}")
+
+    with open(f"{out_dir}/clusters.json", "wt") as f2:
+      json.dump({
+        'threshold': args.threshold,
+        'clusters': [[font_files[font] for font in cluster] for cluster in clusters]
+      }, f2, separators=(',', ':'))
+
+    util.log(f, f"\nScript Took: {time.time()-script_start_time:.3f} seconds")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,368 @@
+#
+# Disk cache used by all scripts (rendered symbol matrices, symbol ids,
+# perceptual hashes, ...) and a command line tool to inspect and prune it.
+#
+# Files live under CACHE_DIR/v<CACHE_VERSION>/<type>/, so bumping the version
+# when a file format changes invalidates old entries, which are then removed
+# by "prune". Hits, misses and last access of every entry are kept in a small
+# sqlite database so entries can be evicted by LRU or LFU when over quota.
+#
+import os
+import sys
+import time
+import atexit
+import shutil
+import hashlib
+import argparse
+import threading
+import _pickle as pickle
+
+CACHE_DIR = './.cache'
+
+# bump whenever the format of any cached file changes
+CACHE_VERSION = 5
+
+# bump whenever the tables of the metadata database change
+SCHEMA_VERSION = 2
+
+# cache types sharded in 256 subfolders, since they hold lots of files
+SHARDED_TYPES = ['images']
+
+# quota in bytes (suffixes K, M, G allowed), applied automatically on exit
+CACHE_QUOTA_ENV = 'FONTDIFF_CACHE_QUOTA'
+
+def parseSize(size):
+  """ Parse sizes like 512M or 10G into bytes
+  """
+  if size is None or size == '':
+    return None
+  units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+  size = str(size).strip().upper()
+  if size[-1] in units:
+    return int(float(size[:-1]) * units[size[-1]])
+  return int(size)
+
+def formatSize(size):
+  for unit in ['B', 'K', 'M', 'G']:
+    if size < 1024:
+      return f"{size:.1f}{unit}"
+    size /= 1024
+  return f"{size:.1f}T"
+
+class DiskCache:
+  """ Versioned disk cache that keeps access metadata of every entry.
+  Metadata is kept in memory and flushed to the database on exit, so cache
+  lookups never wait on sqlite. Worker processes may never run atexit
+  handlers, so they have to call flush themselves.
+  """
+  def __init__(self, root = CACHE_DIR, version = CACHE_VERSION):
+    self.root = root
+    self.version = version
+    self.base_dir = f"{root}/v{version}"
+    self.db_path = f"{root}/cache.db"
+    self.quota = parseSize(os.environ.get(CACHE_QUOTA_ENV))
+    self.lock = threading.Lock()
+    self.pending_stats = {}
+    self.pending_access = {}
+    atexit.register(self.flush)
+
+  def path(self, cache_type, key, ext):
+    """ Path of the cache file for given key (any string)
+    """
+    h = hashlib.blake2s()
+    h.update(f"{cache_type}-{key}".encode())
+    cacheId = h.hexdigest()
+    if cache_type in SHARDED_TYPES:
+      return f"{self.base_dir}/{cache_type}/{cacheId[0:2]}/{cacheId[2:]}{ext}"
+    return f"{self.base_dir}/{cache_type}/{cacheId[2:]}{ext}"
+
+  def _record(self, cache_type, path, hit = None, size = None):
+    """ Count a hit/miss (if hit is not None) and the access to path, unless
+    it was a miss
+    """
+    with self.lock:
+      if hit is not None:
+        stats = self.pending_stats.setdefault(cache_type, [0, 0])
+        stats[0 if hit else 1] += 1
+      if hit is not False:
+        (_type, hits, old_size) = self.pending_access.get(path, (cache_type, 0, None))
+        self.pending_access[path] = (cache_type, hits + (1 if hit else 0), size if size is not None else old_size)
+
+  def load(self, cache_type, path, read):
+    """ Returns read(file) or None if path is not cached
+    """
+    if not os.path.isfile(path):
+      self._record(cache_type, path, False)
+      return None
+
+    with open(path, 'rb') as f:
+      value = read(f)
+    self._record(cache_type, path, True)
+    return value
+
+  def exists(self, cache_type, path):
+    """ Same as load, for callers that open the file themselves
+    """
+    if not os.path.isfile(path):
+      self._record(cache_type, path, False)
+      return False
+    self._record(cache_type, path, True)
+    return True
+
+  def save(self, cache_type, path, write):
+    """ Write a cache file through a temporary file and rename it, so other
+    threads or processes never read a half written file
+    """
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+      f = open(tmp_path, 'wb')
+    except FileNotFoundError:
+      # folders are only created when the first file is stored on them
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      f = open(tmp_path, 'wb')
+
+    with f:
+      write(f)
+    os.replace(tmp_path, path)
+    self._record(cache_type, path, size = os.path.getsize(path))
+
+  def loadPickle(self, cache_type, path):
+    return self.load(cache_type, path, pickle.load)
+
+  def savePickle(self, cache_type, path, value):
+    self.save(cache_type, path, lambda f: pickle.dump(value, f))
+
+  def _connect(self):
+    import sqlite3
+    os.makedirs(self.root, exist_ok=True)
+    db = sqlite3.connect(self.db_path, timeout=60)
+    (schema_version,) = db.execute("PRAGMA user_version").fetchone()
+    if schema_version < SCHEMA_VERSION:
+      with db:
+        db.execute("""CREATE TABLE IF NOT EXISTS entries (
+          path TEXT PRIMARY KEY, type TEXT, size INTEGER, last_access REAL, hits INTEGER
+        )""")
+        # hits and misses of each type, per cache version (the unversioned
+        # stats table of older runs is dropped)
+        db.execute("DROP TABLE IF EXISTS stats")
+        db.execute("""CREATE TABLE IF NOT EXISTS version_stats (
+          version INTEGER, type TEXT, hits INTEGER, misses INTEGER, PRIMARY KEY (version, type)
+        )""")
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return db
+
+  def flush(self):
+    """ Store pending access metadata and apply the quota, if any, to the
+    entries of the current version
+    """
+    with self.lock:
+      (pending_stats, self.pending_stats) = (self.pending_stats, {})
+      (pending_access, self.pending_access) = (self.pending_access, {})
+
+    if not pending_stats and not pending_access:
+      return
+
+    now = time.time()
+    with self._connect() as db:
+      for cache_type, (hits, misses) in pending_stats.items():
+        db.execute("""INSERT INTO version_stats (version, type, hits, misses) VALUES (?, ?, ?, ?)
+          ON CONFLICT(version, type) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses""",
+          (self.version, cache_type, hits, misses))
+      for path, (cache_type, hits, size) in pending_access.items():
+        if size is None:
+          size = os.path.getsize(path) if os.path.isfile(path) else 0
+        db.execute("""INSERT INTO entries (path, type, size, last_access, hits) VALUES (?, ?, ?, ?, ?)
+          ON CONFLICT(path) DO UPDATE SET last_access = excluded.last_access, hits = hits + excluded.hits, size = excluded.size""",
+          (path, cache_type, size, now, hits))
+
+    if self.quota is not None:
+      self.prune(self.quota)
+
+  def stats(self):
+    """ Returns {type: {entries, size, hits, misses}} for the current version
+    """
+    self.flush()
+    result = {}
+    with self._connect() as db:
+      for (cache_type, entries, size) in db.execute("SELECT type, COUNT(*), SUM(size) FROM entries WHERE path LIKE ? GROUP BY type", (f"{self.base_dir}/%",)):
+        result[cache_type] = {'entries': entries, 'size': size or 0, 'hits': 0, 'misses': 0}
+      for (cache_type, hits, misses) in db.execute("SELECT type, hits, misses FROM version_stats WHERE version = ?", (self.version,)):
+        result.setdefault(cache_type, {'entries': 0, 'size': 0})
+        result[cache_type].update({'hits': hits, 'misses': misses})
+    return result
+
+  def staleVersions(self):
+    """ Folders of older/newer cache versions (or the pre-versioned layout)
+    """
+    if not os.path.isdir(self.root):
+      return []
+    current = os.path.basename(self.base_dir)
+    return [
+      os.path.join(self.root, name)
+      for name in sorted(os.listdir(self.root))
+      if name != current and os.path.isdir(os.path.join(self.root, name))
+    ]
+
+  def prune(self, quota = None, policy = 'lru', remove_stale = False):
+    """ Evict entries of the current version until they fit in quota bytes.
+    With remove_stale, folders of other versions are removed too, which may
+    belong to another checkout, so it is only done when explicitly asked.
+    Returns (files_removed, bytes_removed), files of stale versions included
+    """
+    removed = 0
+    removed_bytes = 0
+    order = "last_access ASC" if policy == 'lru' else "hits ASC, last_access ASC"
+    with self._connect() as db:
+      if remove_stale:
+        for folder in self.staleVersions():
+          (files, size) = folderUsage(folder)
+          removed += files
+          removed_bytes += size
+          shutil.rmtree(folder, ignore_errors=True)
+        db.execute("DELETE FROM entries WHERE path NOT LIKE ?", (f"{self.base_dir}/%",))
+
+      if quota is None:
+        return (removed, removed_bytes)
+
+      (total,) = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE path LIKE ?", (f"{self.base_dir}/%",)).fetchone()
+      if total <= quota:
+        return (removed, removed_bytes)
+
+      evicted = []
+      for (path, size) in db.execute(f"SELECT path, size FROM entries WHERE path LIKE ? ORDER BY {order}", (f"{self.base_dir}/%",)):
+        if total <= quota:
+          break
+        try:
+          os.unlink(path)
+        except FileNotFoundError:
+          pass
+        evicted.append((path,))
+        total -= size
+        removed += 1
+        removed_bytes += size
+
+      db.executemany("DELETE FROM entries WHERE path = ?", evicted)
+
+    return (removed, removed_bytes)
+
+  def verify(self, check):
+    """ Check every file of the current version with check(cache_type, path),
+    removing broken files and leftover temporary files, and index files that
+    have no metadata yet. Returns (checked, removed)
+    """
+    self.flush()
+    checked = 0
+    removed = 0
+    now = time.time()
+    with self._connect() as db:
+      known = set(path for (path,) in db.execute("SELECT path FROM entries WHERE path LIKE ?", (f"{self.base_dir}/%",)))
+      found = set()
+      for (dirpath, _dirnames, filenames) in os.walk(self.base_dir):
+        cache_type = os.path.relpath(dirpath, self.base_dir).split(os.sep)[0]
+        for filename in filenames:
+          path = os.path.join(dirpath, filename)
+          checked += 1
+          ok = not filename.endswith('.tmp')
+          if ok:
+            try:
+              ok = check(cache_type, path)
+            except Exception:
+              ok = False
+
+          if not ok:
+            os.unlink(path)
+            removed += 1
+            continue
+
+          found.add(path)
+          if path not in known:
+            db.execute("INSERT INTO entries (path, type, size, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+              (path, cache_type, os.path.getsize(path), now))
+
+      db.executemany("DELETE FROM entries WHERE path = ?", [(path,) for path in known - found])
+
+    return (checked, removed)
+
+def folderUsage(folder):
+  """ (files, bytes) of everything under folder
+  """
+  files = 0
+  total = 0
+  for (dirpath, _dirnames, filenames) in os.walk(folder):
+    for filename in filenames:
+      try:
+        total += os.path.getsize(os.path.join(dirpath, filename))
+        files += 1
+      except OSError:
+        pass
+  return (files, total)
+
+g_diskCache = DiskCache()
+
+def checkCacheFile(cache_type, path):
+  """ True if the file can be loaded
+  """
+  if path.endswith('.png'):
+    from PIL import Image
+    with Image.open(path) as image:
+      image.verify()
+    return True
+
+  if path.endswith(('.ttf', '.otf')):
+    from fontTools import ttLib
+    ttLib.TTFont(path)['head']
+    return True
+
+  with open(path, 'rb') as f:
+    pickle.load(f)
+  return True
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""
+Inspect and clean the cache shared by all scripts
+    """,
+    epilog=f"""
+Examples:
+  $ python3 cache.py stats
+  $ python3 cache.py prune --quota 10G --policy lfu
+  $ python3 cache.py verify
+
+Set {CACHE_QUOTA_ENV}=10G to apply a quota automatically after every run.
+Folders of other cache versions are only removed by prune.
+    """
+  )
+
+  parser.add_argument('command', choices=['stats', 'prune', 'verify'])
+  parser.add_argument('--quota', help="Max cache size, e.g. 512M or 10G (prune)")
+  parser.add_argument('--policy', choices=['lru', 'lfu'], default='lru', help="Eviction policy (prune)")
+
+  args = parser.parse_args()
+  cache = g_diskCache
+
+  if args.command == 'stats':
+    stats = cache.stats()
+    print(f"Cache folder: {cache.base_dir}")
+    print(f"  {'Type':<12} {'Entries':>10} {'Size':>10} {'Hits':>10} {'Misses':>10} {'Hit rate':>9}")
+    for cache_type, s in sorted(stats.items()):
+      lookups = s['hits'] + s['misses']
+      hit_rate = f"{100*s['hits']/lookups:.1f}%" if lookups else '-'
+      print(f"  {cache_type:<12} {s['entries']:>10} {formatSize(s['size']):>10} {s['hits']:>10} {s['misses']:>10} {hit_rate:>9}")
+
+    stale = cache.staleVersions()
+    if stale:
+      usage = [folderUsage(folder) for folder in stale]
+      print(f"  {len(stale)} stale folders from other cache versions: {sum(files for (files, _size) in usage)} files, {formatSize(sum(size for (_files, size) in usage))} (removed by prune)")
+
+  elif args.command == 'prune':
+    (removed, removed_bytes) = cache.prune(parseSize(args.quota), args.policy, remove_stale = True)
+    print(f"Removed {removed} entries, {formatSize(removed_bytes)} freed")
+
+  elif args.command == 'verify':
+    (checked, removed) = cache.verify(checkCacheFile)
+    print(f"Checked {checked} files, {removed} broken files removed")
+
+if __name__ == '__main__':
+  main()
@@ -7,9 +7,13 @@ import os
 import time
 import glob
 import argparse
-from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageSequence
 
+import lazy
 import util
+import scriptcoverage
+
+Image = lazy.lazyImport('PIL.Image')
+ImageDraw = lazy.lazyImport('PIL.ImageDraw')
 
 def main():
   parser = argparse.ArgumentParser(
@@ -26,7 +30,10 @@ Examples:
   )
 
   parser.add_argument('-d', '--out-dir', help="Output folder where images/diffs/etc will be generated")
+  parser.add_argument('--min-ratio', type=float, default=0.5, help="Fonts must cover each script of the input font at least this fraction as much (default 0.5)")
+  parser.add_argument('--max-missing', type=int, default=2, help="Number of scripts of the input font that fonts are allowed to miss (default 2)")
   parser.add_argument('-v', '--verbose', action='store_true')
+  parser.add_argument('--profile-startup', action='store_true', help="Report time spent starting up and importing modules")
   parser.add_argument('input_font')
   parser.add_argument('font_search_path')
 
@@ -46,13 +53,15 @@ Examples:
   }
 
   args = parser.parse_args()
+  if args.profile_startup:
+    lazy.profileStartup()
   verbose = args.verbose
 
   if not args.out_dir:
     out_hash = util.getFileMd5(args.input_font)
     out_dir = os.path.split(os.path.splitext(args.input_font)[0])[1]
     args.out_dir = f'tmp/charset-{out_dir}-{out_hash[0:8]}'.lower()
-    os.makedirs(args.out_dir, exist_ok = True)
+  os.makedirs(args.out_dir, exist_ok = True)
   out_dir = args.out_dir
 
   font1_path = args.input_font
@@ -66,10 +75,11 @@ Examples:
     font_files = list(sorted(ttf_files + otf_files))
     font_files = [os.path.join(root_dir, file) for file in font_files]
 
-  arial_font = ImageFont.truetype("Arial", 12)
+  arial_font = util.getTitleFont(12)
   script_start_time = time.time()
   with open(f"{args.out_dir}/analysis.txt", "wt") as f:
     symbols1 = util.getSymbolIds(font1_path)
+    coverage1 = scriptcoverage.getFontCoverage(font1_path)
 
     font1charsets = set()
     for charset, text in CHARSET_TEXT_MAP.items():
@@ -78,12 +88,28 @@ Examples:
         font1charsets.add(charset)
 
     print("- Charsets found: ", ', '.join(sorted(list(font1charsets))))
+    print("- Script coverage: ", ', '.join(f"{script} {100*coverage1[scriptcoverage.SCRIPTS.index(script)]:.0f}%" for script in scriptcoverage.getFontScripts(coverage1)))
 
     util.log(f, f"Comparing with font: {font1_path:<32}")
     util.log(f, f"{font1_path:<32}: {len(symbols1)} glyphs")
 
+    # fonts are filtered on their script coverage, kept on a catalog of the
+    # search path, so only fonts added or changed since the last run are read
+    catalog_key = os.path.abspath(args.font_search_path)
+    index = scriptcoverage.ScriptCoverageIndex()
+    index.load(catalog_key)
+    for font_file in font_files:
+      try:
+        index.add(font_file)
+      except Exception as e:
+        util.log(f, f"ERROR reading {font_file}: {e}")
+    index.save(catalog_key)
+
+    matching = index.query(coverage1, args.min_ratio, args.max_missing)
+    util.log(f, f"{len(matching)} of {len(font_files)} fonts have the charsets of {font1_path}")
+
     # NOTE: adding font1 as a reference
-    font_files = [font1_path] + font_files
+    font_files = [font1_path] + matching
 
     MAX_HEIGHT = 900
     font_size = 32
@@ -94,27 +120,15 @@ Examples:
     draw1 = ImageDraw.Draw(image1)
     draw2 = ImageDraw.Draw(image2)
 
-    font1 = ImageFont.truetype(font1_path, font_size)
+    font1 = util.getFont(font1_path, font_size)
 
     image_y = padding
     for idx, ttf_file in enumerate(font_files):
       if font1_path == ttf_file:
         continue
 
-      symbols2 = util.getSymbolIds(ttf_file)
-
-      font2charsets = set()
-      for charset, text in CHARSET_TEXT_MAP.items():
-        # only draw charsets available on the first font
-        if len(set([ord(x) for x in text]) & symbols2) > 3:
-          font2charsets.add(charset)
-
-      if len(font1charsets.intersection(font2charsets)) < len(font1charsets) - 2:
-        util.log (f, "Missing charsets. Skipping")
-        continue
-
       font2_path = ttf_file
-      font2 = ImageFont.truetype(font2_path, font_size)
+      font2 = util.getFont(font2_path, font_size)
 
       #image1 = Image.new("RGB", (1024, image_height), "white")
       image2 = Image.new("RGB", (1024, image_height), "white")
@@ -13,12 +13,22 @@ import argparse
 import hashlib
 import shutil
 import _pickle as pickle
-from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageSequence
-from fontTools import ttLib
-import numpy
 
+import lazy
 import util
 
+Image = lazy.lazyImport('PIL.Image')
+ImageDraw = lazy.lazyImport('PIL.ImageDraw')
+
+def sharedSymbols(symbols1, font_path):
+  """ Number of symbols1 also on the cmap of font_path, 0 if it cannot be
+  read
+  """
+  try:
+    return len(symbols1 & util.getCmapCodepoints(font_path))
+  except Exception:
+    return 0
+
 def main():
   parser = argparse.ArgumentParser(
     prog=sys.argv[0],
@@ -30,12 +40,15 @@ Analyze font and try to find a similar one
 Examples:
   $ python3 compare.py -t "The Abc Of Text" -v FontName.ttf google-fonts
   $ python3 compare.py -d cmpdir -v path/to/Font.ttf folder/containing/fonts
+  $ python3 compare.py --time-budget 60 path/to/Font.ttf folder/containing/fonts
     """
   )
 
   parser.add_argument('-t', '--text', default="The Abc Of Text abcde ABC 01234", help="Text to draw")
   parser.add_argument('-d', '--out-dir', help="Output folder where images/diffs/etc will be generated")
+  parser.add_argument('--time-budget', type=float, help="Stop after this many seconds, comparing the fonts with more symbols in common first")
   parser.add_argument('-v', '--verbose', action='store_true')
+  parser.add_argument('--profile-startup', action='store_true', help="Report time spent starting up and importing modules")
   parser.add_argument('input_font')
   parser.add_argument('font_search_path')
 
@@ -55,14 +68,16 @@ Examples:
   }
 
   args = parser.parse_args()
+  if args.profile_startup:
+    lazy.profileStartup()
   verbose = args.verbose
 
   if not args.out_dir:
     out_hash = util.getFileMd5(args.input_font)
     out_dir = os.path.split(os.path.splitext(args.input_font)[0])[1]
     args.out_dir = f'tmp/cmp-{out_dir}-{out_hash[0:8]}'.lower()
-    os.makedirs(args.out_dir, exist_ok = True)
   out_dir = args.out_dir
+  os.makedirs(out_dir, exist_ok = True)
 
   font1_path = args.input_font
   if os.path.isfile(args.font_search_path):
@@ -75,7 +90,7 @@ Examples:
     font_files = list(sorted(ttf_files + otf_files))
     font_files = [os.path.join(root_dir, file) for file in font_files]
 
-  arial_font = ImageFont.truetype("Arial", 12)
+  arial_font = util.getTitleFont(12)
   text = LANG_TEXT_MAP.get(args.text, args.text)
   script_start_time = time.time()
   with open(f"{args.out_dir}/analysis.txt", "wt") as f:
@@ -84,6 +99,17 @@ Examples:
     util.log(f, f"Comparing with font: {font1_path:<32}")
     util.log(f, f"{font1_path:<32}: {len(symbols1)} glyphs")
 
+    # with a time budget, fonts with more symbols in common are compared first.
+    # Fonts left once the budget is spent keep their order, after the rest
+    deadline = script_start_time + args.time_budget if args.time_budget else None
+    if deadline is not None:
+      shared = {}
+      for font_file in font_files:
+        if time.time() > deadline:
+          break
+        shared[font_file] = sharedSymbols(symbols1, font_file)
+      font_files = sorted(font_files, key=lambda font_file: shared.get(font_file, -1), reverse=True)
+
     # NOTE: adding font1 as a reference
     font_files = [font1_path] + font_files
 
@@ -103,15 +129,20 @@ Examples:
     draw1 = ImageDraw.Draw(image1)
     draw2 = ImageDraw.Draw(image2)
 
-    font1 = ImageFont.truetype(font1_path, font_size)
+    font1 = util.getFont(font1_path, font_size)
 
+    ranking = []
     image_y = padding
     for idx, ttf_file in enumerate(font_files):
       if font1_path == ttf_file:
         continue
 
+      if deadline is not None and time.time() > deadline:
+        util.log(f, f"\nTime budget of {args.time_budget:g} seconds exhausted")
+        break
+
       font2_path = ttf_file
-      font2 = ImageFont.truetype(font2_path, font_size)
+      font2 = util.getFont(font2_path, font_size)
 
       image1 = Image.new("RGB", (1024, image_height), "white")
       image2 = Image.new("RGB", (1024, image_height), "white")
@@ -122,6 +153,7 @@ Examples:
       font2base = os.path.splitext(os.path.basename(font2_path))[0]
 
       (best_x, best_y, best_score) = util.searchBestAlignment(font1_path, font2_path)
+      ranking.append((best_score, font2_path, best_x, best_y))
 
       image_y = padding
       for lang, text in LANG_TEXT_MAP.items():
@@ -170,6 +202,13 @@ Examples:
         loop = 0
       )
 
+    ncompared = len(ranking)
+    ncandidates = len([x for x in font_files if x != font1_path])
+    util.log(f, f"\nFonts compared: {ncompared} of {ncandidates} ({100*ncompared/max(1, ncandidates):.1f}%)")
+    util.log(f, "Ranking by alignment score:")
+    for i, (score, font2_path, best_x, best_y) in enumerate(sorted(ranking, key=lambda x: x[0], reverse=True)):
+      util.log(f, f"  #{i+1:<2d} {font2_path:<32}: offset=({best_x}, {best_y}) score={score:.3f}")
+
     util.log(f, f"\nScript Took: {time.time()-script_start_time:.3f} seconds")
 
 if __name__ == '__main__':
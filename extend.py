@@ -3,11 +3,122 @@
 # other files based on the font to model.
 #
 import os
+import io
 import sys
 import argparse
 import shutil
+import lazy
 import util
+import phash
+import cache
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+numpy = lazy.lazyImport('numpy')
+
+# each worker process is replaced after building this many variants, so memory
+# held by fontTools/Pillow caches cannot grow without bounds (Python 3.11+)
+MAX_TASKS_PER_WORKER = 8
+
+# state shared by all variants built on a process, set by initWorker so it is
+# sent once per worker instead of once per variant
+g_worker = {}
+
+# weight of the difference of ink density (see phash.glyphInkDensity) against
+# the phash distance (normalized to [0, 1]) when ranking donors by style
+DENSITY_WEIGHT = 2.0
+
+def rankDonorsByStyle(base_font, donor_files):
+  """ Style distance from base_font to every donor: the average phash distance
+  of their probe glyphs plus DENSITY_WEIGHT times the difference of their ink
+  density. Descriptors of each font are cached, see phash.py.
+
+  Returns (donors, distances), leaving out donors that cannot be read
+  """
+  index = phash.PerceptualHashIndex()
+  densities = []
+  for donor in donor_files:
+    try:
+      hashes = phash.getFontHashes(donor)
+      density = phash.getFontInkDensity(donor)
+    except Exception as e:
+      print(f"ERROR hashing {donor}: {e}")
+      continue
+    index.add(donor, hashes)
+    densities.append(density if density is not None else numpy.nan)
+
+  if not index.font_paths:
+    return ([], numpy.zeros(0))
+
+  distances = index.distances(phash.getFontHashes(base_font)) / phash.HASH_BITS
+  base_density = phash.getFontInkDensity(base_font)
+  if base_density is not None:
+    # donors without probe symbols get the maximum difference
+    density_diff = numpy.nan_to_num(numpy.abs(numpy.array(densities) - base_density), nan=1.0)
+    distances = distances + DENSITY_WEIGHT*density_diff
+  return (index.font_paths, distances)
+
+def assignDonors(donors, distances, codepoints):
+  """ Pick for every codepoint the donor with the lowest distance among the
+  ones that define it, in a single vectorized pass over a donors x codepoints
+  cost matrix. Donors with an infinite distance are never picked.
+
+  Returns ({donor: [codepoints]}, codepoints no donor can provide)
+  """
+  if not donors:
+    return ({}, list(codepoints))
+
+  columns = {codepoint: j for j, codepoint in enumerate(codepoints)}
+  has = numpy.zeros((len(donors), len(codepoints)), dtype=bool)
+  for i, donor in enumerate(donors):
+    has[i, [columns[c] for c in util.getSymbolIds(donor) & columns.keys()]] = True
+
+  cost = numpy.where(has, numpy.asarray(distances)[:, None], numpy.inf)
+
+  best = numpy.argmin(cost, axis=0)
+  found = numpy.isfinite(cost[best, numpy.arange(len(codepoints))])
+
+  assignment = {}
+  for j in numpy.flatnonzero(found):
+    assignment.setdefault(donors[best[j]], []).append(codepoints[j])
+  return (assignment, [codepoints[j] for j in numpy.flatnonzero(~found)])
+
+def extendByStyle(base_font, donor_files, new_font, missing_codepoints):
+  """ Copy every missing codepoint into new_font from the donor closest in
+  style to base_font that has it (see rankDonorsByStyle). Codepoints of donors
+  that cannot be merged are assigned again to the next best donors.
+
+  Returns the codepoints that could not be copied
+  """
+  (donors, distances) = rankDonorsByStyle(base_font, donor_files)
+  rank = {donor: i for i, donor in enumerate(donors)}
+  usable = numpy.ones(len(donors), dtype=bool)
+
+  shutil.copy(base_font, new_font)
+  remaining = list(missing_codepoints)
+  while remaining:
+    (assignment, missing) = assignDonors(donors, numpy.where(usable, distances, numpy.inf), remaining)
+
+    failed = False
+    for donor, codepoints in sorted(assignment.items(), key=lambda x: distances[rank[x[0]]]):
+      if util.copyFontGlyphs(
+        base_font_file=new_font,
+        from_font_file=donor,
+        target_font_file=new_font,
+        glyph_codepoints = codepoints
+      ):
+        print(f"  Imported {len(codepoints)} symbols from {donor} (style distance {distances[rank[donor]]:.3f})")
+        copied = set(codepoints)
+        remaining = [c for c in remaining if c not in copied]
+      else:
+        print(f"  Cannot copy symbols from {donor}, trying other donors")
+        usable[rank[donor]] = False
+        failed = True
+
+    if not failed:
+      break
+
+  return remaining
 
 def findFilesWithAllSymbols(font_files, symbols):
   """ Opens font files and finds all that fully contain given set of symbols
@@ -22,6 +133,92 @@ def findFilesWithAllSymbols(font_files, symbols):
       pass
   return fonts_with_all_symbols
 
+def initWorker(base_font_data, original_image):
+  g_worker['base_font_data'] = base_font_data
+  g_worker['original_image'] = original_image
+
+def buildVariant(font_file, base_font, outdir, missing_codepoints, original_chars):
+  """ Extend base font with missing_codepoints from font_file, and draw its
+  symbol matrix plus a gif comparing it with the original font. The base font
+  is parsed from the bytes shared by initWorker, since merging modifies it.
+
+  Returns a summary dict with the files created (if any).
+  """
+  start_time = time.time()
+  (base_font_name, base_font_ext) = os.path.splitext(os.path.basename(base_font))
+  font_file_basename = os.path.splitext(os.path.basename(font_file))[0]
+  new_font = f"{outdir}/{base_font_name}__from__{font_file_basename}{base_font_ext}"
+
+  result = {'donor' : font_file, 'font' : None, 'files' : [], 'seconds' : 0}
+  if not util.copyFontGlyphs(
+    base_font_file = io.BytesIO(g_worker['base_font_data']),
+    from_font_file = font_file,
+    target_font_file = new_font,
+    glyph_codepoints = missing_codepoints
+  ):
+    result['seconds'] = time.time() - start_time
+    return result
+
+  image_matrix = util.drawFullSymbolMatrix(original_chars, None, new_font, title=f"{base_font} + {font_file_basename}")
+  image_file = f"{outdir}/{base_font_name}__from__{font_file_basename}.png"
+  image_matrix.save(image_file)
+
+  gif_file = f"{outdir}/{base_font_name}__all_from__{font_file_basename}.gif"
+  gif = g_worker['original_image'].copy()
+  gif.save(
+    gif_file,
+    append_images=[image_matrix],
+    save_all = True,
+    duration = 1000,
+    loop = 0
+  )
+
+  result['font'] = new_font
+  result['files'] = [new_font, image_file, gif_file]
+  result['seconds'] = time.time() - start_time
+  return result
+
+def buildVariantTask(*args):
+  """ buildVariant run on a worker process. Workers are not guaranteed to
+  run atexit handlers, so cache metadata is flushed after every task
+  """
+  try:
+    return buildVariant(*args)
+  finally:
+    cache.g_diskCache.flush()
+
+def buildVariants(font_files, base_font, outdir, missing_codepoints, original_chars, original_image, jobs = 1):
+  """ Build one variant per donor font with buildVariant, on a pool of jobs
+  processes when jobs > 1. Yields summaries as variants are finished.
+
+  On Python 3.11+ workers are replaced every MAX_TASKS_PER_WORKER variants,
+  which makes the pool start them with the spawn method, so each worker
+  imports all modules again instead of forking the parent process.
+  """
+  with open(base_font, 'rb') as f:
+    base_font_data = f.read()
+
+  if jobs <= 1:
+    initWorker(base_font_data, original_image)
+    for font_file in font_files:
+      yield buildVariant(font_file, base_font, outdir, missing_codepoints, original_chars)
+    return
+
+  # older versions keep their workers for the whole run
+  options = {'max_tasks_per_child': MAX_TASKS_PER_WORKER} if sys.version_info >= (3, 11) else {}
+  with ProcessPoolExecutor(
+    max_workers = jobs,
+    initializer = initWorker,
+    initargs = (base_font_data, original_image),
+    **options
+  ) as executor:
+    futures = [
+      executor.submit(buildVariantTask, font_file, base_font, outdir, missing_codepoints, original_chars)
+      for font_file in font_files
+    ]
+    for future in as_completed(futures):
+      yield future.result()
+
 def main():
   parser = argparse.ArgumentParser(
     prog=sys.argv[0],
@@ -34,15 +231,24 @@ Examples:
   # New font will be created from BaseFont.ttf with glyphs extra-*.ttf fonts in order
   # to match all glyphs/symbols present on FontToMatch.ttf
   $ python3 extend.py -m FontToMatch.ttf -b BaseFont.ttf extra-font1.ttf extra-font2.ttf ...
+
+  # Same, but each missing symbol is copied from the donor that looks most
+  # like BaseFont.ttf
+  $ python3 extend.py --match-style -m FontToMatch.ttf -b BaseFont.ttf fonts/*.ttf
 """
   )
 
   parser.add_argument('--original', help="Original font where we'd like to match the symbols from")
   parser.add_argument('--base', help="Base font that we want to extend")
+  parser.add_argument('--match-style', action='store_true', help="Build a single font, copying each missing symbol from the donor closest in style to the base font")
+  parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of processes used to build the variants (default 1)")
   parser.add_argument('-v', '--verbose', action='store_true')
+  parser.add_argument('--profile-startup', action='store_true', help="Report time spent starting up and importing modules")
   parser.add_argument('extra_fonts', nargs='+', help="Extra fonts that will be used to copy symbols to base")
 
   args = parser.parse_args()
+  if args.profile_startup:
+    lazy.profileStartup()
   verbose = args.verbose
 
   base_font = args.base
@@ -80,36 +286,66 @@ Examples:
   original_image = util.drawFullSymbolMatrix(original_chars, None, original_font, title=f"Font To Clone (org): {original_font}")
   original_image.save(f"{outdir}/{original_font_name}-matrix.png")
 
-  fonts_with_all_symbols = findFilesWithAllSymbols(extra_fonts, missing_codepoints)
-  for font_file in fonts_with_all_symbols:
-    font_file_basename = os.path.splitext(os.path.basename(font_file))[0]
-    new_font = f"{outdir}/{base_font_name}__from__{font_file_basename}{base_font_ext}"
-    shutil.copy(base_font, new_font)
-
-    if not util.copyFontGlyphs(
-      base_font_file = new_font,
-      from_font_file = font_file,
-      target_font_file = new_font,
-      glyph_codepoints = missing_codepoints
-    ):
-      print(f"Font {font_file} has all missing symbols, but we cannot copy!")
-      os.unlink(new_font)
-      continue
-
-    print(f"Font {font_file} has all missing symbols. Creating {new_font}")
-    image_matrix = util.drawFullSymbolMatrix(original_chars, None, new_font, title=f"{base_font} + {font_file_basename}")
-    image_matrix.save(f"{outdir}/{base_font_name}__from__{font_file_basename}.png")
+  if args.match_style:
+    start_time = time.time()
+    new_font = f"{outdir}/{base_font_name}-matched{base_font_ext}"
+    print (f"Ranking {len(extra_fonts)} donors by style similarity to {base_font}...")
+    remaining = extendByStyle(base_font, extra_fonts, new_font, missing_codepoints)
 
-    gif = original_image.copy()
-    gif.save(
-      f"{outdir}/{base_font_name}__all_from__{font_file_basename}.gif",
+    image_matrix = util.drawFullSymbolMatrix(
+      original_chars,
+      None,
+      new_font,
+      title=f"{base_font_name} extended with matching styles"
+    )
+    image_matrix.save(f"{outdir}/{base_font_name}-matched.png")
+    original_image.save(
+      f"{outdir}/{base_font_name}-all-matched.gif",
       append_images=[image_matrix],
       save_all = True,
       duration = 1000,
       loop = 0
     )
 
+    print ("-"*80)
+    if remaining:
+      print (f"WARNING: {len(remaining)} missing symbols could not be copied from any donor!")
+    else:
+      print (f"SUCCESS: All missing symbols have been filled in ({time.time()-start_time:.2f} seconds)")
+    print (f"Output files created here: {outdir}/")
+    print ("-"*80)
+    return
+
+  fonts_with_all_symbols = findFilesWithAllSymbols(extra_fonts, missing_codepoints)
+
+  start_time = time.time()
+  results = []
+  for result in buildVariants(
+    fonts_with_all_symbols,
+    base_font,
+    outdir,
+    missing_codepoints,
+    original_chars,
+    original_image,
+    jobs = args.jobs
+  ):
+    if result['font']:
+      print(f"Font {result['donor']} has all missing symbols. Created {result['font']} ({result['seconds']:.2f} seconds)")
+    else:
+      print(f"Font {result['donor']} has all missing symbols, but we cannot copy!")
+    results.append(result)
+
   if len(fonts_with_all_symbols) > 0:
+    created = [r for r in results if r['font']]
+    print ("-"*80)
+    print (f"Created {len(created)} of {len(results)} variants in {time.time()-start_time:.2f} seconds ({args.jobs} jobs)")
+    for result in sorted(created, key=lambda r: r['font']):
+      print (f"  {result['font']}")
+    for result in sorted(results, key=lambda r: r['donor']):
+      if not result['font']:
+        print (f"  FAILED: {result['donor']}")
+    print (f"Output files created here: {outdir}/")
+    print ("-"*80)
     return
 
   # if we haven't found a file with all symbols, we'll fill from multiple files
@@ -35,24 +35,119 @@ import glob
 import json
 import argparse
 import shutil
-from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageSequence
-from fontTools import ttLib
-import numpy
+import lazy
 import util
+import phash
+import metrics
+import results
 
 # ------------------------------------------------------------------------------
 # Symbol IDs cache
 # ------------------------------------------------------------------------------
 STANDARD_ALPHABET = 'abcçdefghijklmnñopqrstuvwxyzABCÇDEFGHIJKLMNÑOPQRSTUVWXYZ01234567890!=.,-+*/%$&€áéíóúäëïöü'
 
+# families are expanded if their representative scores at least this fraction
+# of the best representative
+FAMILY_MARGIN = 0.9
+
+# fraction of --time-budget kept for the final pass (rescoring the top matches
+# and saving their images), scoring stops once the rest is spent
+FINAL_PASS_BUDGET = 0.25
+
+# columns of the scores file written while fonts are scored. status is one of
+# scored, skipped (too few shared symbols), pruned (poor alignment score),
+# aborted (cannot beat the best score, see --progressive) or error
+SCORE_COLUMNS = ['font', 'status', 'score', 'best_x', 'best_y', 'best_scale', 'location', 'nshared', 'nmissing', 'nwanted', 'seconds']
+
+def familyRepresentatives(families):
+  """ First font of every family (see util.groupFontFamilies)
+  """
+  return [family[0] for family in families]
+
+def expandFamilies(families, scores, margin = FAMILY_MARGIN):
+  """ Rest of the fonts of the families whose representative scored within
+  margin of the best representative. scores is {font: score}; representatives
+  without score (skipped, failed) are always expanded.
+  """
+  representative_scores = [scores[family[0]] for family in families if family[0] in scores]
+  best = max(representative_scores, default = 0)
+  fonts = []
+  for family in families:
+    score = scores.get(family[0], None)
+    if score is None or score >= margin*best:
+      fonts += family[1:]
+  return fonts
+
+def findFontFiles(path):
+  """ Given font file, or all ttf/otf fonts found recursively in a folder
+  """
+  if os.path.isfile(path):
+    return [path]
+
+  ttf_files = list(glob.glob('**/*.ttf', root_dir = path, recursive = True))
+  otf_files = list(glob.glob('**/*.otf', root_dir = path, recursive = True))
+  return [os.path.join(path, file) for file in ttf_files + otf_files]
+
+def findReferenceFonts(path):
+  """ Reference fonts to find matches for: a font file, a folder of fonts or
+  a text file with one font path per line
+  """
+  if os.path.isfile(path) and os.path.splitext(path)[1].lower() in ['.txt', '.lst']:
+    with open(path, 'rt') as f:
+      lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+  return findFontFiles(path)
+
+def parseShard(value):
+  """ Parse --shard i/N into (i, N), i going from 1 to N
+  """
+  try:
+    (shard, nshards) = [int(x) for x in value.split('/')]
+  except ValueError:
+    raise argparse.ArgumentTypeError(f"expected i/N, got '{value}'")
+  if nshards < 1 or not 1 <= shard <= nshards:
+    raise argparse.ArgumentTypeError(f"shard must be between 1 and N, got '{value}'")
+  return (shard, nshards)
+
+def getFontShard(font_path, nshards):
+  """ Shard (1 to nshards) scanning given font. It depends on the content of
+  the font only, so all hosts agree no matter where the corpus is mounted
+  """
+  return int(util.getFileMd5(font_path), 16) % nshards + 1
+
+def shardOutDir(out_dir, shard):
+  """ Folder of the partial results of a shard, inside the folder of the
+  query, where merge.py looks for them
+  """
+  return f"{out_dir}/shard-{shard[0]}-of-{shard[1]}"
+
 def compareFonts(
   font_path1,
   font_path2,
   xoffset = 0,
   yoffset = 0,
   file_prefix = "",
-  alphabet = None
+  alphabet = None,
+  scale = 1.0,
+  min_score = None,
+  paged = False,
+  metric = metrics.DEFAULT_METRIC,
+  skip_identical = False,
+  memory_cache = True
 ):
+  """ Score font2 against font1 and save the symbol matrices used for the
+  comparison. When min_score is given, glyphs are first scored progressively
+  and the comparison stops as soon as font2 cannot reach min_score.
+
+  With skip_identical, glyphs with the same outline on both fonts are not
+  rendered to be scored, and the diff only shows the other glyphs.
+
+  Matrices with more than MAX_MATRIX_SIZE x MAX_MATRIX_SIZE symbols are trimmed
+  unless paged is set, in which case all symbols are saved in multiple pages.
+  Without memory_cache, nothing drawn is kept in memory once saved.
+
+  Returns (sim_score, diff, nexamined), diff being None if aborted.
+  """
   symbols1 = util.getSymbolIds(font_path1)
   symbols2 = util.getSymbolIds(font_path2)
   symbols3 = list(symbols1 | symbols2)
@@ -80,38 +175,78 @@ def compareFonts(
 
   shared_size = math.ceil(len(codepoints_shared)**0.5)
 
+  nexamined = len(codepoints_shared)
+  if min_score is not None:
+    (sim_score, nexamined, aborted) = util.progressiveFontDiffScore(
+      codepoints_shared,
+      font_path1,
+      font_path2,
+      xoffset = xoffset,
+      yoffset = yoffset,
+      scale = scale,
+      min_score = min_score,
+      metric = metric,
+      skip_identical = skip_identical
+    )
+    if aborted:
+      return (sim_score, None, nexamined)
+
   (sim_score, diff) = util.getFontDiffScore(
     codepoints_shared,
     shared_size,
     font_path1,
     font_path2,
     xoffset = xoffset,
-    yoffset = yoffset
+    yoffset = yoffset,
+    scale = scale,
+    metric = metric,
+    skip_identical = skip_identical,
+    memory_cache = memory_cache
   )
 
   font1_base = os.path.basename(font_path1)
   font2_base = os.path.basename(font_path2)
+  font2_title = f"{font2_base} with offset {xoffset}, {yoffset}" + (f" scale {scale}" if scale != 1 else "")
+  missing_title = f"{len(symbols1 - symbols2)} {font1_base} chars not in {font2_base}"
+
+  if paged and size > util.MAX_MATRIX_SIZE:
+    util.saveTiledSymbolMatrix(codepoints, font_path1, f"{file_prefix}_font1", title=font1_base)
+    util.saveTiledSymbolMatrix(
+      codepoints,
+      font_path2,
+      f"{file_prefix}_font2",
+      title=font2_title,
+      xoffset = xoffset,
+      yoffset = yoffset,
+      scale = scale
+    )
+    util.saveTiledSymbolMatrix(codepoints_missing_from2, font_path1, f"{file_prefix}3_missing", title=missing_title)
+    return (sim_score, diff, nexamined)
 
   # if diff.getbbox() is not None:
   image1 = util.drawSymbolMatrix(
     codepoints,
     size,
     font_path1,
-    title=font1_base
+    title=font1_base,
+    memory_cache = memory_cache
   )
   image2 = util.drawSymbolMatrix(
     codepoints,
     size,
     font_path2,
-    title=f"{font2_base} with offset {xoffset}, {yoffset}",
+    title=font2_title,
     xoffset = xoffset,
-    yoffset = yoffset
+    yoffset = yoffset,
+    scale = scale,
+    memory_cache = memory_cache
   )
   image_missing = util.drawSymbolMatrix(
     codepoints_missing_from2,
     size,
     font_path1,
-    title=f"{len(symbols1 - symbols2)} {font1_base} chars not in {font2_base}"
+    title=missing_title,
+    memory_cache = memory_cache
   )
 
   image1.save(f"{file_prefix}_font1.png")
@@ -119,233 +254,369 @@ def compareFonts(
   image_missing.save(f"{file_prefix}3_missing.png")
   # diff.save(f"{file_prefix}_diff.png")
 
-  return (sim_score, diff)
-
-
-def main():
-  parser = argparse.ArgumentParser(
-    prog=sys.argv[0],
-    formatter_class=argparse.RawTextHelpFormatter,
-    description="""
-Analyze font and try to find a similar one
-    """,
-    epilog="""
-Examples:
-  $ python3 fontdiff.py -b -v FontName.ttf google-fonts
-  $ python3 fontdiff.py --fast-search -d cmpdir -b -v path/to/Font.ttf folder/containing/fonts
+  return (sim_score, diff, nexamined)
+
+
+class FontQuery:
+  """ Search of the best matches for one reference font. A corpus can be
+  scanned once for many references by calling scoreFont for each of them on
+  every corpus font, so symbols and renders of the corpus font are shared.
+  Every query keeps its own matches, top scores and output folder.
+  """
+  def __init__(self, font1, out_dir, args, alphabet, start_time):
+    self.font1 = font1
+    self.args = args
+    self.alphabet = alphabet
+    self.diff_folder = out_dir
+    self.start_time = start_time
+    self.deadline = start_time + args.time_budget if args.time_budget else None
+    os.makedirs(out_dir, exist_ok=True)
+
+    self.symbols1 = util.getSymbolIds(font1)
+    self.matches = []
+    self.scores = {}
+    self.candidates = []
+    self.families = None
+    self.nscored = 0
+    self.out_of_time = False
+    self.top_score = 0
+    self.top_full_score = 0
+    self.total_examined = 0
+    self.total_glyphs = 0
+
+    self.f = open(f"{out_dir}/analysis.txt", "wt")
+    self.sink = results.ResultSink(f"{out_dir}/scores.{args.results_format}", SCORE_COLUMNS, args.results_format)
+    util.log(self.f, f"Finding best match for: {font1:<32}")
+    util.log(self.f, f"{font1:<32}: {len(self.symbols1)} glyphs")
+
+  def setCandidates(self, font_files, families = None):
+    """ Corpus fonts to score. With families, only their representatives are
+    scored first, see moreCandidates.
     """
-  )
-
-  parser.add_argument('-a', '--alphabet', help="Specify which letters should we try to match for scoring")
-  parser.add_argument('--fast-search', action='store_true', help="Fast exploration to skip expensive comparisons (implies -b)")
-  parser.add_argument('-b', '--best-fit', action='store_true', help="On each font, try to find the best fit")
-  parser.add_argument('-d', '--out-dir', help="Output folder where images/diffs/etc will be generated")
-  parser.add_argument('-v', '--verbose', action='store_true')
-  parser.add_argument('input_font')
-  parser.add_argument('font_search_path')
-
-  args = parser.parse_args()
-
-  verbose = args.verbose
-
-  alphabet = args.alphabet
-  if args.alphabet in ["std", "standard"]:
-    alphabet = STANDARD_ALPHABET
-
-  # if we want fast search we should go for best_fit for sure
-  if args.fast_search:
-    args.best_fit = True
-  args.exhaustive_search = not args.fast_search
-
-  if not args.out_dir:
-    out_hash = getFileMd5(args.input_font)
-    out_dir = os.path.split(os.path.splitext(args.input_font)[0])[1]
-    args.out_dir = f'tmp/diff-{out_dir}-{out_hash[0:8]}'.lower()
-
-  diff_folder = args.out_dir
-  os.makedirs(diff_folder, exist_ok=True)
-
-  util.init()
-
-  font1 = args.input_font
-  if os.path.isfile(args.font_search_path):
-    font_files = [args.font_search_path]
+    self.candidates = font_files
+    self.families = families
+    if families is not None:
+      util.log(self.f, f"Grouped {len(font_files)} fonts in {len(families)} families")
+
+  def prior(self, font2):
+    """ Cheap estimation of how good a match font2 can be: the fraction of
+    the reference symbols on its cmap
+    """
+    try:
+      return len(self.symbols1 & util.getCmapCodepoints(font2))/max(1, len(self.symbols1))
+    except Exception:
+      return 0
 
-  else:
-    root_dir = args.font_search_path
-    ttf_files = list(glob.glob('**/*.ttf', root_dir = root_dir, recursive = True))
-    otf_files = list(glob.glob('**/*.otf', root_dir = root_dir, recursive = True))
-    font_files = ttf_files + otf_files
-    font_files = [os.path.join(root_dir, file) for file in font_files]
+  def isOutOfTime(self, share = 1.0):
+    """ True once share of the time budget (if any) has been spent
+    """
+    if self.deadline is None:
+      return False
+    return time.time() > self.start_time + share*self.args.time_budget
+
+  def ordered(self, fonts):
+    """ With a time budget, most promising fonts are scored first. Fonts from
+    the phash index are already sorted by distance. Reading the symbols of
+    every font is not free, so fonts left once the scoring budget is spent
+    keep their order, after the rest (they will not be scored anyway).
+    """
+    if not self.args.time_budget or self.args.phash_top:
+      return fonts
+
+    priors = {}
+    for font2 in fonts:
+      if self.isOutOfTime(1 - FINAL_PASS_BUDGET):
+        break
+      priors[font2] = self.prior(font2)
+    return sorted(fonts, key=lambda font2: priors.get(font2, -1), reverse=True)
+
+  def firstCandidates(self):
+    if self.families is None:
+      return self.ordered(self.candidates)
+    return self.ordered(familyRepresentatives(self.families))
+
+  def moreCandidates(self):
+    """ Fonts to score once all firstCandidates have been scored
+    """
+    if self.families is None:
+      return []
+    return self.ordered(expandFamilies(self.families, self.scores, self.args.family_margin))
 
-  # extract copyright/license/...
-  # font = ttLib.TTFont(font2)
-  # for record in font["name"].names:
-  #   print(record)
+  def scoreFont(self, font2):
+    """ Align and score font2 against the reference, adding it to matches
+    unless it is skipped. A row is added to the scores file in any case.
+    """
+    self.nscored += 1
+    start_time = time.time()
+    row = {'font' : font2, 'status' : 'error'}
+    try:
+      row.update(self.scoreFontRow(font2, start_time))
+    except Exception as e:
+      util.log(self.f, f"  ERROR processing {font2}: {e}")
+    row['seconds'] = round(time.time() - start_time, 3)
+    self.sink.write(row)
+
+  def scoreFontRow(self, font2, start_time):
+    """ Body of scoreFont, returns the columns of its row on the scores file
+    """
+    (f, args, font1, symbols1, alphabet) = (self.f, self.args, self.font1, self.symbols1, self.alphabet)
+    util.log(f, f"\n[{self.nscored}/{len(self.candidates)}] {font2}")
+
+    prefix = os.path.splitext(os.path.basename(font2))[0].lower()
+    symbols2 = util.getSymbolIds(font2)
+    util.log(f, f"  {'Total glyps':<32}: {len(symbols1 | symbols2)} glyphs on both fonts")
+    util.log(f, f"  {os.path.basename(font2):<32}: {len(symbols2)} glyphs (vs {len(symbols1)})")
+    util.log(f, f"  {os.path.basename(font2):<32}: {len(symbols1&symbols2)} glyphs shared with {font1} (vs {len(symbols1)})")
+    util.log(f, f"  {os.path.basename(font2):<32}: {len(symbols1-symbols2)} glyphs missing from {font1}")
+
+    diff_len = len(symbols1-symbols2)
+    if diff_len < 15:
+      util.log(f, f"  {'':<32}  {sorted(list(symbols1-symbols2))}")
+    else:
+      util.log(f, f"  {'':<32}  {sorted(list(symbols1-symbols2))[0:15]}...")
+      # util.log(f, f"  {'':<32}  Too many missing symbols: Skipping!!")
+      #continue
+
+    counts = {
+      'nshared' : len(symbols1&symbols2),
+      'nmissing' : len(symbols1-symbols2),
+      'nwanted' : len(symbols1)
+    }
+    if len(symbols1 & symbols2) < (len(symbols1)*0.5):
+      util.log(f, f"  {'':<32}  Too few shared symbols: Skipping!!")
+      return {'status' : 'skipped', **counts}
+
+    best_x = best_y = 0
+    best_scale = 1.0
+    score = 0
+    best_score = self.top_score
+    status = 'scored'
+    location = {}
+    render_font2 = font2
+    if args.best_fit:
+      (best_x, best_y, best_score) = util.fastSearchBestAlignment(font1, font2, step = 3, metric = args.metric)
+
+      # pick the instance of variable fonts first, along with its offsets
+      # since they change with the instance, so fonts whose default instance
+      # is far from font1 are not skipped
+      if args.variable_axes:
+        (location, x, y, axes_score) = util.searchVariableAxes(font1, font2, best_x, best_y, metric = args.metric)
+        if location:
+          (best_x, best_y, best_score) = (x, y, axes_score)
+          render_font2 = util.instantiateFont(font2, location)
+          util.log(f, f"  {'Best instance':<32}: {util.formatLocation(location)} (score={axes_score:.3f})")
+
+      # if quicksearch gives an score < 0.1 then there is no match so we can skip
+      if best_score > 0.1:
+        # offsets are fine tuned on the chosen instance
+        (best_x, best_y, best_score) = util.fastSearchBestAlignment(
+          font1,
+          render_font2,
+          step = 1,
+          search_space = 3,
+          x = best_x,
+          y = best_y,
+          metric = args.metric
+        )
+
+        # the instance might change a bit with the fine tuned offsets
+        if location:
+          (location, best_x, best_y, best_score) = util.searchVariableAxes(font1, font2, best_x, best_y, start = location, metric = args.metric)
+          render_font2 = util.instantiateFont(font2, location)
+          util.log(f, f"  {'Best instance (refined)':<32}: {util.formatLocation(location)} (score={best_score:.3f})")
+
+        if args.subpixel:
+          (best_x, best_y, best_scale, best_score) = util.refineAlignment(font1, render_font2, best_x, best_y, metric = args.metric)
+
+      util.log(f, f"  {'Best alignment':<32}: ({best_x}, {best_y}, scale={best_scale}, score={best_score:.3f}) {'BEST!!' if best_score > self.top_score else ''}")
+      if best_score > self.top_score:
+        self.top_score = best_score
+
+      score = best_score
+
+    if best_score < 0.75*self.top_score:
+      util.log(f, f"  {'Best score is poor':<32}: Skipping non-promising font!")
+      status = 'pruned'
+
+    elif args.exhaustive_search:
+      (score, diff, nexamined) = compareFonts(
+        font1,
+        render_font2,
+        xoffset = best_x,
+        yoffset = best_y,
+        file_prefix=self.diff_folder + "/" + prefix,
+        alphabet = alphabet,
+        scale = best_scale,
+        min_score = 0.75*self.top_full_score if args.progressive else None,
+        paged = args.paged,
+        metric = args.metric,
+        skip_identical = True
+      )
+      util.log(f, f"  {'Glyphs examined':<32}: {nexamined} {'(aborted, cannot beat best score)' if diff is None else ''}")
+      if diff is None:
+        status = 'aborted'
+      self.top_full_score = max(self.top_full_score, score)
+      self.total_examined += nexamined
+      self.total_glyphs += len([c for c in symbols1 & symbols2 if not alphabet or chr(c) in alphabet])
+
+    end_time = time.time()
+    util.log(f, f"  Took {end_time-start_time:.3f} seconds (total of {time.time() - self.start_time:.3f} seconds so far)")
+
+    match = {
+      'font' : font2,
+      'score' : score,
+      'nmissing' : len(symbols1-symbols2),
+      'nshared' : len(symbols1&symbols2),
+      'nwanted' : len(symbols1),
+      'best_x' : best_x,
+      'best_y' : best_y,
+      'best_scale' : best_scale,
+      'location' : location
+    }
+    self.matches.append(match)
+    self.scores[font2] = score
+    return {'status' : status, **match}
+
+  def saveShard(self, shard):
+    """ Save the first pass of a --shard run on shard.json, to be combined
+    with the other shards by merge.py, which runs the final pass
+    """
+    with open(f"{self.diff_folder}/shard.json", "wt") as f2:
+      json.dump({
+        'font1' : self.font1,
+        'shard' : shard[0],
+        'nshards' : shard[1],
+        'args' : vars(self.args),
+        'alphabet' : self.alphabet,
+        'candidates' : self.candidates,
+        'nscored' : self.nscored,
+        'out_of_time' : self.out_of_time,
+        'total_examined' : self.total_examined,
+        'total_glyphs' : self.total_glyphs,
+        'matches' : self.matches
+      }, f2, separators=(',', ':'))
+
+    util.log(self.f, f"\nShard {shard[0]}/{shard[1]} scored {self.nscored} of {len(self.candidates)} fonts, run merge.py on {os.path.dirname(self.diff_folder)} once all shards are done")
+    util.log(self.f, f"\nScript Took: {time.time()-self.start_time:.3f} seconds")
+    self.f.close()
+    self.sink.close()
+
+  def finish(self, top_count = 50, verbose = False):
+    """ Score again the top_count best matches, save their diffs, gifs and
+    fonts, and write the final ranking to analysis-top.json. Returns the final
+    list of best fonts.
+    """
+    (f, args, font1, alphabet, diff_folder) = (self.f, self.args, self.font1, self.alphabet, self.diff_folder)
 
-  script_start_time = time.time()
-  with open(f"{diff_folder}/analysis.txt", "wt") as f:
-    symbols1 = util.getSymbolIds(font1)
+    if self.out_of_time:
+      util.log(f, f"\nTime budget of {args.time_budget:g} seconds exhausted, showing the best matches found so far")
 
-    util.log(f, f"Finding best match for: {font1:<32}")
-    util.log(f, f"{font1:<32}: {len(symbols1)} glyphs")
-    matches = []
+    if self.families is not None or args.time_budget:
+      util.log(f, f"\nFonts scored: {self.nscored} of {len(self.candidates)} ({100*self.nscored/max(1, len(self.candidates)):.1f}%)")
 
-    top_score = 0
-    for idx, ttf_file in enumerate(font_files):
-      font2 = ttf_file
-      try:
-
-        start_time = time.time()
-        util.log(f, f"\n[{idx+1}/{len(font_files)}] {font2}")
-
-        prefix = os.path.splitext(os.path.basename(font2))[0].lower()
-        symbols2 = util.getSymbolIds(font2)
-        util.log(f, f"  {'Total glyps':<32}: {len(symbols1 | symbols2)} glyphs on both fonts")
-        util.log(f, f"  {os.path.basename(font2):<32}: {len(symbols2)} glyphs (vs {len(symbols1)})")
-        util.log(f, f"  {os.path.basename(font2):<32}: {len(symbols1&symbols2)} glyphs shared with {font1} (vs {len(symbols1)})")
-        util.log(f, f"  {os.path.basename(font2):<32}: {len(symbols1-symbols2)} glyphs missing from {font1}")
-
-        diff_len = len(symbols1-symbols2)
-        if diff_len < 15:
-          util.log(f, f"  {'':<32}  {sorted(list(symbols1-symbols2))}")
-        else:
-          util.log(f, f"  {'':<32}  {sorted(list(symbols1-symbols2))[0:15]}...")
-          # util.log(f, f"  {'':<32}  Too many missing symbols: Skipping!!")
-          #continue
-
-        if len(symbols1 & symbols2) < (len(symbols1)*0.5):
-          util.log(f, f"  {'':<32}  Too few shared symbols: Skipping!!")
-          continue
-
-        best_x = best_y = 0
-        score = 0
-        best_score = top_score
-        if args.best_fit:
-          (best_x, best_y, best_score) = util.fastSearchBestAlignment(font1, font2, step = 3)
-
-          # if quicksearch gives an score < 0.1 then there is no match so we can skip
-          if best_score > 0.1:
-            (best_x, best_y, best_score) = util.fastSearchBestAlignment(
-              font1,
-              font2,
-              step = 1,
-              search_space = 3,
-              x = best_x,
-              y = best_y
-            )
-
-          util.log(f, f"  {'Best alignment':<32}: ({best_x}, {best_y}, score={best_score:.3f}) {'BEST!!' if best_score > top_score else ''}")
-          if best_score > top_score:
-            top_score = best_score
-
-          score = best_score
-
-        if best_score < 0.75*top_score:
-          util.log(f, f"  {'Best score is poor':<32}: Skipping non-promising font!")
-
-        elif args.exhaustive_search:
-          (score, _) = compareFonts(
-            font1,
-            font2,
-            xoffset = best_x,
-            yoffset = best_y,
-            file_prefix=diff_folder + "/" + prefix,
-            alphabet = alphabet
-          )
-
-        end_time = time.time()
-        util.log(f, f"  Took {end_time-start_time:.3f} seconds (total of {time.time() - script_start_time:.3f} seconds so far)")
-
-        matches.append ({
-          'font' : font2,
-          'score' : score,
-          'nmissing' : len(symbols1-symbols2),
-          'nshared' : len(symbols1&symbols2),
-          'nwanted' : len(symbols1),
-          'best_x' : best_x,
-          'best_y' : best_y
-        })
-      except Exception as e:
-        util.log(f, f"  ERROR processing {font2}: {e}")
-        continue
+    if args.progressive and self.total_glyphs > 0:
+      util.log(f, f"\nGlyphs examined: {self.total_examined} of {self.total_glyphs} ({100*self.total_examined/self.total_glyphs:.1f}%)")
 
     # generate a list of best matches
-    top_count = 50
-    top_matches = sorted(matches, key=lambda x: x['score'], reverse=True)
+    top_matches = sorted(self.matches, key=lambda x: x['score'], reverse=True)
     top_folder = diff_folder + '/top'
     gif_folder_fonts = top_folder + '-gif'
     diff_folder_fonts = top_folder + '-diff'
     top_folder_fonts = top_folder + '-fonts'
+    glyphs_folder = top_folder + '-glyphs'
 
     os.makedirs(top_folder, exist_ok=True)
     os.makedirs(gif_folder_fonts, exist_ok=True)
     os.makedirs(diff_folder_fonts, exist_ok=True)
     os.makedirs(top_folder_fonts, exist_ok=True)
+    if getattr(args, 'glyph_scores', False):
+      os.makedirs(glyphs_folder, exist_ok=True)
 
     shutil.copy2(font1, diff_folder)
 
     util.log(f, "\n\nTop matches by score (first pass):")
     best_fonts = []
-    fonts_diff = {}
+    # diffs are saved as soon as they are computed, named by first pass rank
+    # since the final one is not known yet, so only one is kept in memory
+    diff_files = {}
     for i, x in enumerate(top_matches[0:top_count]):
-      util.log(f, f"  #{i+1:<2d} {x['font']:<32}: alignment  =({x['best_x']:2d}, {x['best_y']:2d}) score={x['score']:<1.3f} shared={x['nshared']} missing={x['nmissing']} wanted={x['nwanted']}")
+      # the final pass is charged against the time budget too, but at least
+      # the best match is always rescored
+      if i > 0 and self.isOutOfTime():
+        util.log(f, f"  Time budget of {args.time_budget:g} seconds exhausted, only the best {i} matches are rescored")
+        break
+
+      util.log(f, f"  #{i+1:<2d} {x['font']:<32}: alignment  =({x['best_x']:2g}, {x['best_y']:2g}) scale={x['best_scale']:g} score={x['score']:<1.3f} shared={x['nshared']} missing={x['nmissing']} wanted={x['nwanted']}")
 
       font2  = x['font']
+      render_font2 = util.instantiateFont(font2, x['location']) if x['location'] else font2
       prefix = os.path.splitext(os.path.basename(font2))[0].lower()
 
       # recompute best alignment, since sometimes it might not be 100% ok
       # (best_x, best_y, best_score) = util.searchBestAlignment(font1, font2)
       best_x = x['best_x']
       best_y = x['best_y']
-      best_score = x['score']
-      (score, diff) = compareFonts(
+      best_scale = x['best_scale']
+      (score, diff, _) = compareFonts(
         font1,
-        font2,
+        render_font2,
         xoffset = best_x,
         yoffset = best_y,
         file_prefix=top_folder + "/" + prefix,
-        alphabet=alphabet
+        alphabet=alphabet,
+        scale = best_scale,
+        paged = args.paged,
+        metric = args.metric,
+        memory_cache = False
       )
+      diff_files[font2] = f"{diff_folder_fonts}/pending-{i+1:03d}.png"
+      diff.save(diff_files[font2])
+      del diff
+
+      if getattr(args, 'glyph_scores', False):
+        saveGlyphScores(font1, render_font2, f"{glyphs_folder}/{prefix}.json", best_x, best_y, best_scale, alphabet, args.metric)
+
       best_fonts.append ({
         'font' : font2,
         'best_x' : best_x,
         'best_y': best_y,
+        'best_scale': best_scale,
+        'location': x['location'],
         'nmissing': x['nmissing'],
         'nshared': x['nshared'],
         'nwanted': x['nwanted'],
         'score' : score,
       })
-      fonts_diff[font2] = diff
 
       shutil.copy2(font2, top_folder_fonts)
 
-    util.log(f, "\n")
-    util.log(f, json.dumps(best_fonts, indent=2))
-
     util.log(f, "\n\nTop matches by score (final pass):")
     best_fonts = sorted(best_fonts, key=lambda x: x['score'], reverse=True)
+
+    # first frame of every gif
+    image1 = util.drawSymbolMatrix(
+      STANDARD_ALPHABET,
+      None,
+      font1,
+      title=os.path.basename(font1),
+      memory_cache = False
+    )
     for i, x in enumerate(best_fonts):
       font2 = x['font']
-      util.log(f, f"  #{i+1:<2d} {font2:<32}: alignment  =({x['best_x']:2d}, {x['best_y']:2d}) score={x['score']:<1.3f} shared={x['nshared']} missing={x['nmissing']} wanted={x['nwanted']}")
+      util.log(f, f"  #{i+1:<2d} {font2:<32}: alignment  =({x['best_x']:2g}, {x['best_y']:2g}) scale={x['best_scale']:g} score={x['score']:<1.3f} shared={x['nshared']} missing={x['nmissing']} wanted={x['nwanted']}")
 
       # save diff to another folder, sorted by score
       (_, file) = os.path.split(font2)
-      diff = fonts_diff[font2]
-      diff.save(f"{diff_folder_fonts}/{i+1:03d}-{file}-s{x['score']:1.3f}.png")
-      image1 = util.drawSymbolMatrix(
-        STANDARD_ALPHABET,
-        None,
-        font1,
-        title=os.path.basename(font1)
-      )
+      os.replace(diff_files[font2], f"{diff_folder_fonts}/{i+1:03d}-{file}-s{x['score']:1.3f}.png")
       image2 = util.drawSymbolMatrix(
         STANDARD_ALPHABET,
         None,
-        font2,
-        title=f"{os.path.basename(font2)} offset={x['best_x']}, {x['best_y']}  score={x['score']}",
+        util.instantiateFont(font2, x['location']) if x['location'] else font2,
+        title=f"{os.path.basename(font2)}{' ' + util.formatLocation(x['location']) if x['location'] else ''} offset={x['best_x']}, {x['best_y']} scale={x['best_scale']} score={x['score']}",
         xoffset = x['best_x'],
-        yoffset = x['best_y']
+        yoffset = x['best_y'],
+        scale = x['best_scale'],
+        memory_cache = False
       )
       image1.save(
         f"{gif_folder_fonts}/{i+1:03d}-{file}-s{x['score']:1.3f}.gif",
@@ -356,11 +627,199 @@ Examples:
       )
 
 
-    best_fonts = [{'source_font' : font1, 'nsymbols' : len(symbols1)}] + best_fonts
+    top_json = [{
+      'source_font' : font1,
+      'nsymbols' : len(self.symbols1),
+      'nscored' : self.nscored,
+      'ncandidates' : len(self.candidates)
+    }] + best_fonts
+    # scores of every font are on the scores file, so the ranking is kept
+    # compact and not printed
     with open(f"{diff_folder}/analysis-top.json", "wt") as f2:
-      util.log(f2, json.dumps(best_fonts, indent=2))
+      json.dump(top_json, f2, separators=(',', ':'))
+
+    if verbose:
+      util.log(f, f"\nFont handles: {util.g_fontPool.stats()}")
+    util.log(f, f"\nScript Took: {time.time()-self.start_time:.3f} seconds")
+    f.close()
+    self.sink.close()
+    return best_fonts
+
+def saveGlyphScores(font_path1, font_path2, out_file, xoffset = 0, yoffset = 0, scale = 1.0, alphabet = None, metric = metrics.DEFAULT_METRIC):
+  """ Save the score of every glyph shared by both fonts on its own, worst
+  first, to see which glyphs make a match fail
+  """
+  symbols2 = util.getSymbolIds(font_path2)
+  codepoints = [chr(x) for x in sorted(util.getSymbolIds(font_path1)) if x in symbols2]
+  if alphabet:
+    codepoints = [x for x in codepoints if x in alphabet]
+
+  scores = util.getGlyphScores(codepoints, font_path1, font_path2, xoffset, yoffset, scale, metric)
+  glyphs = sorted(zip(codepoints, (float(x) for x in scores)), key=lambda x: x[1])
+  with open(out_file, "wt") as f:
+    json.dump([{'symbol': symbol, 'score': score} for (symbol, score) in glyphs], f, ensure_ascii=False, separators=(',', ':'))
+
+def queryOutDir(font1, out_dir = None):
+  """ Output folder for given reference font: tmp/diff-<name>-<md5>, placed
+  inside out_dir instead of tmp if given
+  """
+  out_hash = util.getFileMd5(font1)
+  name = os.path.split(os.path.splitext(font1)[0])[1]
+  return f'{out_dir or "tmp"}/{f"diff-{name}-{out_hash[0:8]}".lower()}'
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""
+Analyze font and try to find a similar one
+    """,
+    epilog="""
+Examples:
+  $ python3 fontdiff.py -b -v FontName.ttf google-fonts
+  $ python3 fontdiff.py --fast-search -d cmpdir -b -v path/to/Font.ttf folder/containing/fonts
+  $ python3 fontdiff.py -b --time-budget 60 FontName.ttf google-fonts
+
+  # batch mode: every font of the folder (or listed in fonts.txt, one per line)
+  # is matched in a single pass over the corpus, each on its own folder of -d
+  $ python3 fontdiff.py -b -d cmpdir customer-fonts/ google-fonts
+  $ python3 fontdiff.py -b -d cmpdir fonts.txt google-fonts
+
+  # split the corpus among hosts (or processes) sharing the output folder,
+  # then combine their results
+  $ python3 fontdiff.py -b --shard 1/2 -d cmpdir FontName.ttf google-fonts
+  $ python3 fontdiff.py -b --shard 2/2 -d cmpdir FontName.ttf google-fonts
+  $ python3 merge.py cmpdir
+    """
+  )
+
+  parser.add_argument('-a', '--alphabet', help="Specify which letters should we try to match for scoring")
+  parser.add_argument('--fast-search', action='store_true', help="Fast exploration to skip expensive comparisons (implies -b)")
+  parser.add_argument('--progressive', action='store_true', help="Score glyphs progressively and stop as soon as a font cannot beat the best ones")
+  parser.add_argument('--paged', action='store_true', help="Save matrices of big fonts in multiple pages instead of trimming them")
+  parser.add_argument('-m', '--metric', default=metrics.DEFAULT_METRIC, choices=sorted(metrics.METRICS), help="Similarity metric used for scoring and alignment")
+  parser.add_argument('--glyph-scores', action='store_true', help="Save the score of every glyph of the top matches, worst first, to see which glyphs differ the most")
+  parser.add_argument('-b', '--best-fit', action='store_true', help="On each font, try to find the best fit")
+  parser.add_argument('--subpixel', action='store_true', help="Refine best fit with fractional offsets and font scale (implies -b)")
+  parser.add_argument('--variable-axes', action='store_true', help=f"Search the {'/'.join(util.VARIABLE_AXES)} axes of variable fonts for the best instance (implies -b)")
+  parser.add_argument('--phash-top', type=int, help="Only scan the N fonts with the closest perceptual hash of the probe glyphs")
+  parser.add_argument('--family-search', action='store_true', help="Score one font per family first, and only the rest of the families that look promising")
+  parser.add_argument('--family-margin', type=float, default=FAMILY_MARGIN, help=f"Expand families scoring at least this fraction of the best one (default {FAMILY_MARGIN})")
+  parser.add_argument('--time-budget', type=float, help=f"Score fonts for at most this many seconds, most promising first, and report the best matches so far ({FINAL_PASS_BUDGET:.0%} of the time is kept to rescore them)")
+  parser.add_argument('-k', '--top', type=int, default=50, help="Number of best matches kept per reference font (default 50)")
+  parser.add_argument('--results-format', choices=results.FORMATS, default='jsonl', help="Format of the scores file, written as fonts are scored (default jsonl)")
+  parser.add_argument('--shard', type=parseShard, help="Only scan the i-th of N parts of the corpus (i/N), saving partial results for merge.py")
+  parser.add_argument('-d', '--out-dir', help="Output folder where images/diffs/etc will be generated (one subfolder per font in batch mode)")
+  parser.add_argument('-v', '--verbose', action='store_true')
+  parser.add_argument('--profile-startup', action='store_true', help="Report time spent starting up and importing modules")
+  parser.add_argument('input_font', help="Font to match, or a folder/text file with many of them (batch mode)")
+  parser.add_argument('font_search_path')
+
+  args = parser.parse_args()
+  if args.profile_startup:
+    lazy.profileStartup()
+
+  verbose = args.verbose
+
+  alphabet = args.alphabet
+  if args.alphabet in ["std", "standard"]:
+    alphabet = STANDARD_ALPHABET
+
+  # if we want fast search we should go for best_fit for sure
+  if args.fast_search or args.subpixel or args.variable_axes:
+    args.best_fit = True
+  args.exhaustive_search = not args.fast_search
+
+  util.init()
+
+  reference_fonts = findReferenceFonts(args.input_font)
+  batch = not (os.path.isfile(args.input_font) and reference_fonts == [args.input_font])
+  font_files = findFontFiles(args.font_search_path)
+
+  script_start_time = time.time()
+  if args.shard:
+    font_files = [font_file for font_file in font_files if getFontShard(font_file, args.shard[1]) == args.shard[0]]
+    print(f"Shard {args.shard[0]}/{args.shard[1]}: {len(font_files)} fonts")
+
+  queries = []
+  for font1 in reference_fonts:
+    out_dir = queryOutDir(font1, args.out_dir) if batch or not args.out_dir else args.out_dir
+    if args.shard:
+      out_dir = shardOutDir(out_dir, args.shard)
+    queries.append(FontQuery(font1, out_dir, args, alphabet, script_start_time))
+
+  # fonts are hashed, ordered and scored until the part of the time budget not
+  # kept for the final pass is spent
+  deadline = script_start_time + (1 - FINAL_PASS_BUDGET)*args.time_budget if args.time_budget else None
+
+  # prefilter candidates by hamming distance of their probe glyph hashes, which
+  # is way cheaper than rendering and aligning all of them. The corpus is
+  # hashed once for all references
+  if args.phash_top:
+    index = phash.PerceptualHashIndex()
+    for font_file in font_files:
+      if deadline is not None and time.time() > deadline:
+        print(f"Time budget exhausted, only {len(index.rows)} of {len(font_files)} fonts hashed")
+        break
+      try:
+        index.add(font_file)
+      except Exception as e:
+        print(f"ERROR hashing {font_file}: {e}")
+
+  families = None
+  if args.family_search:
+    families = util.groupFontFamilies(font_files)
+    print(f"Grouped {len(font_files)} fonts in {len(families)} families")
+
+  for query in queries:
+    if args.phash_top:
+      nearest = index.query(phash.getFontHashes(query.font1), max_results = args.phash_top)
+      candidates = [font_file for (_distance, font_file) in nearest]
+      query.setCandidates(candidates, util.groupFontFamilies(candidates) if args.family_search else None)
+    else:
+      query.setCandidates(font_files, families)
+
+  # extract copyright/license/...
+  # font = ttLib.TTFont(font2)
+  # for record in font["name"].names:
+  #   print(record)
 
-    util.log(f, f"\nScript Took: {time.time()-script_start_time:.3f} seconds")
+  # corpus fonts are scored against every reference that wants them before
+  # moving to the next one, so they are loaded and rendered only once. With
+  # family search, families are expanded once all representatives are scored
+  out_of_time = False
+  for candidates_of in [FontQuery.firstCandidates, FontQuery.moreCandidates]:
+    pending = {}
+    ranks = {}
+    for query in queries:
+      for rank, font2 in enumerate(candidates_of(query)):
+        pending.setdefault(font2, []).append(query)
+        ranks[font2] = min(rank, ranks.get(font2, rank))
+
+    for font2 in sorted(pending, key=lambda font2: ranks[font2]):
+      if deadline is not None and time.time() > deadline:
+        out_of_time = True
+        break
+      for query in pending[font2]:
+        query.scoreFont(font2)
+
+    if out_of_time:
+      for query in queries:
+        query.out_of_time = True
+      break
+
+  for query in queries:
+    if args.shard:
+      query.saveShard(args.shard)
+      continue
+
+    best_fonts = query.finish(args.top, verbose)
+    if batch:
+      best = best_fonts[0] if best_fonts else None
+      print(f"{query.font1}: {best['font'] + ' score=' + format(best['score'], '.3f') if best else 'no match'} ({query.diff_folder})")
+
+  if batch:
+    print(f"\nMatched {len(queries)} fonts against {len(font_files)} fonts in {time.time()-script_start_time:.3f} seconds")
 
 if __name__ == '__main__':
   main()
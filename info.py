@@ -13,12 +13,14 @@ import argparse
 import hashlib
 import shutil
 import _pickle as pickle
-from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageSequence
-from fontTools import ttLib
-import numpy
 
+import lazy
 import util
 
+Image = lazy.lazyImport('PIL.Image')
+ImageDraw = lazy.lazyImport('PIL.ImageDraw')
+ttLib = lazy.lazyImport('fontTools.ttLib')
+
 def main():
   parser = argparse.ArgumentParser(
     prog=sys.argv[0],
@@ -35,6 +37,7 @@ Examples:
 
   parser.add_argument('-d', '--out-dir', help="Output folder where images/diffs/etc will be generated")
   parser.add_argument('-v', '--verbose', action='store_true')
+  parser.add_argument('--profile-startup', action='store_true', help="Report time spent starting up and importing modules")
   parser.add_argument('input_font')
 
   CHARSET_TEXT_MAP = {
@@ -52,6 +55,8 @@ Examples:
   }
 
   args = parser.parse_args()
+  if args.profile_startup:
+    lazy.profileStartup()
   verbose = args.verbose
 
   if not args.out_dir:
@@ -63,7 +68,7 @@ Examples:
 
   font1_path = args.input_font
 
-  arial_font = ImageFont.truetype("Arial", 12)
+  arial_font = util.getTitleFont(12)
   script_start_time = time.time()
   with open(f"{args.out_dir}/analysis.txt", "wt") as f:
     MAX_HEIGHT = 900
@@ -84,7 +89,7 @@ Examples:
 
     for font1_path in input_fonts:
       symbols1 = util.getSymbolIds(font1_path)
-      font1 = ImageFont.truetype(font1_path, font_size)
+      font1 = util.getFont(font1_path, font_size)
 
 
       num_lines = 0
@@ -122,13 +127,14 @@ Examples:
       util.log(f, f"  - Charsets: {', '.join(font1charsets)}")
 
       image1.save(f"{args.out_dir}/{os.path.basename(font1_path).lower()}.png")
-      image = util.drawSymbolMatrix(
+
+      # big fonts are saved in multiple pages so all symbols are shown
+      util.saveTiledSymbolMatrix(
         ''.join([chr(c) for c in sorted(list(symbols1))]),
-        None,
         font1_path,
+        f"{args.out_dir}/symbols-{os.path.basename(font1_path).lower()}",
         title=f"{len(symbols1)} symbols ({os.path.basename(font1_path)})"
       )
-      image.save(f"{args.out_dir}/symbols-{os.path.basename(font1_path).lower()}.png")
 
 
     util.log(f, f"\nScript Took: {time.time()-script_start_time:.3f} seconds")
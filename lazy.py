@@ -0,0 +1,68 @@
+#
+# Lazy imports, so heavy dependencies (numpy, Pillow, fontTools...) are only
+# loaded when a script actually uses them instead of on startup. Time spent on
+# each import is recorded and can be reported with --profile-startup.
+#
+import sys
+import time
+import atexit
+import importlib
+import threading
+
+# {module_name: seconds} of every lazy module loaded so far
+g_importTimes = {}
+
+g_lock = threading.Lock()
+
+class LazyModule:
+  """ Stands for a module that is imported the first time any of its
+  attributes is accessed
+  """
+  def __init__(self, name):
+    self.__dict__['_name'] = name
+    self.__dict__['_module'] = None
+
+  def _load(self):
+    module = self.__dict__['_module']
+    if module is not None:
+      return module
+
+    with g_lock:
+      if self.__dict__['_module'] is None:
+        start_time = time.perf_counter()
+        module = importlib.import_module(self._name)
+        g_importTimes[self._name] = time.perf_counter() - start_time
+        self.__dict__['_module'] = module
+    return self.__dict__['_module']
+
+  def __getattr__(self, attr):
+    return getattr(self._load(), attr)
+
+  def __setattr__(self, attr, value):
+    setattr(self._load(), attr, value)
+
+  def __repr__(self):
+    state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+    return f"<lazy module '{self._name}' ({state})>"
+
+def lazyImport(name):
+  """ Returns a LazyModule for given module name (i.e 'PIL.Image'). Modules
+  already imported are returned as is.
+  """
+  if name in sys.modules:
+    return sys.modules[name]
+  return LazyModule(name)
+
+def reportImports(out = sys.stderr):
+  total = sum(g_importTimes.values())
+  out.write(f"Lazy imports: {1000*total:.1f} ms\n")
+  for name, seconds in sorted(g_importTimes.items(), key=lambda x: x[1], reverse=True):
+    out.write(f"  {name:<32} {1000*seconds:8.1f} ms\n")
+
+def profileStartup(out = sys.stderr):
+  """ Report the CPU time spent so far (interpreter startup and eager imports,
+  when called right after parsing arguments), and the cost of every lazy
+  import when the script finishes
+  """
+  out.write(f"Startup: {1000*time.process_time():.1f} ms until arguments were parsed\n")
+  atexit.register(reportImports, out)
@@ -0,0 +1,130 @@
+#
+# Combine the partial results of fontdiff.py --shard runs (one per host or
+# process, see getFontShard) into the final ranking and artifacts of each
+# reference font, as if a single fontdiff.py had scanned the whole corpus.
+#
+import sys
+import os
+import time
+import glob
+import json
+import argparse
+
+import lazy
+import util
+import results
+import fontdiff
+
+def findShardFiles(query_dir):
+  return sorted(glob.glob(f"{query_dir}/shard-*-of-*/shard.json"))
+
+def findQueryDirs(path):
+  """ Folders of the queries with shards: path itself, or its subfolders in
+  batch mode
+  """
+  if findShardFiles(path):
+    return [path]
+  return [folder for folder in sorted(glob.glob(f"{path}/*/")) if findShardFiles(folder)]
+
+def loadShards(query_dir):
+  """ Partial results of all the shards of a query. Raises ValueError if
+  they come from different runs
+  """
+  shards = []
+  for shard_file in findShardFiles(query_dir):
+    with open(shard_file, 'rt') as f:
+      shard = json.load(f)
+    shard['dir'] = os.path.dirname(shard_file)
+    shards.append(shard)
+
+  if len(set(shard['nshards'] for shard in shards)) > 1 or len(set(shard['font1'] for shard in shards)) > 1:
+    raise ValueError(f"{query_dir} has shards of different runs")
+  return sorted(shards, key=lambda shard: shard['shard'])
+
+def mergeQuery(query_dir, top_count = None, partial = False, verbose = False):
+  """ Final pass (see FontQuery.finish) on the matches of all the shards of a
+  query. Returns the final list of best fonts
+  """
+  start_time = time.time()
+  shards = loadShards(query_dir)
+  nshards = shards[0]['nshards']
+  missing = sorted(set(range(1, nshards + 1)) - set(shard['shard'] for shard in shards))
+  if missing and not partial:
+    raise ValueError(f"{query_dir} is missing shards {', '.join(str(shard) for shard in missing)} of {nshards}")
+
+  # shards run with the same options, so the final pass uses them too
+  args = argparse.Namespace(**shards[0]['args'])
+  query = fontdiff.FontQuery(shards[0]['font1'], query_dir, args, shards[0]['alphabet'], start_time)
+  util.log(query.f, f"Merging {len(shards)} of {nshards} shards")
+  if missing:
+    util.log(query.f, f"  Missing shards: {', '.join(str(shard) for shard in missing)}")
+
+  for shard in shards:
+    query.candidates += shard['candidates']
+    query.matches += shard['matches']
+    query.nscored += shard['nscored']
+    query.out_of_time |= shard['out_of_time']
+    query.total_examined += shard['total_examined']
+    query.total_glyphs += shard['total_glyphs']
+
+    scores_file = f"{shard['dir']}/scores.{args.results_format}"
+    if os.path.isfile(scores_file):
+      for row in results.readRows(scores_file, args.results_format):
+        query.sink.write(row)
+
+  # only tells finish to report how many fonts were scored
+  if args.family_search:
+    query.families = []
+
+  return query.finish(top_count or args.top, verbose)
+
+def main():
+  parser = argparse.ArgumentParser(
+    prog=sys.argv[0],
+    formatter_class=argparse.RawTextHelpFormatter,
+    description="""
+Combine the results of fontdiff.py --shard runs into the final ranking
+    """,
+    epilog="""
+Examples:
+  $ python3 fontdiff.py -b --shard 1/2 -d cmpdir FontName.ttf google-fonts
+  $ python3 fontdiff.py -b --shard 2/2 -d cmpdir FontName.ttf google-fonts
+  $ python3 merge.py cmpdir
+    """
+  )
+
+  parser.add_argument('-k', '--top', type=int, help="Number of best matches kept per reference font (default: same as the shards)")
+  parser.add_argument('--partial', action='store_true', help="Merge even if some shards are missing")
+  parser.add_argument('-v', '--verbose', action='store_true')
+  parser.add_argument('--profile-startup', action='store_true', help="Report time spent starting up and importing modules")
+  parser.add_argument('out_dir', help="Output folder of the shards (-d of fontdiff.py)")
+
+  args = parser.parse_args()
+  if args.profile_startup:
+    lazy.profileStartup()
+
+  util.init()
+
+  query_dirs = findQueryDirs(args.out_dir)
+  if not query_dirs:
+    print(f"No shards found on {args.out_dir}")
+    sys.exit(1)
+
+  failed = False
+  for query_dir in query_dirs:
+    try:
+      best_fonts = mergeQuery(query_dir, args.top, args.partial, args.verbose)
+    except ValueError as e:
+      print(f"ERROR: {e}")
+      failed = True
+      continue
+
+    if len(query_dirs) > 1:
+      best = best_fonts[0] if best_fonts else None
+      print(f"{query_dir}: {best['font'] + ' score=' + format(best['score'], '.3f') if best else 'no match'}")
+
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
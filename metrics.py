@@ -0,0 +1,166 @@
+#
+# Similarity metrics between glyphs rendered by two fonts. Glyphs are given
+# as stacks of cells (numpy arrays of shape (n, height, width), black on
+# white) and every metric computes one value per glyph cell, so scores can be
+# computed on all glyphs, tile by tile, or estimated from a sample of them.
+#
+# Higher scores always mean more similar fonts.
+#
+from lazy import lazyImport
+
+numpy = lazyImport('numpy')
+
+METRICS = {}
+DEFAULT_METRIC = 'mse'
+
+# pixels darker than this are considered ink by binarized metrics
+INK_THRESHOLD = 128
+
+# distance (in pixels) at which the chamfer distance is truncated
+CHAMFER_MAX_DISTANCE = 8
+
+class Metric:
+  """ glyph_values(cells1, cells2) returns one value per glyph and
+  score(mean_value) turns the mean of those values into the final score.
+  pixel_diff is set on metrics whose values are mean absolute pixel
+  differences, which can be computed on the whole matrix image at once.
+
+  croppable metrics give the same values when cells are cropped to any box
+  holding all their ink, so the white margins of the cells can be skipped.
+  """
+  def __init__(self, name, glyph_values, score, description, pixel_diff = False, croppable = False):
+    self.name = name
+    self.glyph_values = glyph_values
+    self.score = score
+    self.description = description
+    self.pixel_diff = pixel_diff
+    self.croppable = croppable
+
+  @property
+  def perfect_value(self):
+    """ Value given to a glyph compared against itself, used for glyphs known
+    to be identical without rendering them
+    """
+    if not hasattr(self, '_perfect_value'):
+      blank = numpy.full((1, 8, 8), 255, dtype=numpy.uint8)
+      self._perfect_value = float(self.glyph_values(blank, blank)[0])
+    return self._perfect_value
+
+  def glyphScores(self, cells1, cells2):
+    """ Score of each glyph on its own
+    """
+    return self.score(self.glyph_values(cells1, cells2))
+
+def registerMetric(name, description, score = None, pixel_diff = False, croppable = False):
+  """ Decorator to register a glyph_values function as a metric
+  """
+  def decorator(glyph_values):
+    METRICS[name] = Metric(
+      name,
+      glyph_values,
+      score if score else (lambda mean: mean),
+      description,
+      pixel_diff,
+      croppable
+    )
+    return glyph_values
+  return decorator
+
+def getMetric(name):
+  if isinstance(name, Metric):
+    return name
+  if name not in METRICS:
+    raise ValueError(f"Unknown metric '{name}', available: {', '.join(sorted(METRICS))}")
+  return METRICS[name]
+
+def _ink(cells):
+  return cells < INK_THRESHOLD
+
+def _dilate(mask):
+  """ Grow a stack of boolean cells by one pixel (4-connected)
+  """
+  grown = mask.copy()
+  grown[:, 1:, :] |= mask[:, :-1, :]
+  grown[:, :-1, :] |= mask[:, 1:, :]
+  grown[:, :, 1:] |= mask[:, :, :-1]
+  grown[:, :, :-1] |= mask[:, :, 1:]
+  return grown
+
+def _distanceTransform(mask, max_distance):
+  """ City block distance from every pixel to the closest set pixel of its
+  own cell, truncated to max_distance. Computed by growing the mask one pixel
+  at a time, which only needs max_distance vectorized passes.
+  """
+  distance = numpy.where(mask, 0, max_distance).astype(numpy.float32)
+  grown = mask
+  for d in range(1, max_distance):
+    grown = _dilate(grown)
+    distance[grown & (distance == max_distance)] = d
+  return distance
+
+def _logMseScore(mean):
+  # 1/LOG(MSE) since we want to maximize, adding e so identical glyphs get 1
+  # instead of dividing by log(0)
+  return 1/numpy.log(numpy.e + mean**2)
+
+@registerMetric(
+  'mse',
+  "1/log(e + mean(diff)^2) of the whole matrix (default)",
+  score = _logMseScore,
+  pixel_diff = True
+)
+def meanDiff(cells1, cells2):
+  diff = numpy.abs(cells1.astype(numpy.int16) - cells2.astype(numpy.int16))
+  return diff.mean(axis=(1, 2))
+
+@registerMetric('ssim', "Structural similarity computed on each glyph cell")
+def ssim(cells1, cells2):
+  c1 = (0.01*255)**2
+  c2 = (0.03*255)**2
+
+  a = cells1.astype(numpy.float32)
+  b = cells2.astype(numpy.float32)
+  mu_a = a.mean(axis=(1, 2))
+  mu_b = b.mean(axis=(1, 2))
+  var_a = a.var(axis=(1, 2))
+  var_b = b.var(axis=(1, 2))
+  cov = (a*b).mean(axis=(1, 2)) - mu_a*mu_b
+
+  return ((2*mu_a*mu_b + c1) * (2*cov + c2)) / ((mu_a**2 + mu_b**2 + c1) * (var_a + var_b + c2))
+
+@registerMetric('iou', "Intersection over union of the binarized glyphs", croppable = True)
+def iou(cells1, cells2):
+  ink1 = _ink(cells1)
+  ink2 = _ink(cells2)
+
+  intersection = (ink1 & ink2).sum(axis=(1, 2))
+  union = (ink1 | ink2).sum(axis=(1, 2))
+
+  # two empty cells are identical
+  return numpy.where(union > 0, intersection / numpy.maximum(union, 1), 1.0)
+
+@registerMetric(
+  'chamfer',
+  "1/(1 + symmetric chamfer distance) between the binarized glyph outlines",
+  score = lambda mean: 1/(1 + mean),
+  croppable = True
+)
+def chamferDistance(cells1, cells2):
+  ink1 = _ink(cells1)
+  ink2 = _ink(cells2)
+
+  distance1 = _distanceTransform(ink1, CHAMFER_MAX_DISTANCE)
+  distance2 = _distanceTransform(ink2, CHAMFER_MAX_DISTANCE)
+
+  count1 = ink1.sum(axis=(1, 2))
+  count2 = ink2.sum(axis=(1, 2))
+
+  # mean distance from the ink of each glyph to the ink of the other one
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    d12 = numpy.where(ink1, distance2, 0).sum(axis=(1, 2)) / count1
+    d21 = numpy.where(ink2, distance1, 0).sum(axis=(1, 2)) / count2
+
+  distance = (d12 + d21)/2
+  distance = numpy.where((count1 == 0) != (count2 == 0), CHAMFER_MAX_DISTANCE, distance)
+  distance = numpy.where((count1 == 0) & (count2 == 0), 0, distance)
+  return distance
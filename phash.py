@@ -0,0 +1,202 @@
+#
+# Perceptual hashes (dHash) of a few probe glyphs per font, so that similar
+# fonts can be found by hamming distance before rendering full matrices.
+#
+from lazy import lazyImport
+import util
+import cache
+
+Image = lazyImport('PIL.Image')
+ImageChops = lazyImport('PIL.ImageChops')
+numpy = lazyImport('numpy')
+
+# same idea as the probes of the fast alignment search (util.getProbeSymbols): a few
+# symbols per script that are usually drawn differently between fonts
+PROBE_TEXT_MAP = {
+  "latin": "abjsAWM15",
+  "cyrillic": "бжфяБДЖЯ",
+  "greek": "αβγξωΣΦΩ",
+  "hebrew": "אבגשת",
+  "arabic": "بجسعك",
+  "devanagari": "कखगपह",
+  "chinese": "永的國我",
+  "japanese": "あかさアカサ",
+  "korean": "가나다한",
+  "thai": "กขคฉ",
+}
+
+PROBE_SYMBOLS = ''.join(PROBE_TEXT_MAP.values())
+
+HASH_BITS = 64
+
+# fonts sharing less probe symbols than this are considered too different
+MIN_SHARED_PROBES = 5
+
+# number of bits set for each possible byte, used when numpy has no popcount.
+# Built on first use, so numpy is not loaded on import
+_POPCOUNT_TABLE = None
+
+def popcount(values):
+  """ Number of bits set on each element of an uint64 numpy array
+  """
+  global _POPCOUNT_TABLE
+  if hasattr(numpy, 'bitwise_count'):
+    return numpy.bitwise_count(values)
+
+  if _POPCOUNT_TABLE is None:
+    _POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+  as_bytes = values.view(numpy.uint8).reshape(values.shape + (8,))
+  return _POPCOUNT_TABLE[as_bytes].sum(axis=-1)
+
+def hammingDistance(hash1, hash2):
+  """ Number of different bits between two hashes
+  """
+  return bin(hash1 ^ hash2).count('1')
+
+def glyphDHash(image):
+  """ Difference hash of a rendered glyph. The image is cropped to the ink
+  bounding box first, so the hash does not depend on glyph placement nor
+  on the size of the glyph, only on its shape.
+  """
+  image = image.convert("L")
+
+  # ink is black on white, so invert to get the bbox of the ink
+  bbox = ImageChops.invert(image).getbbox()
+  if bbox is None:
+    return 0
+
+  small = image.crop(bbox).resize((9, 8), Image.Resampling.BILINEAR)
+  pixels = numpy.asarray(small, dtype=numpy.int16)
+
+  bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+  value = 0
+  for bit in bits:
+    value = (value << 1) | int(bit)
+  return value
+
+def glyphInkDensity(image):
+  """ Fraction of the ink bounding box of a rendered glyph covered by ink, a
+  proxy of the stroke weight that dHash mostly ignores
+  """
+  image = image.convert("L")
+  bbox = ImageChops.invert(image).getbbox()
+  if bbox is None:
+    return 0.0
+
+  pixels = numpy.asarray(image.crop(bbox), dtype=numpy.float32)
+  return float(1 - pixels.mean()/255)
+
+def getFontInkDensity(font_path):
+  """ Average ink density (see glyphInkDensity) of the probe symbols that
+  the font defines, or None if it has none. Cached on disk.
+  """
+  diskCacheId = cache.g_diskCache.path('phash', f"density-{util.getFileKey(font_path)}", '.density')
+  density = cache.g_diskCache.loadPickle('phash', diskCacheId)
+  if density is not None:
+    return density[0]
+
+  symbols = util.getSymbolIds(font_path)
+  densities = [glyphInkDensity(util.drawText(symbol, font_path)) for symbol in PROBE_SYMBOLS if ord(symbol) in symbols]
+  density = (sum(densities)/len(densities) if densities else None,)
+
+  cache.g_diskCache.savePickle('phash', diskCacheId, density)
+
+  return density[0]
+
+def getFontHashes(font_path):
+  """ Return a dict of {codepoint: dhash} with the probe symbols that the font
+  defines. Results are cached on disk.
+  """
+  diskCacheId = cache.g_diskCache.path('phash', f"phash-{util.getFileKey(font_path)}", '.phash')
+  hashes = cache.g_diskCache.loadPickle('phash', diskCacheId)
+  if hashes is not None:
+    return hashes
+
+  symbols = util.getSymbolIds(font_path)
+
+  hashes = {}
+  for symbol in PROBE_SYMBOLS:
+    if ord(symbol) not in symbols:
+      continue
+    hashes[ord(symbol)] = glyphDHash(util.drawText(symbol, font_path))
+
+  cache.g_diskCache.savePickle('phash', diskCacheId, hashes)
+
+  return hashes
+
+class PerceptualHashIndex:
+  """ Packed array of probe hashes (one row per font, one column per probe
+  symbol) that can be scanned with a vectorized popcount.
+  """
+  def __init__(self):
+    self.probes = [ord(x) for x in PROBE_SYMBOLS]
+    self.font_paths = []
+    self.rows = []
+    self.hashes = None
+    self.mask = None
+
+  def add(self, font_path, hashes = None):
+    if hashes is None:
+      hashes = getFontHashes(font_path)
+
+    self.font_paths.append(font_path)
+    self.rows.append(hashes)
+    self.hashes = None
+
+  def _pack(self, hashes):
+    row = numpy.zeros(len(self.probes), dtype=numpy.uint64)
+    mask = numpy.zeros(len(self.probes), dtype=bool)
+    for i, codepoint in enumerate(self.probes):
+      if codepoint in hashes:
+        row[i] = hashes[codepoint]
+        mask[i] = True
+    return (row, mask)
+
+  def build(self):
+    """ Pack all added fonts into numpy arrays. Called automatically on query.
+    """
+    self.hashes = numpy.zeros((len(self.rows), len(self.probes)), dtype=numpy.uint64)
+    self.mask = numpy.zeros((len(self.rows), len(self.probes)), dtype=bool)
+    for i, hashes in enumerate(self.rows):
+      (self.hashes[i], self.mask[i]) = self._pack(hashes)
+
+  def distances(self, hashes, start = 0, stop = None):
+    """ Average hamming distance between given hashes and every font in the
+    index (or only fonts start to stop), computed only on the probe symbols
+    both fonts define. Fonts that share too few probes to be compared get the
+    maximum distance.
+    """
+    if self.hashes is None:
+      self.build()
+
+    (row, mask) = self._pack(hashes)
+    shared = self.mask[start:stop] & mask
+
+    bits = popcount(self.hashes[start:stop] ^ row).astype(numpy.float32)
+    bits[~shared] = 0
+
+    nshared = shared.sum(axis=1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      distances = bits.sum(axis=1) / nshared
+
+    distances[nshared < max(1, min(MIN_SHARED_PROBES, mask.sum()))] = HASH_BITS
+    return distances
+
+  def query(self, hashes, max_results = None, max_distance = None):
+    """ Return a list of (distance, font_path) sorted by distance
+    """
+    if not self.font_paths:
+      return []
+
+    distances = self.distances(hashes)
+    order = numpy.argsort(distances, kind='stable')
+
+    results = []
+    for i in order:
+      if max_distance is not None and distances[i] > max_distance:
+        break
+      results.append((float(distances[i]), self.font_paths[i]))
+      if max_results is not None and len(results) >= max_results:
+        break
+
+    return results
@@ -0,0 +1,75 @@
+#
+# Streams of results (one row per scored font) written while a scan runs, so
+# they can be followed or loaded by other tools before it finishes.
+#
+import csv
+import json
+import time
+
+FORMATS = ['jsonl', 'csv']
+
+# rows are written in batches of FLUSH_ROWS, or every FLUSH_SECONDS if they
+# come slowly
+FLUSH_ROWS = 64
+FLUSH_SECONDS = 5
+
+class ResultSink:
+  """ Appends rows (dicts) to a JSONL or CSV file. CSV files have the given
+  columns, values that are not numbers or strings are stored as JSON.
+  """
+  def __init__(self, path, columns, format = 'jsonl'):
+    if format not in FORMATS:
+      raise ValueError(f"Unknown results format: {format}")
+
+    self.path = path
+    self.columns = columns
+    self.format = format
+    self.pending = []
+    self.last_flush = time.time()
+    self.file = open(path, 'wt', newline='')
+    self.writer = None
+    if format == 'csv':
+      self.writer = csv.DictWriter(self.file, fieldnames=columns, extrasaction='ignore')
+      self.writer.writeheader()
+
+  def write(self, row):
+    self.pending.append(row)
+    if len(self.pending) >= FLUSH_ROWS or (time.time() - self.last_flush) > FLUSH_SECONDS:
+      self.flush()
+
+  def flush(self):
+    for row in self.pending:
+      if self.writer:
+        self.writer.writerow({key: csvValue(value) for key, value in row.items()})
+      else:
+        self.file.write(json.dumps(row, separators=(',', ':')))
+        self.file.write("\n")
+    self.pending = []
+    self.file.flush()
+    self.last_flush = time.time()
+
+  def close(self):
+    self.flush()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def readRows(path, format = 'jsonl'):
+  """ Rows written by a ResultSink. Values of CSV files are read as strings
+  """
+  with open(path, 'rt', newline='') as f:
+    if format == 'csv':
+      yield from csv.DictReader(f)
+    else:
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+
+def csvValue(value):
+  if value is None or isinstance(value, (int, float, str)):
+    return value
+  return json.dumps(value, separators=(',', ':'))
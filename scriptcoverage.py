@@ -0,0 +1,99 @@
+#
+# Script coverage profiles: the fraction of the codepoints of every script in
+# util.SCRIPT_RANGES that a font defines. Profiles of a whole corpus are kept
+# in a single catalog file, so fonts can be filtered by charset with one
+# vectorized query instead of reading the symbols of every font.
+#
+
+from lazy import lazyImport
+import util
+import cache
+
+numpy = lazyImport('numpy')
+
+SCRIPTS = list(util.SCRIPT_RANGES)
+
+# number of codepoints of each script
+SCRIPT_SIZES = [sum(end - start + 1 for (start, end) in util.SCRIPT_RANGES[script]) for script in SCRIPTS]
+
+# fonts covering less than this fraction of a script are not considered to
+# support it (i.e. a few greek letters used as math symbols)
+MIN_SCRIPT_COVERAGE = 0.05
+
+def getFontCoverage(font_path):
+  """ numpy array with the coverage (0 to 1) of every script in SCRIPTS
+  """
+  counts = util.getScriptCounts(util.getSymbolIds(font_path))
+  return numpy.array([counts.get(script, 0)/size for script, size in zip(SCRIPTS, SCRIPT_SIZES)], dtype=numpy.float32)
+
+def getFontScripts(coverage):
+  """ Scripts a font supports, given its coverage
+  """
+  return [script for script, value in zip(SCRIPTS, coverage) if value >= MIN_SCRIPT_COVERAGE]
+
+class ScriptCoverageIndex:
+  """ Coverage profiles of many fonts packed in a (fonts, scripts) array.
+  load() reads the catalog of previous runs from the disk cache, and only
+  fonts that are new or changed since then get their symbols read.
+  """
+  def __init__(self):
+    self.font_paths = []
+    self.rows = []
+    self.coverage = None
+    self.catalog = {}
+    self.changed = False
+
+  def load(self, catalog_key):
+    diskCacheId = cache.g_diskCache.path('coverage', f"catalog-{catalog_key}", '.coverage')
+    catalog = cache.g_diskCache.loadPickle('coverage', diskCacheId)
+    if catalog is not None and catalog.get('scripts') == SCRIPTS:
+      self.catalog = catalog['fonts']
+
+  def save(self, catalog_key):
+    if not self.changed:
+      return
+    # fonts removed from the corpus are forgotten
+    self.catalog = {font_path: self.catalog[font_path] for font_path in self.font_paths}
+    diskCacheId = cache.g_diskCache.path('coverage', f"catalog-{catalog_key}", '.coverage')
+    cache.g_diskCache.savePickle('coverage', diskCacheId, {'scripts': SCRIPTS, 'fonts': self.catalog})
+    self.changed = False
+
+  def add(self, font_path):
+    stamp = util.getFileStamp(font_path)
+    (old_stamp, coverage) = self.catalog.get(font_path, (None, None))
+    if old_stamp != stamp:
+      coverage = getFontCoverage(font_path)
+      self.catalog[font_path] = (stamp, coverage)
+      self.changed = True
+
+    self.font_paths.append(font_path)
+    self.rows.append(coverage)
+    self.coverage = None
+
+  def build(self):
+    """ Pack all added fonts into a numpy array. Called automatically on query.
+    """
+    self.coverage = numpy.zeros((len(self.rows), len(SCRIPTS)), dtype=numpy.float32)
+    for i, coverage in enumerate(self.rows):
+      self.coverage[i] = coverage
+
+  def missingScripts(self, coverage, min_ratio = 0.5):
+    """ For every font of the index, number of scripts supported by a font
+    with given coverage that it covers less than min_ratio times as much
+    """
+    if self.coverage is None:
+      self.build()
+
+    required = coverage >= MIN_SCRIPT_COVERAGE
+    covered = self.coverage >= min_ratio*coverage
+    return (required & ~covered).sum(axis=1)
+
+  def query(self, coverage, min_ratio = 0.5, max_missing = 0):
+    """ Fonts (in the order they were added) missing at most max_missing of
+    the scripts of a font with given coverage, see missingScripts
+    """
+    if not self.font_paths:
+      return []
+
+    missing = self.missingScripts(coverage, min_ratio)
+    return [self.font_paths[i] for i in numpy.flatnonzero(missing <= max_missing)]
@@ -0,0 +1,89 @@
+import os
+import sys
+
+import pytest
+from fontTools.fontBuilder import FontBuilder
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+# scripts live on the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+import util
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+FONT_FOLDERS = ['/usr/share/fonts/truetype/dejavu', '/usr/share/fonts/dejavu', '/usr/share/fonts/TTF']
+
+def findFont(name):
+  for folder in FONT_FOLDERS:
+    path = os.path.join(folder, name)
+    if os.path.isfile(path):
+      return path
+  pytest.skip(f"{name} is not installed")
+
+def buildBarsFont(path, weight):
+  """ Font whose letters are a stem and a bar, both moving right and the stem
+  getting wider as weight grows, so its best offsets change with the weight
+  """
+  names = ['.notdef'] + [f"bar{ord(c)}" for c in LETTERS]
+  glyphs = {'.notdef': TTGlyphPen(None).glyph()}
+  for c in LETTERS:
+    (top, shift) = (413 + 60*(ord(c) % 7), (weight - 100)*0.6)
+    pen = TTGlyphPen(None)
+    for (x0, y0, x1, y1) in [(113 + shift, 0, 173 + 2*shift, top), (113 + shift, top - 67, 517, top)]:
+      pen.moveTo((x0, y0))
+      pen.lineTo((x0, y1))
+      pen.lineTo((x1, y1))
+      pen.lineTo((x1, y0))
+      pen.closePath()
+    glyphs[f"bar{ord(c)}"] = pen.glyph()
+
+  builder = FontBuilder(1000, isTTF=True)
+  builder.setupGlyphOrder(names)
+  builder.setupCharacterMap({ord(c): f"bar{ord(c)}" for c in LETTERS})
+  builder.setupGlyf(glyphs)
+  builder.setupHorizontalMetrics({name: (600, 100) for name in names})
+  builder.setupHorizontalHeader(ascent=800, descent=-200)
+  builder.setupNameTable({'familyName': 'Bars', 'styleName': f"W{weight}"})
+  builder.setupOS2(sTypoAscender=800, usWinAscent=800, usWinDescent=200)
+  builder.setupPost()
+  builder.save(path)
+
+@pytest.fixture(scope='session', autouse=True)
+def disk_cache(tmp_path_factory):
+  """ Disk cache of the test session, so the cache of the user is left alone
+  """
+  disk_cache = cache.DiskCache(root=str(tmp_path_factory.mktemp('cache')))
+  with pytest.MonkeyPatch.context() as monkeypatch:
+    monkeypatch.setattr(cache, 'g_diskCache', disk_cache)
+    yield disk_cache
+  disk_cache.flush()
+
+@pytest.fixture(autouse=True)
+def context(monkeypatch):
+  """ Every test gets a new default render context, with empty memory caches
+  """
+  context = util.RenderContext()
+  monkeypatch.setattr(util, 'g_context', context)
+  return context
+
+@pytest.fixture
+def sans():
+  return findFont('DejaVuSans.ttf')
+
+@pytest.fixture
+def sans_bold():
+  return findFont('DejaVuSans-Bold.ttf')
+
+@pytest.fixture(scope='session')
+def bars_masters(tmp_path_factory):
+  """ {weight: path} of tiny bars fonts (see buildBarsFont), cheap to hash and
+  render, that can be used as masters of a variable font
+  """
+  folder = tmp_path_factory.mktemp('bars')
+  masters = {}
+  for weight in [100, 400, 900]:
+    masters[weight] = str(folder / f"Bars-{weight}.ttf")
+    buildBarsFont(masters[weight], weight)
+  return masters
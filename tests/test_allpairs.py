@@ -0,0 +1,52 @@
+import json
+import shutil
+import sys
+
+import numpy
+
+import allpairs
+
+def test_blocks_cover_every_pair_once():
+  pairs = [(i, j) for (rows, columns) in allpairs.iterBlocks(7, 3) for i in rows for j in columns if j >= i]
+  assert sorted(pairs) == [(i, j) for i in range(7) for j in range(i, 7)]
+
+def test_clusters_are_single_linkage():
+  matrix = numpy.full((6, 6), 0.1, dtype=numpy.float32)
+  for (i, j) in [(0, 3), (3, 5), (1, 4)]:
+    matrix[i, j] = matrix[j, i] = 0.9
+  matrix[2, 2] = 1.0
+  matrix[1, 2] = matrix[2, 1] = numpy.nan
+
+  assert allpairs.clusterFonts(matrix, 0.5, block_size = 4) == [[0, 3, 5], [1, 4]]
+  assert allpairs.clusterFonts(matrix, 0.95) == []
+
+def test_matrix_is_resumed_unless_fonts_or_settings_change(tmp_path):
+  fonts = ['a.ttf', 'b.ttf']
+  matrix = allpairs.openMatrix(str(tmp_path), fonts, {'metric': 'mse'})
+  assert numpy.isnan(matrix).all()
+  matrix[0, 1] = 0.75
+  matrix.flush()
+  del matrix
+
+  assert allpairs.openMatrix(str(tmp_path), fonts, {'metric': 'mse'})[0, 1] == 0.75
+  assert numpy.isnan(allpairs.openMatrix(str(tmp_path), fonts, {'metric': 'iou'})).all()
+  assert allpairs.openMatrix(str(tmp_path), fonts + ['c.ttf'], {'metric': 'iou'}).shape == (3, 3)
+
+def test_copies_of_a_font_are_clustered(sans, sans_bold, tmp_path, monkeypatch):
+  corpus = tmp_path / 'corpus'
+  corpus.mkdir()
+  for (name, font) in [('Sans.ttf', sans), ('SansCopy.ttf', sans), ('Bold.ttf', sans_bold)]:
+    shutil.copy(font, corpus / name)
+
+  out_dir = tmp_path / 'out'
+  monkeypatch.setattr(sys, 'argv', ['allpairs.py', '-t', '0.9', '--block-size', '2', '-d', str(out_dir), str(corpus)])
+  allpairs.main()
+
+  clusters = json.loads((out_dir / 'clusters.json').read_text())['clusters']
+  assert [sorted(cluster) for cluster in clusters] == [[str(corpus / 'Sans.ttf'), str(corpus / 'SansCopy.ttf')]]
+
+  # nothing is scored again when resumed
+  scores = numpy.load(out_dir / 'scores.npy')
+  monkeypatch.setattr(allpairs.PairScorer, 'score', None)
+  allpairs.main()
+  assert numpy.array_equal(numpy.load(out_dir / 'scores.npy'), scores)
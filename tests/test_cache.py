@@ -0,0 +1,78 @@
+import os
+import sqlite3
+
+import pytest
+
+import cache
+
+@pytest.fixture
+def tmp_cache(tmp_path):
+  """ Cache of its own, with a folder left by another cache version
+  """
+  disk_cache = cache.DiskCache(root=str(tmp_path), version=2)
+  other = cache.DiskCache(root=str(tmp_path), version=1)
+  other.savePickle('probes', other.path('probes', 'old', '.pickle'), 'old')
+  other.flush()
+  return disk_cache
+
+def savePickles(disk_cache, keys):
+  paths = [disk_cache.path('probes', key, '.pickle') for key in keys]
+  for (key, path) in zip(keys, paths):
+    disk_cache.savePickle('probes', path, key*100)
+  return paths
+
+def test_quota_only_evicts_current_version(tmp_cache, tmp_path):
+  (old, recent) = savePickles(tmp_cache, ['old', 'recent'])
+  tmp_cache.flush()
+  assert tmp_cache.loadPickle('probes', recent) == 'recent'*100
+  tmp_cache.flush()
+
+  old_size = os.path.getsize(old)
+  (removed, removed_bytes) = tmp_cache.prune(os.path.getsize(recent))
+  assert (removed, removed_bytes) == (1, old_size)
+  assert not os.path.exists(old)
+  assert os.path.exists(recent)
+  assert os.path.isdir(tmp_path / 'v1')
+
+def test_prune_removes_stale_versions_when_asked(tmp_cache, tmp_path):
+  savePickles(tmp_cache, ['a'])
+  tmp_cache.flush()
+
+  tmp_cache.prune()
+  assert os.path.isdir(tmp_path / 'v1')
+
+  (removed, _removed_bytes) = tmp_cache.prune(remove_stale = True)
+  assert removed == 1
+  assert not os.path.exists(tmp_path / 'v1')
+  assert tmp_cache.stats()['probes']['entries'] == 1
+
+def test_stats_are_kept_per_version(tmp_cache):
+  (path,) = savePickles(tmp_cache, ['a'])
+  tmp_cache.loadPickle('probes', path)
+  tmp_cache.loadPickle('probes', path + 'missing')
+
+  stats = tmp_cache.stats()['probes']
+  assert (stats['entries'], stats['hits'], stats['misses']) == (1, 1, 1)
+  assert cache.DiskCache(root=tmp_cache.root, version=1).stats()['probes']['hits'] == 0
+
+def test_verify_removes_broken_files(tmp_cache):
+  (good, broken) = savePickles(tmp_cache, ['good', 'broken'])
+  with open(broken, 'wb') as f:
+    f.write(b'not a pickle')
+  with open(good + '.123-456.tmp', 'wb') as f:
+    f.write(b'half written')
+
+  assert tmp_cache.verify(cache.checkCacheFile) == (3, 2)
+  assert os.listdir(os.path.dirname(good)) == [os.path.basename(good)]
+  assert tmp_cache.stats()['probes']['entries'] == 1
+
+def test_old_stats_table_is_dropped_once(tmp_path):
+  with sqlite3.connect(tmp_path / 'cache.db') as db:
+    db.execute("CREATE TABLE stats (type TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)")
+
+  tmp_cache = cache.DiskCache(root=str(tmp_path))
+  with tmp_cache._connect() as db:
+    tables = set(name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    (schema_version,) = db.execute("PRAGMA user_version").fetchone()
+  assert tables == {'entries', 'version_stats'}
+  assert schema_version == cache.SCHEMA_VERSION
@@ -0,0 +1,75 @@
+import argparse
+import json
+import shutil
+import sys
+
+import pytest
+
+import fontdiff
+import merge
+
+def test_parse_shard():
+  assert fontdiff.parseShard('2/3') == (2, 3)
+  for value in ['0/3', '4/3', '1/0', 'a/b', '3']:
+    with pytest.raises(argparse.ArgumentTypeError):
+      fontdiff.parseShard(value)
+
+def test_shards_partition_fonts_by_content(bars_masters, tmp_path):
+  fonts = list(bars_masters.values())
+  for nshards in [1, 2, 3]:
+    shards = [fontdiff.getFontShard(font, nshards) for font in fonts]
+    assert all(1 <= shard <= nshards for shard in shards)
+
+  # copies of a font are scanned by the same shard wherever they are
+  copy = str(tmp_path / 'Copy.ttf')
+  shutil.copy(fonts[0], copy)
+  assert fontdiff.getFontShard(copy, 7) == fontdiff.getFontShard(fonts[0], 7)
+
+@pytest.fixture
+def corpus(bars_masters, tmp_path):
+  """ (reference font, corpus folder) holding the bars masters and a copy of
+  the reference
+  """
+  folder = tmp_path / 'corpus'
+  folder.mkdir()
+  for (weight, path) in bars_masters.items():
+    shutil.copy(path, folder / f"Bars-{weight}.ttf")
+  shutil.copy(bars_masters[400], folder / 'Copy.ttf')
+  return (bars_masters[400], str(folder))
+
+def runFontDiff(monkeypatch, *argv):
+  monkeypatch.setattr(sys, 'argv', ['fontdiff.py', *argv])
+  fontdiff.main()
+
+def readRanking(out_dir):
+  with open(f"{out_dir}/analysis-top.json", 'rt') as f:
+    (summary, *ranking) = json.load(f)
+  return (summary, [(x['font'], round(x['score'], 6)) for x in ranking])
+
+def test_merged_shards_match_single_run(corpus, tmp_path, monkeypatch):
+  (font1, folder) = corpus
+  runFontDiff(monkeypatch, '-b', '-d', str(tmp_path / 'single'), font1, folder)
+  for shard in ['1/2', '2/2']:
+    runFontDiff(monkeypatch, '-b', '--shard', shard, '-d', str(tmp_path / 'sharded'), font1, folder)
+
+  merge.mergeQuery(str(tmp_path / 'sharded'))
+  (summary, ranking) = readRanking(tmp_path / 'single')
+  assert readRanking(tmp_path / 'sharded') == (summary, ranking)
+  assert ranking[0][1] == 1.0
+  assert summary['ncandidates'] == 4
+
+def test_merge_needs_every_shard(corpus, tmp_path, monkeypatch):
+  (font1, folder) = corpus
+  runFontDiff(monkeypatch, '--shard', '1/3', '-d', str(tmp_path), font1, folder)
+
+  with pytest.raises(ValueError, match='missing shards 2, 3'):
+    merge.mergeQuery(str(tmp_path))
+  assert merge.mergeQuery(str(tmp_path), partial = True) is not None
+
+def test_shards_of_different_runs_are_not_merged(corpus, tmp_path, monkeypatch):
+  (font1, folder) = corpus
+  runFontDiff(monkeypatch, '--shard', '1/2', '-d', str(tmp_path), font1, folder)
+  runFontDiff(monkeypatch, '--shard', '2/3', '-d', str(tmp_path), font1, folder)
+
+  with pytest.raises(ValueError, match='different runs'):
+    merge.loadShards(str(tmp_path))
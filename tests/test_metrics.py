@@ -0,0 +1,49 @@
+import json
+
+import numpy
+import pytest
+
+import fontdiff
+import metrics
+import util
+
+def cells(*rows):
+  """ Stack of glyph cells from strings, '#' being ink
+  """
+  return numpy.array([[[0 if c == '#' else 255 for c in row] for row in cell] for cell in rows], dtype=numpy.uint8)
+
+SQUARE = ['....', '.##.', '.##.', '....']
+SHIFTED = ['....', '....', '.##.', '.##.']
+FAR = ['##..', '##..', '....', '....']
+BLANK = ['....'] * 4
+
+@pytest.mark.parametrize('name', sorted(metrics.METRICS))
+def test_identical_glyphs_get_the_perfect_value(name):
+  metric = metrics.getMetric(name)
+  values = metric.glyph_values(cells(SQUARE, BLANK), cells(SQUARE, BLANK))
+  assert numpy.allclose(values, metric.perfect_value)
+
+@pytest.mark.parametrize('name', sorted(metrics.METRICS))
+def test_closer_glyphs_score_higher(name):
+  metric = metrics.getMetric(name)
+  scores = metric.glyphScores(cells(SQUARE, SQUARE, SQUARE), cells(SQUARE, SHIFTED, FAR))
+  assert scores[0] > scores[1] > scores[2]
+
+def test_unknown_metric():
+  with pytest.raises(ValueError, match='mse'):
+    metrics.getMetric('nope')
+
+@pytest.mark.parametrize('name', sorted(metrics.METRICS))
+def test_glyph_scores_of_other_font_are_lower(name, sans, sans_bold):
+  metric = metrics.getMetric(name)
+  perfect_score = metric.score(metric.perfect_value)
+  assert numpy.allclose(util.getGlyphScores('abc', sans, sans, metric = name), perfect_score)
+  assert (util.getGlyphScores('abc', sans, sans_bold, metric = name) < perfect_score).all()
+
+def test_save_glyph_scores(sans, sans_bold, tmp_path):
+  out_file = tmp_path / 'glyphs.json'
+  fontdiff.saveGlyphScores(sans, sans_bold, str(out_file), alphabet = 'abcl')
+
+  glyphs = json.loads(out_file.read_text())
+  assert sorted(x['symbol'] for x in glyphs) == ['a', 'b', 'c', 'l']
+  assert [x['score'] for x in glyphs] == sorted(x['score'] for x in glyphs)
@@ -0,0 +1,130 @@
+import math
+import shutil
+
+import numpy
+import pytest
+from fontTools import ttLib, varLib
+from fontTools.designspaceLib import DesignSpaceDocument
+from fontTools.pens.transformPen import TransformPen
+from fontTools.pens.ttGlyphPen import TTGlyphPen
+from fontTools.varLib import instancer
+
+import metrics
+import phash
+import util
+
+SYMBOLS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789ÀÁÂÄÇÉÈÑÖÜàáâäçéèñöü'
+
+@pytest.fixture
+def sans_bigger_a(sans, tmp_path):
+  """ Copy of sans with the outline of 'A' scaled, which also changes the
+  composite glyphs built on it (À, Á, Â...)
+  """
+  font = ttLib.TTFont(sans)
+  glyph_set = font.getGlyphSet()
+  pen = TTGlyphPen(glyph_set)
+  glyph_set['A'].draw(TransformPen(pen, (1.2, 0, 0, 1.2, 0, 0)))
+  font['glyf']['A'] = pen.glyph()
+
+  path = str(tmp_path / 'DejaVuSans-BiggerA.ttf')
+  font.save(path)
+  return path
+
+def test_composite_glyphs_hash_with_their_components(sans, sans_bigger_a):
+  hashes1 = util.getGlyphHashes(sans)
+  hashes2 = util.getGlyphHashes(sans_bigger_a)
+  assert hashes1[ord('B')] == hashes2[ord('B')]
+  for symbol in 'AÀÁÂ':
+    assert hashes1[ord(symbol)] != hashes2[ord(symbol)]
+
+  (different, nidentical) = util.splitIdenticalGlyphs('AÀÁBC', sans, sans_bigger_a)
+  assert (different, nidentical) == ('AÀÁ', 2)
+
+def test_composite_glyphs_do_not_share_cached_renders(sans, sans_bigger_a):
+  util.drawSymbolMatrix('ÀÁÂ', None, sans)
+  cached = util.drawSymbolMatrix('ÀÁÂ', None, sans_bigger_a)
+  drawn = util.drawFullSymbolMatrix('ÀÁÂ', None, sans_bigger_a)
+  assert numpy.array_equal(numpy.asarray(cached), numpy.asarray(drawn))
+
+@pytest.mark.parametrize('xoffset, yoffset', [(1, 0), (0, 5), (-3, 2), (4, -4), (-7, -6)])
+def test_shifted_matrix_matches_real_render(context, sans, xoffset, yoffset):
+  size = math.ceil(len(SYMBOLS)**0.5)
+  drawn = numpy.asarray(util.drawFullSymbolMatrix(SYMBOLS, size, sans, xoffset = xoffset, yoffset = yoffset))
+
+  # matrices drawn at 0,0 are moved instead of drawn again
+  util.drawSymbolMatrix(SYMBOLS, size, sans)
+  shifted = numpy.asarray(util.drawSymbolMatrix(SYMBOLS, size, sans, xoffset = xoffset, yoffset = yoffset))
+  (pixels, _info) = context.getMatrixPixels(SYMBOLS, size, sans, xoffset = xoffset, yoffset = yoffset)
+
+  assert numpy.array_equal(shifted, drawn)
+  assert numpy.array_equal(pixels, drawn)
+
+@pytest.mark.parametrize('metric', sorted(metrics.METRICS))
+@pytest.mark.parametrize('xoffset, yoffset, scale', [(0, 0, 1.0), (1, -2, 1.0), (0.5, 1.25, 1.03)])
+def test_progressive_score_converges_to_exact_score(sans, sans_bold, metric, xoffset, yoffset, scale):
+  symbols = list(SYMBOLS)
+  (exact, _diff) = util.getFontDiffScore(symbols, math.ceil(len(symbols)**0.5), sans, sans_bold, xoffset, yoffset, scale, metric = metric, with_diff = False)
+  (estimate, nexamined, aborted) = util.progressiveFontDiffScore(symbols, sans, sans_bold, xoffset, yoffset, scale, batch_size = 16, metric = metric, skip_identical = False)
+
+  assert not aborted
+  assert nexamined == len(symbols)
+  assert estimate == pytest.approx(exact, rel = 1e-6)
+
+def test_progressive_score_skipping_identical_glyphs(sans, sans_bigger_a):
+  symbols = list(SYMBOLS)
+  (exact, _diff) = util.getFontDiffScore(symbols, math.ceil(len(symbols)**0.5), sans, sans_bigger_a, 0, 0, skip_identical = True, with_diff = False)
+  (estimate, nexamined, aborted) = util.progressiveFontDiffScore(symbols, sans, sans_bigger_a, 0, 0, batch_size = 4)
+
+  assert not aborted
+  assert nexamined == len(symbols)
+  assert estimate == pytest.approx(exact, rel = 1e-6)
+
+def test_tiled_symbol_matrix_pages(sans, tmp_path):
+  single = util.saveTiledSymbolMatrix(SYMBOLS, sans, str(tmp_path / 'single'))
+  assert single == [str(tmp_path / 'single.png')]
+
+  paged = util.saveTiledSymbolMatrix(SYMBOLS, sans, str(tmp_path / 'paged'), tile_size = 8)
+  assert paged == [str(tmp_path / f"paged-p{i:03d}.png") for i in range(2)]
+
+@pytest.fixture
+def bars_fonts(bars_masters, tmp_path):
+  """ Variable bars font (wght 100-900, 400 by default) and its static
+  wght=600 instance
+  """
+  designspace = DesignSpaceDocument()
+  designspace.addAxisDescriptor(tag='wght', name='Weight', minimum=100, default=400, maximum=900)
+  for (weight, path) in bars_masters.items():
+    designspace.addSourceDescriptor(path=path, location={'Weight': weight})
+
+  (font, _, _) = varLib.build(designspace)
+  variable_path = str(tmp_path / 'Bars-VF.ttf')
+  font.save(variable_path)
+  static_path = str(tmp_path / 'Bars-600.ttf')
+  instancer.instantiateVariableFont(font, {'wght': 600}).save(static_path)
+  return (variable_path, static_path)
+
+def test_variable_axes_are_searched_with_offsets(bars_fonts):
+  (variable_font, static_font) = bars_fonts
+
+  # the default instance lines up best at other offsets than the static one
+  (x, y, default_score) = util.fastSearchBestAlignment(static_font, variable_font, step = 3)
+  assert (x, y) != (0, 0)
+
+  (location, x, y, score) = util.searchVariableAxes(static_font, variable_font, x, y)
+  assert abs(location['wght'] - 600) <= 16
+  assert (x, y) == (0, 0)
+  assert score > 0.99 > default_score
+
+def test_variable_axes_of_static_font(sans, sans_bold):
+  assert util.searchVariableAxes(sans, sans_bold, 1, 2) == ({}, 1, 2, None)
+
+def test_fonts_edited_in_place_are_read_again(sans, sans_bold, tmp_path, monkeypatch):
+  path = str(tmp_path / 'Font.ttf')
+  shutil.copy(sans, path)
+  hashes = phash.getFontHashes(path)
+  subset = util.subsetFont(path, [ord('A')])
+
+  shutil.copy(sans_bold, path)
+  monkeypatch.setattr(util, 'g_context', util.RenderContext())
+  assert phash.getFontHashes(path) != hashes
+  assert util.subsetFont(path, [ord('A')]) != subset
@@ -4,22 +4,72 @@ import math
 import os
 import time
 import hashlib
-import _pickle as pickle
-from PIL import Image, ImageDraw, ImageFont, ImageChops
-from fontTools import ttLib
-from fontTools import subset as FontSubset
-from fontTools.merge import Merger as FontMerger
-import util
-import numpy
-import tempfile
-
-CACHE_DIR = './.cache'
+import random
+import threading
+import bisect
+import weakref
+import unicodedata
+import collections
+from lazy import lazyImport
+import metrics
+import cache
+
+# heavy dependencies are imported on first use, see lazy.py
+Image = lazyImport('PIL.Image')
+ImageDraw = lazyImport('PIL.ImageDraw')
+ImageFont = lazyImport('PIL.ImageFont')
+PngImagePlugin = lazyImport('PIL.PngImagePlugin')
+ttLib = lazyImport('fontTools.ttLib')
+FontSubset = lazyImport('fontTools.subset')
+FontMerge = lazyImport('fontTools.merge')
+instancer = lazyImport('fontTools.varLib.instancer')
+recordingPen = lazyImport('fontTools.pens.recordingPen')
+numpy = lazyImport('numpy')
+tempfile = lazyImport('tempfile')
+
 CACHE_FORMAT = '.png'
-g_font_size = 32
-g_padding = 4
-g_symbolIdsCache = {}
-g_imageCache = {}
-g_imageCacheLastPurge = time.time()
+
+# everything is rendered black on white, so a single channel is enough. This
+# keeps images in memory and on the disk cache 3 times smaller than RGB, and
+# diffs can be computed without converting back to grayscale
+RENDER_MODE = "L"
+DEFAULT_FONT_SIZE = 32
+DEFAULT_PADDING = 4
+
+# bigger symbol matrices are split into tiles of MAX_MATRIX_SIZE x MAX_MATRIX_SIZE
+MAX_MATRIX_SIZE = 32
+
+# max number of FreeType font handles kept open by the font pool
+FONT_POOL_SIZE = 64
+
+# axes of variable fonts searched when matching fonts, see searchVariableAxes
+VARIABLE_AXES = ['wght', 'wdth']
+
+# offsets of every instance tried by searchVariableAxes are searched this far
+# (in pixels) from the best ones so far, with this step
+AXES_ALIGNMENT_SPACE = 6
+AXES_ALIGNMENT_STEP = 3
+
+# max number of passes of searchVariableAxes over all axes
+AXES_SEARCH_ROUNDS = 3
+
+# number of probe symbols used by the fast alignment search (a 3x3 grid), see
+# getProbeSymbols
+PROBE_COUNT = 9
+
+# max number of symbols of a script rendered to rank probes (the first ones of
+# the script), so fonts with thousands of glyphs (i.e CJK) stay cheap
+PROBE_POOL_SIZE = 128
+
+# probes whose 8x8 thumbnails differ less than this (mean ink difference) from
+# a better ranked probe look alike, so they are ranked last
+PROBE_MIN_DISTANCE = 0.08
+
+# used when fonts share no symbols we know how to rank
+DEFAULT_PROBES = 'abjsAWM15'
+
+# fonts tried, in order, to draw titles on images
+TITLE_FONTS = ["Arial.ttf", "Arial", "DejaVuSans.ttf"]
 
 #  for glyph_codepoint, glyph_name in cmap.items():
 #    print(f"Glyph: {glyph_id}, {gid} Unicode Codepoint: {name}")
@@ -50,30 +100,108 @@ g_imageCacheLastPurge = time.time()
 
 
 def init():
-  """ Make sure some cache folders exist, ...
+  """ Make sure the cache folder exists. Folders for each cache type (and their
+  shards) are created on demand, when the first file is saved there.
   """
-  os.makedirs(f'{CACHE_DIR}/symbols', exist_ok=True)
-  for i in range(0, 256):
-    os.makedirs(f'{CACHE_DIR}/{i:02x}', exist_ok=True)
-
-
-def drawText(text, font_path, out_file = None):
-  font = ImageFont.truetype(font_path, g_font_size)
+  os.makedirs(cache.g_diskCache.base_dir, exist_ok=True)
+
+class FontPool:
+  """ Bounded LRU pools of ImageFont handles keyed by (path, index, size), so
+  fonts are parsed by FreeType once instead of on every image drawn. FreeType
+  faces are not thread safe, so every thread gets its own pool of at most
+  max_size handles, shared by all the contexts it draws with. Keys hold the
+  stamp of the file too, since FreeType reads glyphs from the file as they
+  are drawn and crashes on handles of fonts edited in place.
+  """
+  def __init__(self, max_size = FONT_POOL_SIZE):
+    self.max_size = max_size
+    self.local = threading.local()
+    self.lock = threading.Lock()
+    # pools of threads that are gone are freed with them
+    self.pools = weakref.WeakValueDictionary()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
 
-  (_left, _top, text_width, text_height) = font.getbbox(text)
+  def getThreadFonts(self):
+    """ OrderedDict of the handles of the calling thread
+    """
+    fonts = getattr(self.local, 'fonts', None)
+    if fonts is None:
+      fonts = self.local.fonts = collections.OrderedDict()
+      with self.lock:
+        self.pools[threading.get_ident()] = fonts
+    return fonts
+
+  def lookup(self, key):
+    fonts = self.getThreadFonts()
+    font = fonts.get(key, None)
+    with self.lock:
+      if font is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+    if font is not None:
+      fonts.move_to_end(key)
+    return font
+
+  def store(self, key, font):
+    fonts = self.getThreadFonts()
+    fonts[key] = font
+    nevicted = 0
+    while len(fonts) > self.max_size:
+      fonts.popitem(last = False)
+      nevicted += 1
+    if nevicted:
+      with self.lock:
+        self.evictions += nevicted
+
+  def get(self, font_path, size, index = 0):
+    key = (getFileKey(font_path), index, size)
+    font = self.lookup(key)
+    if font is None:
+      font = ImageFont.truetype(font_path, size, index = index)
+      self.store(key, font)
+    return font
+
+  def stats(self):
+    with self.lock:
+      return {
+        'open' : sum(len(fonts) for fonts in self.pools.values()),
+        'threads' : len(self.pools),
+        'hits' : self.hits,
+        'misses' : self.misses,
+        'evictions' : self.evictions
+      }
+
+g_fontPool = FontPool()
+
+def getFont(font_path, size, index = 0):
+  """ Returns a (cached) ImageFont for given font file and size
+  """
+  return g_fontPool.get(font_path, size, index)
 
-  image_width = 2*g_padding + text_width
-  image_height = 2*g_padding + text_height
+def getTitleFont(size = 16):
+  """ Font used to draw titles. Falls back to Pillow's default font when none
+  of TITLE_FONTS is installed. Resolved once per size (and thread).
+  """
+  key = ('<title>', 0, size)
+  font = g_fontPool.lookup(key)
+  if font is not None:
+    return font
 
-  image = Image.new("RGB", (image_width, image_height), "white")
-  draw = ImageDraw.Draw(image)
+  for font_path in TITLE_FONTS:
+    try:
+      font = ImageFont.truetype(font_path, size)
+      break
+    except OSError:
+      pass
 
-  draw.text((g_padding, g_padding), text, font=font, fill="black")
+  if font is None:
+    font = ImageFont.load_default(size)
 
-  if out_file:
-    image.save(out_file)
-
-  return image
+  g_fontPool.store(key, font)
+  return font
 
 class CachedImage:
   def __init__(self, image):
@@ -94,106 +222,1351 @@ class CachedImage:
       return True
     return False
 
-def drawFullSymbolMatrix(symbols, size, font_path, title = None, xoffset = 0, yoffset = 0):
-  """ yoffset helps skew font drawing
+class RenderContext:
+  """ Rendering settings (font size, padding) and caches used to draw and
+  compare symbol matrices. Each context has its own caches and lock, so
+  comparisons at different sizes can run concurrently on multiple threads.
+
+  Module level functions (drawSymbolMatrix, getFontDiffScore, ...) use a
+  default context, g_context.
   """
-  if not size:
-    size = math.ceil(len(symbols)**0.5)
+  def __init__(self, font_size = DEFAULT_FONT_SIZE, padding = DEFAULT_PADDING):
+    self.font_size = font_size
+    self.padding = padding
+    self.image_cache = {}
+    self.image_cache_last_purge = time.time()
+    self.symbol_info_cache = {}
+    self.probes_cache = {}
+    self.ink_range_cache = {}
+    self.lock = threading.RLock()
+    # scratch buffers of each thread, see getScratch
+    self.scratch = threading.local()
 
-  title_padding = 64 if title else 0
+  def drawText(self, text, font_path, out_file = None):
+    font = getFont(font_path, self.font_size)
 
-  image_width = 2*g_padding + g_font_size*size
-  image_height = title_padding + g_padding + (g_padding + g_font_size)*size
+    (_left, _top, text_width, text_height) = font.getbbox(text)
 
-  # (_left, _top, text_width, text_height) = font.getbbox(line)
+    image_width = 2*self.padding + text_width
+    image_height = 2*self.padding + text_height
 
-  font = ImageFont.truetype(font_path, g_font_size)
-  image = Image.new("RGB", (image_width, image_height), "white")
-  draw = ImageDraw.Draw(image)
+    image = Image.new(RENDER_MODE, (image_width, image_height), "white")
+    draw = ImageDraw.Draw(image)
 
-  if title:
-    title_font = ImageFont.truetype("Arial.ttf", 16)
-    draw.text((8, 8), title, font=title_font, fill="black")
+    draw.text((self.padding, self.padding), text, font=font, fill="black")
 
-  for i, symbol in enumerate(symbols):
-    x = xoffset + g_padding + (i%size)*g_font_size
-    y = yoffset + title_padding + g_padding + ((i-i%size)/size)*g_font_size
+    if out_file:
+      image.save(out_file)
 
-    draw.text((x,y), symbol, font=font, fill="black")
+    return image
 
-  return image
+  def drawFullSymbolMatrix(self, symbols, size, font_path, title = None, xoffset = 0, yoffset = 0):
+    """ yoffset helps skew font drawing
+    """
+    if not size:
+      size = math.ceil(len(symbols)**0.5)
 
+    title_padding = 64 if title else 0
 
-def drawSymbolMatrix(symbols, size, font_path, title = None, xoffset = 0, yoffset = 0):
-  """ yoffset helps skew font drawing
-  """
-  global g_imageCache, g_imageCacheLastPurge
-  if not size:
-    size = math.ceil(len(symbols)**0.5)
+    image_width = 2*self.padding + self.font_size*size
+    image_height = title_padding + self.padding + (self.padding + self.font_size)*size
+
+    # (_left, _top, text_width, text_height) = font.getbbox(line)
+
+    font = getFont(font_path, self.font_size)
+    image = Image.new(RENDER_MODE, (image_width, image_height), "white")
+    draw = ImageDraw.Draw(image)
+
+    if title:
+      title_font = getTitleFont(16)
+      draw.text((8, 8), title, font=title_font, fill="black")
 
-  if size > 32:
-    #print (f"WARN: Huge size! Trimming down from size={size}, nsymbols={len(symbols)} to size=32, nsymbols=1024")
-    symbols = symbols[:1024]
-    size    = 32
+    for i, symbol in enumerate(symbols):
+      x = xoffset + self.padding + (i%size)*self.font_size
+      y = yoffset + title_padding + self.padding + ((i-i%size)/size)*self.font_size
 
-  title_padding = 64 if title else 0
+      draw.text((x,y), symbol, font=font, fill="black")
 
-  image_width = 2*g_padding + g_font_size*size
-  image_height = title_padding + g_padding + (g_padding + g_font_size)*size
+    return image
+
+  def getSymbolMatrixSize(self, size, title = None):
+    """ Returns (width, height) in pixels of a symbol matrix of size x size
+    """
+    title_padding = 64 if title else 0
 
-  # (_left, _top, text_width, text_height) = font.getbbox(line)
+    image_width = 2*self.padding + self.font_size*size
+    image_height = title_padding + self.padding + (self.padding + self.font_size)*size
+    return (image_width, image_height)
 
-  # Since this method is called with same params and different offsets
-  # we can make it go faster by not rendering text again, so faster than drawing
-  # symbol matrix is to check if we just drawn the same thing with offset=0,0
-  # and then just recover the image and create another image drawing with
-  # desired offset so we only cache stuff with offset 0, 0
-  if xoffset != 0 and yoffset != 0:
-    cachedImage = drawSymbolMatrix(symbols, size, font_path, title, xoffset = 0, yoffset = 0)
-    image = Image.new("RGB", (image_width, image_height), "white")
-    image.paste(cachedImage, (xoffset, yoffset))
+  def drawSymbolMatrix(self, symbols, size, font_path, title = None, xoffset = 0, yoffset = 0, scale = 1.0, memory_cache = True):
+    """ yoffset helps skew font drawing. Offsets can be fractional, and scale
+    renders the font bigger/smaller than font_size while keeping the same
+    grid, which helps matching fonts with slightly different em sizes.
 
-    # hack: paste title to stay on the same position as when drawn on 0,0
-    title_image = cachedImage.crop((0, 0, image_width, 32))
-    image.paste(title_image, (0,0))
+    Matrices bigger than MAX_MATRIX_SIZE are trimmed, use iterSymbolTiles or
+    saveTiledSymbolMatrix to draw all symbols.
+    """
+    if not size:
+      size = math.ceil(len(symbols)**0.5)
+
+    if size > MAX_MATRIX_SIZE:
+      #print (f"WARN: Huge size! Trimming down from size={size}, nsymbols={len(symbols)} to size=32, nsymbols=1024")
+      symbols = symbols[:MAX_MATRIX_SIZE*MAX_MATRIX_SIZE]
+      size    = MAX_MATRIX_SIZE
+
+    title_padding = 64 if title else 0
+
+    (image_width, image_height) = self.getSymbolMatrixSize(size, title)
+
+    # (_left, _top, text_width, text_height) = font.getbbox(line)
+
+    # Since this method is called with same params and different offsets
+    # we can make it go faster by not rendering text again, so faster than drawing
+    # symbol matrix is to check if we just drawn the same thing with offset=0,0
+    # and then just recover the image and create another image drawing with
+    # desired offset so we only cache stuff with offset 0, 0
+    # (fractional offsets cannot be pasted, so those are always drawn, and
+    # titles stay in place while glyphs move, so titled images are too)
+    is_integer_offset = float(xoffset).is_integer() and float(yoffset).is_integer()
+    if is_integer_offset:
+      xoffset = int(xoffset)
+      yoffset = int(yoffset)
+    if (xoffset != 0 or yoffset != 0) and is_integer_offset and not title:
+      cachedImage = self.drawSymbolMatrix(symbols, size, font_path, xoffset = 0, yoffset = 0, scale = scale, memory_cache = memory_cache)
+      if self.isShiftable(cachedImage):
+        pixels = shiftPixels(getPixels(cachedImage), xoffset, yoffset, numpy.empty((image_height, image_width), dtype=numpy.uint8))
+        return pixelsImage(pixels, self.getShiftedInfo(cachedImage, xoffset, yoffset))
+
+    h = hashlib.blake2s()
+    h.update(f"{symbols}-{size}-{self.getRenderKey(symbols, font_path)}-{title}-{xoffset}-{yoffset}-{scale}-{RENDER_MODE}-{self.font_size}-{self.padding}".encode())
+    cacheId = h.hexdigest()
+    with self.lock:
+      cached = self.image_cache.get(cacheId, None)
+      if cached:
+        cached.hit()
+        return cached.image
+
+    # titles are only drawn for images saved as results, and those usually
+    # differ on every run (offsets, scores...) so they are not stored on disk
+    use_disk_cache = is_integer_offset and not title
+    diskCacheId = cache.g_diskCache.path('images', cacheId, CACHE_FORMAT)
+    if use_disk_cache and cache.g_diskCache.exists('images', diskCacheId):
+      # bboxes recorded when drawn are kept as PNG text chunks
+      with Image.open(diskCacheId) as image:
+        image = pixelsImage(numpy.asarray(image), image.info)
+      if memory_cache:
+        with self.lock:
+          self.image_cache[cacheId] = CachedImage(image)
+      return image
+
+    font = getFont(font_path, self.font_size*scale)
+    image = Image.new(RENDER_MODE, (image_width, image_height), "white")
+    draw = ImageDraw.Draw(image)
+
+    if title:
+      title_font = getTitleFont(16)
+      draw.text((8, 8), title, font=title_font, fill="black")
+
+    for i, symbol in enumerate(symbols):
+      x = xoffset + self.padding + (i%size)*self.font_size
+      y = yoffset + title_padding + self.padding + ((i-i%size)/size)*self.font_size
+
+      draw.text((x,y), symbol, font=font, fill="black")
+
+    # keep the pixels as a numpy array shared with the image, so scores read
+    # them without copies. The ink bbox of the matrix, and the union of the
+    # ink of every cell, let scores skip pixels that are white on both
+    # matrices (see getInkDiff and getGlyphCellPairs)
+    pixels = numpy.asarray(image)
+    image = pixelsImage(pixels, {'cell_bbox': self.getCellInkBBox(pixels, size, title)})
+    if title is None:
+      image.info['ink_bbox'] = getPixelsInkBBox(pixels)
+
+    with self.lock:
+      if memory_cache:
+        self.image_cache[cacheId] = CachedImage(image)
+
+      # purge every X seconds, to free memory. Done in place, since other
+      # threads might be using the same dict
+      if (len(self.image_cache) > 100 and (time.time() - self.image_cache_last_purge) > 30):
+        for k in [k for k, v in self.image_cache.items() if v.isExpired()]:
+          del self.image_cache[k]
+        self.image_cache_last_purge = time.time()
+
+    # subpixel renders are only useful while refining the alignment of a pair
+    # of fonts, so don't fill the disk with them
+    if use_disk_cache:
+      pnginfo = PngImagePlugin.PngInfo()
+      for key in ['ink_bbox', 'cell_bbox']:
+        if key in image.info:
+          pnginfo.add_text(key, formatBBox(image.info[key]))
+      cache.g_diskCache.save('images', diskCacheId, lambda f: image.save(f, format=CACHE_FORMAT[1:], pnginfo=pnginfo))
     return image
 
-  h = hashlib.blake2s()
-  h.update(f"{symbols}-{size}-{font_path}-{title}-{xoffset}-{yoffset}".encode())
-  cacheId = h.hexdigest()
-  cached = g_imageCache.get(cacheId, None)
-  if cached:
-    cached.hit()
-    return cached.image
+  def getFontInkRange(self, font_path, scale = 1.0):
+    """ (top, bottom) in pixels, relative to where a symbol is drawn, that
+    the ink of any glyph of font_path can reach, from the font bbox of the
+    head table (plus a margin for hinting and antialiasing)
+    """
+    key = (font_path, scale)
+    with self.lock:
+      if key in self.ink_range_cache:
+        return self.ink_range_cache[key]
+
+    (ascent, _descent) = getFont(font_path, self.font_size*scale).getmetrics()
+    head = ttLib.TTFont(font_path, lazy=True, fontNumber=0)['head']
+    pixels_per_unit = self.font_size*scale/head.unitsPerEm
+    ink_range = (math.floor(ascent - head.yMax*pixels_per_unit) - 2, math.ceil(ascent - head.yMin*pixels_per_unit) + 2)
+
+    with self.lock:
+      self.ink_range_cache[key] = ink_range
+    return ink_range
+
+  def drawSymbolRows(self, symbols, size, font_path, top, bottom, xoffset = 0, yoffset = 0, scale = 1.0):
+    """ Pixel rows top to bottom of the symbol matrix (without title) that
+    drawSymbolMatrix would draw, as a numpy array. Only glyphs whose ink can
+    reach those rows (see getFontInkRange) are drawn, so rows get exactly the
+    same pixels, ink bleeding from the glyphs around included.
+    """
+    (image_width, _image_height) = self.getSymbolMatrixSize(size)
+    (ink_top, ink_bottom) = self.getFontInkRange(font_path, scale)
+
+    glyphs = []
+    for i, symbol in enumerate(symbols):
+      x = xoffset + self.padding + (i%size)*self.font_size
+      y = yoffset + self.padding + ((i-i%size)/size)*self.font_size
+      if y + ink_bottom > top and y + ink_top < bottom:
+        glyphs.append((x, y, symbol))
+
+    # Pillow splits coordinates in integer and fractional parts rounding
+    # towards zero, so glyphs are drawn on a canvas where their coordinates
+    # have the same sign as on the whole matrix
+    origin = top
+    if glyphs:
+      origin = min(top, max(0, math.floor(min(y for (_x, y, _symbol) in glyphs))))
+
+    font = getFont(font_path, self.font_size*scale)
+    image = Image.new(RENDER_MODE, (image_width, bottom - origin), "white")
+    draw = ImageDraw.Draw(image)
+    for (x, y, symbol) in glyphs:
+      draw.text((x, y - origin), symbol, font=font, fill="black")
+    return numpy.asarray(image)[top - origin:]
+
+  def getCellInkBBox(self, pixels, size, title = None):
+    """ (left, top, right, bottom) of the ink found on any glyph cell of a
+    symbol matrix, relative to the cell
+    """
+    title_padding = 64 if title else 0
+    grid_pixels = self.font_size*size
+    grid = pixels[title_padding+self.padding:title_padding+self.padding+grid_pixels, self.padding:self.padding+grid_pixels]
+    ink = (grid < 255).reshape(size, self.font_size, size, self.font_size)
+    return getPixelsInkBBox(ink.any(axis=(0, 2)))
+
+  def isShiftable(self, image):
+    """ Whether a symbol matrix drawn at 0,0 (without title) can be moved by
+    shiftPixels and look the same as if drawn at the new offset: none of its
+    ink touches the borders, since ink clipped there would be missing
+    """
+    (left, top, right, bottom) = self.getInkBBox(image)
+    (width, height) = image.size
+    return left > 0 and top > 0 and right < width and bottom < height
+
+  def getShiftedInfo(self, image, xoffset, yoffset):
+    """ info (bboxes) of a symbol matrix drawn at 0,0 and moved by integer
+    offsets with shiftPixels
+    """
+    info = {'ink_bbox': clipBBox(offsetBBox(self.getInkBBox(image), xoffset, yoffset), image.size)}
+    if 'cell_bbox' in image.info:
+      cell_bbox = parseBBox(image.info['cell_bbox'])
+      info['cell_bbox'] = unionBBox([cell_bbox, offsetBBox(cell_bbox, xoffset, yoffset)])
+    return info
+
+  def getMatrixPixels(self, symbols, size, font_path, xoffset = 0, yoffset = 0, scale = 1.0, memory_cache = True):
+    """ Same as drawSymbolMatrix, but returns a matrix as (pixels, info),
+    pixels being a numpy array. Matrices moved by integer offsets are written
+    on a scratch buffer of the calling thread instead of a new image, so they
+    are only valid until the next call from the same thread.
+    """
+    if (xoffset != 0 or yoffset != 0) and float(xoffset).is_integer() and float(yoffset).is_integer():
+      image = self.drawSymbolMatrix(symbols, size, font_path, scale = scale, memory_cache = memory_cache)
+      if self.isShiftable(image):
+        pixels = getPixels(image)
+        shifted = shiftPixels(pixels, int(xoffset), int(yoffset), self.getScratch('shifted', pixels.shape, numpy.uint8))
+        return (shifted, self.getShiftedInfo(image, int(xoffset), int(yoffset)))
+
+    image = self.drawSymbolMatrix(symbols, size, font_path, xoffset = xoffset, yoffset = yoffset, scale = scale, memory_cache = memory_cache)
+    self.getInkBBox(image)
+    return (getPixels(image), image.info)
+
+  def getScratch(self, name, shape, dtype):
+    """ Numpy array of given shape reused by every call from the same
+    thread, so scoring loops do not allocate memory. Its content is only valid
+    until the next call asking for the same name.
+    """
+    buffers = getattr(self.scratch, 'buffers', None)
+    if buffers is None:
+      buffers = self.scratch.buffers = {}
+
+    count = math.prod(shape)
+    buffer = buffers.get((name, dtype), None)
+    if buffer is None or buffer.size < count:
+      buffer = buffers[(name, dtype)] = numpy.empty(count, dtype=dtype)
+    return buffer[:count].reshape(shape)
+
+  def getInkBBox(self, image):
+    """ (left, top, right, bottom) of the ink of a symbol matrix, as recorded
+    by drawSymbolMatrix, or found on the pixels for images drawn before bboxes
+    were recorded. Matrices without ink get an empty (0, 0, 0, 0) bbox.
+    """
+    bbox = image.info.get('ink_bbox', None)
+    if bbox is None:
+      bbox = image.info['ink_bbox'] = getPixelsInkBBox(getPixels(image))
+    return parseBBox(bbox)
+
+  def getInkDiff(self, matrix1, matrix2):
+    """ Absolute difference of two symbol matrices (see getMatrixPixels)
+    computed only on the union of their ink bboxes, since everything else is
+    white on both. Returns (diff, box), diff being an int16 scratch array
+    with the difference at box (see getScratch).
+    """
+    ((pixels1, info1), (pixels2, info2)) = (matrix1, matrix2)
+    box = unionBBox([bbox for bbox in [parseBBox(info1['ink_bbox']), parseBBox(info2['ink_bbox'])] if not isEmptyBBox(bbox)])
+    if box is None:
+      box = (0, 0, 0, 0)
+
+    (left, top, right, bottom) = box
+    diff = self.getScratch('diff', (bottom - top, right - left), numpy.int16)
+    numpy.subtract(pixels1[top:bottom, left:right], pixels2[top:bottom, left:right], out=diff, dtype=numpy.int16)
+    numpy.abs(diff, out=diff)
+    return (diff, box)
+
+  def getGlyphCellPairs(self, matrix1, matrix2, count, size, metric):
+    """ Glyph cells of two symbol matrices (see getGlyphCells). Metrics that
+    give the same values on any crop holding all the ink get both stacks
+    cropped to the union of the ink of their cells.
+    """
+    ((pixels1, info1), (pixels2, info2)) = (matrix1, matrix2)
+    crop = None
+    if metric.croppable:
+      bboxes = [info.get('cell_bbox', None) for info in [info1, info2]]
+      if None not in bboxes:
+        crop = getCellCrop(unionBBox([parseBBox(bbox) for bbox in bboxes]), self.font_size)
+    return (self.getGlyphCells(pixels1, count, size, crop = crop), self.getGlyphCells(pixels2, count, size, crop = crop))
+
+  def saveTiledSymbolMatrix(
+    self,
+    symbols,
+    font_path,
+    file_prefix,
+    title = None,
+    xoffset = 0,
+    yoffset = 0,
+    scale = 1.0,
+    tile_size = MAX_MATRIX_SIZE
+  ):
+    """ Draw all symbols, no matter how many, as a list of pages saved on
+    {file_prefix}-pNNN.png, or on {file_prefix}.png when they fit in a single
+    page. Each page is saved as soon as it is drawn, so memory stays bounded
+    to a single tile even for huge CJK fonts.
+
+    Returns the list of files written.
+    """
+    files = []
+    ntiles = math.ceil(len(symbols)/(tile_size*tile_size))
+    for i, tile in enumerate(iterSymbolTiles(symbols, tile_size)):
+      image = self.drawSymbolMatrix(
+        tile,
+        tile_size if ntiles > 1 else None,
+        font_path,
+        title = f"{title} ({i+1}/{ntiles})" if title and ntiles > 1 else title,
+        xoffset = xoffset,
+        yoffset = yoffset,
+        scale = scale,
+        memory_cache = False
+      )
+      out_file = f"{file_prefix}-p{i:03d}.png" if ntiles > 1 else f"{file_prefix}.png"
+      image.save(out_file)
+      files.append(out_file)
+    return files
+
+  def getSymbolIds(self, font_path):
+    """ Return non-empty symbol IDs. Please note that simple/composite glyphs
+    that contain no rendering will be skipped, since in the end, defining
+    a symbol only to be left empty, is like if it was not defined in the first
+    place.
+    """
+    return self.getSymbolInfo(font_path)[0]
+
+  def getGlyphHashes(self, font_path):
+    """ Return {codepoint: outline_hash} of all non-empty symbols, see
+    getGlyphOutlineHash
+    """
+    return self.getSymbolInfo(font_path)[1]
+
+  def getSymbolInfo(self, font_path):
+    """ Return (symbol_ids, glyph_hashes), both extracted in a single pass over
+    the font and cached together.
+    """
+    with self.lock:
+      if font_path in self.symbol_info_cache:
+        return self.symbol_info_cache[font_path]
+
+    diskCacheId = cache.g_diskCache.path('symbols', f"font-{getFileKey(font_path)}", '.symbols')
+    info = cache.g_diskCache.loadPickle('symbols', diskCacheId)
+    if info is not None:
+      with self.lock:
+        self.symbol_info_cache[font_path] = info
+      return info
+
+    font = ttLib.TTFont(font_path)
+    cmap = font.getBestCmap()
+
+    # Note: we can return all symbols by doing this: return set(cmap.keys())
+
+    glyph_set = font.getGlyphSet()
+    font_metrics = getFontMetricsKey(font)
+
+    # we want to get all symbol ids that are not empty/blank, we want glyphs
+    # that draw something on the screen
+    symbols = set()
+    hashes = {}
+    for char, name in cmap.items():
+      glyph = None
+      try:
+        glyph = font['glyf'][name]
+
+        if glyph.isComposite():
+          is_empty_glyph = glyph.components is None
+        else:
+          is_empty_glyph = glyph.numberOfContours <= 0
+
+        if is_empty_glyph:
+          continue
+      except:
+        pass
+
+      symbols.add(char)
+      try:
+        hashes[char] = getGlyphOutlineHash(glyph_set, name, font_metrics, glyph)
+      except Exception:
+        # broken outlines are still rendered (somehow), just never deduplicated
+        pass
+
+    info = (symbols, hashes)
+    with self.lock:
+      self.symbol_info_cache[font_path] = info
+
+    cache.g_diskCache.savePickle('symbols', diskCacheId, info)
+
+    return info
+
+  def getRenderKey(self, symbols, font_path):
+    """ Identifies how symbols look when drawn with font_path: a hash of their
+    outline hashes, so fonts sharing glyphs (forks, mirrors, families...) share
+    cached images. Falls back to the path and stamp of the font when any
+    symbol has no outline hash, since missing symbols are drawn differently
+    by each font.
+    """
+    hashes = self.getGlyphHashes(font_path)
+
+    h = hashlib.blake2s()
+    for symbol in symbols:
+      value = hashes.get(ord(symbol), None)
+      if value is None:
+        return getFileKey(font_path)
+      h.update(value.to_bytes(8, 'little'))
+    return h.hexdigest()
+
+  def splitIdenticalGlyphs(self, codepoints, font_path1, font_path2, xoffset = 0, yoffset = 0, scale = 1.0):
+    """ Split codepoints in the ones that have to be rendered to be compared and
+    the ones whose glyphs have the same outline on both fonts. Identical glyphs
+    render to the same pixels, so they are perfect matches, but only when font2
+    is drawn with no offset nor scale.
+
+    Returns (different_codepoints, nidentical)
+    """
+    if xoffset != 0 or yoffset != 0 or scale != 1.0:
+      return (codepoints, 0)
+
+    hashes1 = self.getGlyphHashes(font_path1)
+    hashes2 = self.getGlyphHashes(font_path2)
+
+    different = []
+    for symbol in codepoints:
+      hash1 = hashes1.get(ord(symbol), None)
+      if hash1 is None or hash1 != hashes2.get(ord(symbol), None):
+        different.append(symbol)
+
+    nidentical = len(codepoints) - len(different)
+    if nidentical == 0:
+      return (codepoints, 0)
+    if isinstance(codepoints, str):
+      different = ''.join(different)
+    return (different, nidentical)
+
+  def getScriptProbes(self, font_path, script):
+    """ Symbols of font_path in given script (see SCRIPT_RANGES), best probes
+    first. Glyphs with the highest ink variance on their cell (big, complex
+    shapes) rank first, skipping the ones that look like a better ranked probe
+    (l/I/1, O/0, ...) so probes tell fonts apart. Cached on memory and disk.
+    """
+    key = (font_path, script)
+    with self.lock:
+      if key in self.probes_cache:
+        return self.probes_cache[key]
+
+    diskCacheId = cache.g_diskCache.path('probes', f"probes-{getFileKey(font_path)}-{script}-{self.font_size}", '.probes')
+    probes = cache.g_diskCache.loadPickle('probes', diskCacheId)
+    if probes is None:
+      # precomposed symbols (accented letters, presentation forms...) look
+      # like their base symbol, and the first ones of each script block are
+      # the most common, so those are the ones more fonts will share
+      codepoints = sorted(c for c in self.getSymbolIds(font_path) if getCodepointScript(c) == script)
+      codepoints = [c for c in codepoints if not unicodedata.decomposition(chr(c))][0:PROBE_POOL_SIZE]
+
+      font = getFont(font_path, self.font_size)
+      cell = self.font_size + 2*self.padding
+      ranked = []
+      for codepoint in codepoints:
+        image = Image.new(RENDER_MODE, (cell, cell), "white")
+        ImageDraw.Draw(image).text((self.padding, self.padding), chr(codepoint), font=font, fill="black")
+        ink = 1 - numpy.asarray(image, dtype=numpy.float32)/255
+        thumbnail = 1 - numpy.asarray(image.resize((8, 8), Image.Resampling.BILINEAR), dtype=numpy.float32)/255
+        ranked.append((float(ink.var()), codepoint, thumbnail))
+      ranked.sort(key=lambda x: (-x[0], x[1]))
+
+      probes = []
+      lookalikes = []
+      thumbnails = []
+      for (_variance, codepoint, thumbnail) in ranked:
+        if any(numpy.abs(thumbnail - other).mean() < PROBE_MIN_DISTANCE for other in thumbnails):
+          lookalikes.append(codepoint)
+          continue
+        probes.append(codepoint)
+        thumbnails.append(thumbnail)
+      probes += lookalikes
+
+      cache.g_diskCache.savePickle('probes', diskCacheId, probes)
+
+    with self.lock:
+      self.probes_cache[key] = probes
+    return probes
+
+  def getProbeSymbols(self, font_path1, font_path2, count = PROBE_COUNT):
+    """ Probe symbols used to quickly compare two fonts: the best ranked probes
+    of font1 (see getScriptProbes) in the script most of their shared symbols
+    belong to, so Cyrillic, Arabic, CJK or symbol fonts get meaningful probes.
+    Returns a string of up to count symbols.
+    """
+    shared = self.getSymbolIds(font_path1) & self.getSymbolIds(font_path2)
+    script = getMainScript(shared)
+    if script is None:
+      return DEFAULT_PROBES
+
+    probes = [c for c in self.getScriptProbes(font_path1, script) if c in shared][0:count]
+    if len(probes) < count:
+      # ranked probes are a sample of big scripts, fill with the rest of them
+      rest = sorted(c for c in shared if getCodepointScript(c) == script and c not in probes)
+      step = max(1, len(rest)/(count - len(probes)))
+      probes += [rest[int(i*step)] for i in range(min(len(rest), count - len(probes)))]
+    return ''.join(chr(c) for c in probes)
+
+  def getGlyphCells(self, image, count, size, title = None, crop = None):
+    """ Split a symbol matrix (an image or its pixels) in one font_size x
+    font_size cell per glyph, or only the (left, top, right, bottom) part of
+    each cell given by crop. Returns a numpy array of shape (count, height,
+    width)
+    """
+    title_padding = 64 if title else 0
+    grid_pixels = self.font_size*size
+
+    pixels = image if isinstance(image, numpy.ndarray) else getPixels(image)
+    grid = pixels[title_padding+self.padding:title_padding+self.padding+grid_pixels, self.padding:self.padding+grid_pixels]
+    cells = grid.reshape(size, self.font_size, size, self.font_size).swapaxes(1, 2)
+    if crop is not None:
+      (left, top, right, bottom) = crop
+      cells = cells[:, :, top:bottom, left:right]
+    return cells.reshape((size*size,) + cells.shape[2:])[0:count]
+
+  def getFontDiffScore(
+    self,
+    codepoints_shared,
+    size,
+    font_path1,
+    font_path2,
+    xoffset,
+    yoffset,
+    scale = 1.0,
+    metric = metrics.DEFAULT_METRIC,
+    skip_identical = False,
+    with_diff = True,
+    memory_cache = True
+  ):
+    """ Compute diff score between two images, using any of the metrics
+    registered on metrics.METRICS. Matrices bigger than MAX_MATRIX_SIZE are
+    scored tile by tile with getTiledFontDiffScore.
+
+    If skip_identical is set, glyphs with the same outline on both fonts are
+    counted as perfect matches without being rendered (see
+    splitIdenticalGlyphs), and the diff only shows the remaining glyphs.
+
+    Returns (sim_score, diff). The diff image is None unless with_diff is
+    set, so searches scoring lots of offsets allocate no images. Matrices
+    scored only once can be kept out of the memory cache with memory_cache.
+    """
+    metric = metrics.getMetric(metric)
+    nidentical = 0
+    if skip_identical:
+      (codepoints_shared, nidentical) = self.splitIdenticalGlyphs(codepoints_shared, font_path1, font_path2, xoffset, yoffset, scale)
+
+    if size > MAX_MATRIX_SIZE or nidentical > 0:
+      return self.getTiledFontDiffScore(codepoints_shared, font_path1, font_path2, xoffset, yoffset, scale, metric = metric, nidentical = nidentical, with_diff = with_diff)
+
+    matrix1 = self.getMatrixPixels(codepoints_shared, size, font_path1, memory_cache = memory_cache)
+    matrix2 = self.getMatrixPixels(codepoints_shared, size, font_path2, xoffset = xoffset, yoffset = yoffset, scale = scale, memory_cache = memory_cache)
+    (height, width) = matrix1[0].shape
+
+    #histogram = diff.histogram()
+
+    # we can also try to minimize this:
+    #sim_score = 1/sum(h * (i**2) for i, h in enumerate(histogram)) / (float(im1.size[0]) * im1.size[1])
+
+    diff = None
+    if metric.pixel_diff:
+      (ink_diff, box) = self.getInkDiff(matrix1, matrix2)
+      sim_score = float(metric.score(int(ink_diff.sum(dtype=numpy.int64)) / (width*height)))
+      if with_diff:
+        diff = diffImage(ink_diff, box, (width, height))
+    else:
+      values = metric.glyph_values(*self.getGlyphCellPairs(matrix1, matrix2, len(codepoints_shared), size, metric))
+      sim_score = float(metric.score(numpy.mean(values)))
+      if with_diff:
+        diff = diffImage(*self.getInkDiff(matrix1, matrix2), (width, height))
+
+    #sim_score = histogram[0] / (float(im1.size[0]) * im1.size[1])
+    return (sim_score, diff)
+
+  def getTiledFontDiffScore(
+    self,
+    codepoints_shared,
+    font_path1,
+    font_path2,
+    xoffset,
+    yoffset,
+    scale = 1.0,
+    diff_prefix = None,
+    tile_size = MAX_MATRIX_SIZE,
+    metric = metrics.DEFAULT_METRIC,
+    nidentical = 0,
+    with_diff = True
+  ):
+    """ Same score as getFontDiffScore, but rendering and diffing tiles of at
+    most tile_size x tile_size symbols, one at a time, and accumulating the
+    diff. For pixel diff metrics the mean is computed over the pixels a single
+    matrix holding all symbols would have, so scores are comparable with
+    getFontDiffScore.
+
+    nidentical glyphs, not included in codepoints_shared, are counted as
+    perfect matches.
+
+    Diff tiles are saved as {diff_prefix}-pNNN.png if diff_prefix is given.
+    Returns (sim_score, diff) where diff is the diff of the first tile, or
+    None if with_diff is not set.
+    """
+    metric = metrics.getMetric(metric)
+    total = len(codepoints_shared) + nidentical
+    size = math.ceil(total**0.5)
+    (image_width, image_height) = self.getSymbolMatrixSize(size)
+
+    # only a few glyphs left after skipping identical ones: no need for a
+    # full tile
+    if len(codepoints_shared) <= tile_size*tile_size:
+      tile_size = max(1, math.ceil(len(codepoints_shared)**0.5))
+
+    diff_sum = 0
+    values_sum = nidentical*metric.perfect_value
+    first_diff = None
+    for i, tile in enumerate(iterSymbolTiles(codepoints_shared, tile_size)):
+      matrix1 = self.getMatrixPixels(tile, tile_size, font_path1, memory_cache = False)
+      matrix2 = self.getMatrixPixels(tile, tile_size, font_path2, xoffset = xoffset, yoffset = yoffset, scale = scale, memory_cache = False)
+
+      if metric.pixel_diff:
+        (ink_diff, box) = self.getInkDiff(matrix1, matrix2)
+        diff_sum += int(ink_diff.sum(dtype=numpy.int64))
+      else:
+        values_sum += numpy.sum(metric.glyph_values(*self.getGlyphCellPairs(matrix1, matrix2, len(tile), tile_size, metric)), dtype=numpy.float64)
+
+      # full size diffs are only built when needed
+      if diff_prefix or (with_diff and first_diff is None):
+        if not metric.pixel_diff:
+          (ink_diff, box) = self.getInkDiff(matrix1, matrix2)
+        (height, width) = matrix1[0].shape
+        diff = diffImage(ink_diff, box, (width, height))
+
+        if diff_prefix:
+          diff.save(f"{diff_prefix}-p{i:03d}.png")
+        if first_diff is None:
+          first_diff = diff
+
+    # every glyph was identical, so there is nothing to diff
+    if with_diff and first_diff is None:
+      first_diff = Image.new(RENDER_MODE, self.getSymbolMatrixSize(tile_size), "black")
+
+    if metric.pixel_diff:
+      sim_score = float(metric.score(diff_sum / (image_width*image_height)))
+    else:
+      sim_score = float(metric.score(values_sum / total))
+    return (sim_score, first_diff)
+
+  def getGlyphScores(
+    self,
+    codepoints,
+    font_path1,
+    font_path2,
+    xoffset = 0,
+    yoffset = 0,
+    scale = 1.0,
+    metric = metrics.DEFAULT_METRIC,
+    tile_size = MAX_MATRIX_SIZE
+  ):
+    """ Score of every glyph on its own, in the same order as codepoints.
+    Useful to find which glyphs differ the most, or to check whether a metric
+    gives stable rankings.
+    """
+    metric = metrics.getMetric(metric)
+
+    scores = []
+    for tile in iterSymbolTiles(codepoints, tile_size):
+      size = math.ceil(len(tile)**0.5)
+      matrix1 = self.getMatrixPixels(tile, size, font_path1)
+      matrix2 = self.getMatrixPixels(tile, size, font_path2, xoffset = xoffset, yoffset = yoffset, scale = scale)
+      scores.append(metric.glyphScores(*self.getGlyphCellPairs(matrix1, matrix2, len(tile), size, metric)))
+
+    if not scores:
+      return numpy.zeros(0)
+    return numpy.concatenate(scores)
+
+  def progressiveFontDiffScore(
+    self,
+    codepoints_shared,
+    font_path1,
+    font_path2,
+    xoffset,
+    yoffset,
+    scale = 1.0,
+    min_score = None,
+    batch_size = 64,
+    confidence = 3.0,
+    seed = 0,
+    metric = metrics.DEFAULT_METRIC,
+    skip_identical = True
+  ):
+    """ Estimate the score getFontDiffScore would give on all codepoints_shared
+    by scoring glyphs in batches, in a shuffled but deterministic order. Stops
+    as soon as the candidate cannot reach min_score: the estimate uses the
+    running mean of the value of each glyph, and the upper bound of the score
+    is computed with `confidence` standard errors.
+
+    Batches are bands of about batch_size glyphs of the same symbol matrices
+    (or tiles) getFontDiffScore scores, drawn with drawSymbolRows, so each
+    glyph gets the same value it gets there. Values of pixel diff metrics are
+    the diff of the cell of the glyph, plus an even share of the diff of the
+    band outside the cells. Once every glyph is examined the estimate is the
+    exact score.
+
+    With skip_identical, glyphs with the same outline on both fonts are known
+    to be perfect matches (see splitIdenticalGlyphs), so only the other ones
+    are sampled.
+
+    Returns (sim_score, nexamined, aborted).
+    """
+    metric = metrics.getMetric(metric)
+    n = len(codepoints_shared)
+    if n == 0:
+      return (float(metric.score(numpy.nan)), 0, False)
+
+    nidentical = 0
+    symbols = codepoints_shared
+    if skip_identical:
+      (symbols, nidentical) = self.splitIdenticalGlyphs(codepoints_shared, font_path1, font_path2, xoffset, yoffset, scale)
+    m = len(symbols)
+
+    # pixel diff metrics are the mean diff of every pixel of a matrix holding
+    # all the symbols, the other ones the mean value of every glyph
+    (image_width, image_height) = self.getSymbolMatrixSize(math.ceil(n**0.5))
+    norm = image_width*image_height if metric.pixel_diff else n
+    identical_sum = 0 if metric.pixel_diff else nidentical*metric.perfect_value
+
+    # same tiles as getTiledFontDiffScore (a single one when they fit)
+    tile_size = MAX_MATRIX_SIZE
+    if m <= tile_size*tile_size:
+      tile_size = max(1, math.ceil(m**0.5))
+    rows_per_band = max(1, round(batch_size/tile_size))
+
+    bands = []
+    for tile in iterSymbolTiles(symbols, tile_size):
+      nrows = math.ceil(len(tile)/tile_size)
+      for row in range(0, nrows, rows_per_band):
+        bands.append((tile, row, min(nrows, row + rows_per_band), nrows))
+    random.Random(seed).shuffle(bands)
+
+    values = []
+    for (tile, first_row, last_row, nrows) in bands:
+      values.extend(self.getBandValues(tile, tile_size, first_row, last_row, nrows, font_path1, font_path2, xoffset, yoffset, scale, metric))
+
+      nexamined = len(values)
+      if min_score is None or nexamined >= m or nexamined < 2:
+        continue
+
+      # finite population correction, since we sample without replacement.
+      # Identical glyphs are known, so only the sampled part is uncertain.
+      # Scores can grow or decrease with the value depending on the metric, so
+      # the best possible score is on either side of the confidence interval
+      mean = (identical_sum + m*numpy.mean(values))/norm
+      std_error = (m/norm) * numpy.std(values, ddof=1) / (nexamined**0.5) * ((m - nexamined)/(m - 1))**0.5
+      best_possible_score = max(
+        metric.score(max(0, mean - confidence*std_error)),
+        metric.score(mean + confidence*std_error)
+      )
+      if best_possible_score < min_score:
+        return (float(metric.score(mean)), nidentical + nexamined, True)
+
+    mean = (identical_sum + numpy.sum(values, dtype=numpy.float64))/norm
+    return (float(metric.score(mean)), nidentical + len(values), False)
+
+  def getBandValues(self, tile, size, first_row, last_row, nrows, font_path1, font_path2, xoffset, yoffset, scale, metric):
+    """ Values (see progressiveFontDiffScore) of the glyphs on rows first_row
+    to last_row of the size x size symbol matrix of tile, nrows being the
+    rows it uses. The first and last bands also hold the margins of the
+    matrix.
+    """
+    (_image_width, image_height) = self.getSymbolMatrixSize(size)
+    top = 0 if first_row == 0 else self.padding + first_row*self.font_size
+    bottom = image_height if last_row == nrows else self.padding + last_row*self.font_size
+
+    pixels1 = self.drawSymbolRows(tile, size, font_path1, top, bottom)
+    pixels2 = self.drawSymbolRows(tile, size, font_path2, top, bottom, xoffset, yoffset, scale)
+
+    # glyph cells of the band, as in getGlyphCells
+    count = min(len(tile), last_row*size) - first_row*size
+    grid_top = self.padding + first_row*self.font_size - top
+    grid_pixels = self.font_size*size
+    (rows1, rows2) = [pixels[grid_top:grid_top + (last_row - first_row)*self.font_size, self.padding:self.padding + grid_pixels] for pixels in (pixels1, pixels2)]
+    (cells1, cells2) = [rows.reshape(last_row - first_row, self.font_size, size, self.font_size).swapaxes(1, 2).reshape(-1, self.font_size, self.font_size)[0:count] for rows in (rows1, rows2)]
+
+    if not metric.pixel_diff:
+      return list(metric.glyph_values(cells1, cells2))
+
+    cell_diffs = numpy.abs(cells1.astype(numpy.int16) - cells2.astype(numpy.int16)).sum(axis=(1, 2), dtype=numpy.int64)
+    band_diff = int(numpy.abs(pixels1.astype(numpy.int16) - pixels2.astype(numpy.int16)).sum(dtype=numpy.int64))
+    return list(cell_diffs + (band_diff - int(cell_diffs.sum()))/count)
+
+  def fastSearchBestAlignment(
+    self,
+    font_path1,
+    font_path2,
+    step = 2,
+    search_space = 12,
+    x = 0,
+    y = 0,
+    metric = metrics.DEFAULT_METRIC
+  ):
+    """ Quickly render a few probe symbols (see getProbeSymbols) in a small grid to try to find
+    a good alignment without having to render all similar simbols; this way, while
+    less accurate, might help rendering simbols and finding similarities much
+    faster
+    """
+    best_score = 0
+    best_x = 0
+    best_y = 0
+
+    probes = self.getProbeSymbols(font_path1, font_path2)
+    size = math.ceil(len(probes)**0.5)
+
+    # this way we can explore a lot in very little time
+    bbox = search_space
+    xoffsets = list(range(x-bbox, x+bbox, step))
+    yoffsets = list(range(y-bbox, y+bbox, step))
+
+    # offsets that cannot line up the ink of both fonts are not worth trying.
+    # Designs rarely line up both edges exactly, so keep a margin
+    bounds = self.getAlignmentBounds(probes, size, font_path1, font_path2, margin = step + 2)
+    if bounds:
+      ((xmin, xmax), (ymin, ymax)) = bounds
+      xoffsets = [xoffset for xoffset in xoffsets if xmin <= xoffset <= xmax] or xoffsets
+      yoffsets = [yoffset for yoffset in yoffsets if ymin <= yoffset <= ymax] or yoffsets
+
+    for xoffset in xoffsets:
+      for yoffset in yoffsets:
+        (sim_score, _) = self.getFontDiffScore(
+          probes,
+          size,
+          font_path1,
+          font_path2,
+          xoffset,
+          yoffset,
+          metric = metric,
+          skip_identical = True,
+          with_diff = False
+        )
+        if sim_score > best_score:
+          best_score = sim_score
+          best_x = xoffset
+          best_y = yoffset
+
+    return (best_x, best_y, best_score)
+
+  def getAlignmentBounds(self, symbols, size, font_path1, font_path2, margin = 0):
+    """ Offsets of font2 worth searching to align it with font1: between the
+    ones lining up the left (top) edges of their ink and the ones lining up
+    the right (bottom) edges, widened by margin.
+
+    Returns ((xmin, xmax), (ymin, ymax)), or None if any font draws no ink
+    """
+    bbox1 = self.getInkBBox(self.drawSymbolMatrix(symbols, size, font_path1))
+    bbox2 = self.getInkBBox(self.drawSymbolMatrix(symbols, size, font_path2))
+    if isEmptyBBox(bbox1) or isEmptyBBox(bbox2):
+      return None
+
+    dx = (bbox1[0] - bbox2[0], bbox1[2] - bbox2[2])
+    dy = (bbox1[1] - bbox2[1], bbox1[3] - bbox2[3])
+    return ((min(dx) - margin, max(dx) + margin), (min(dy) - margin, max(dy) + margin))
+
+  def refineAlignment(
+    self,
+    font_path1,
+    font_path2,
+    x,
+    y,
+    symbols = None,
+    scale_range = (0.85, 1.15),
+    scale_tolerance = 0.005,
+    metric = metrics.DEFAULT_METRIC
+  ):
+    """ Refine an integer alignment (i.e from fastSearchBestAlignment) into a
+    fractional one, also searching for the scale of font2 that matches font1
+    best. Offsets are refined by parabolic interpolation around the integer
+    optimum, and scale with a golden-section search, so it converges in a few
+    dozen evaluations instead of brute forcing a 3D grid.
+
+    Returns (x, y, scale, score)
+    """
+    symbols = symbols or self.getProbeSymbols(font_path1, font_path2)
+    size = math.ceil(len(symbols)**0.5)
+
+    def score(xoffset, yoffset, scale):
+      (sim_score, _) = self.getFontDiffScore(symbols, size, font_path1, font_path2, xoffset, yoffset, scale, metric = metric, skip_identical = True, with_diff = False)
+      return sim_score
+
+    def refineOffsets(x, y, scale, center_score):
+      dx = parabolicPeak(score(x-1, y, scale), center_score, score(x+1, y, scale))
+      dy = parabolicPeak(score(x, y-1, scale), center_score, score(x, y+1, scale))
+      return (round(x + dx, 2), round(y + dy, 2))
+
+    def searchScale(x, y):
+      (lo, hi) = scale_range
+      return round(goldenSectionSearch(lambda scale: score(x, y, scale), lo, hi, scale_tolerance), 3)
+
+    best = (x, y, 1.0, score(x, y, 1.0))
+
+    (fx, fy) = refineOffsets(x, y, 1.0, best[3])
+    best_scale = searchScale(fx, fy)
+
+    # glyphs grow from the top-left corner, so offsets might need to move a bit
+    # once we know the scale
+    (ix, iy) = (round(fx), round(fy))
+    (fx, fy) = refineOffsets(ix, iy, best_scale, score(ix, iy, best_scale))
+
+    candidate_score = score(fx, fy, best_scale)
+    if candidate_score > best[3]:
+      best = (fx, fy, best_scale, candidate_score)
+
+    return best
+
+  def searchVariableAxes(
+    self,
+    font_path1,
+    font_path2,
+    x = 0,
+    y = 0,
+    symbols = None,
+    axes = VARIABLE_AXES,
+    tolerance = 0.01,
+    start = None,
+    metric = metrics.DEFAULT_METRIC
+  ):
+    """ Find the location of variable font2, and the offsets of that instance,
+    that match font1 best, with the same probe symbols used by
+    fastSearchBestAlignment. Offsets change with the instance (i.e. bolder
+    glyphs are wider), so every location is scored at its best offsets near
+    the best ones so far, found with a coarse fastSearchBestAlignment.
+
+    Each axis is optimized in turn with a golden-section search down to
+    tolerance (as a fraction of the axis range), on instances of a subset of
+    font2 holding only the probe symbols, so each evaluation is cheap. Passes
+    over all axes are repeated while they improve, up to AXES_SEARCH_ROUNDS.
+    The search starts from the default location, or from start if given, and
+    never returns a worse location.
+
+    Returns (location, x, y, score), location being {} and score None if
+    font2 has none of the axes
+    """
+    font_axes = getFontAxes(font_path2)
+    axes = [tag for tag in axes if tag in font_axes]
+    if not axes:
+      return ({}, x, y, None)
+
+    symbols = symbols or self.getProbeSymbols(font_path1, font_path2)
+    probe_font = subsetFont(font_path2, [ord(symbol) for symbol in symbols])
+
+    def align(location, x, y):
+      instance = instantiateFont(probe_font, location)
+      return self.fastSearchBestAlignment(
+        font_path1,
+        instance,
+        step = AXES_ALIGNMENT_STEP,
+        search_space = AXES_ALIGNMENT_SPACE,
+        x = x,
+        y = y,
+        metric = metric
+      )
+
+    location = {tag: (start or {}).get(tag, font_axes[tag][1]) for tag in axes}
+    best = align(location, x, y)
+    for _round in range(AXES_SEARCH_ROUNDS):
+      improved = False
+      for tag in axes:
+        (lo, _default, hi) = font_axes[tag]
+        if hi <= lo:
+          continue
+
+        (best_x, best_y, best_score) = best
+        value = round(goldenSectionSearch(lambda value: align({**location, tag: round(value)}, best_x, best_y)[2], lo, hi, tolerance*(hi - lo)))
+        candidate = align({**location, tag: value}, best_x, best_y)
+        if candidate[2] > best_score:
+          location[tag] = value
+          best = candidate
+          improved = True
+
+      if not improved:
+        break
+
+    return (location, *best)
+
+  def searchBestAlignment(self, font_path1, font_path2, search_space = 1, metric = metrics.DEFAULT_METRIC):
+    """ Brute force search of any x/y axis to see how to match the font in the
+    best possible way to previous one.
+    """
+    (best_x, best_y, best_score) = self.fastSearchBestAlignment(font_path1, font_path2, step = 4, metric = metric)
+    (best_x, best_y, best_score) = self.fastSearchBestAlignment(font_path1, font_path2, step = 2, search_space = 4, x = best_x, y = best_y, metric = metric)
+
+    symbols1 = self.getSymbolIds(font_path1)
+    symbols2 = self.getSymbolIds(font_path2)
+
+    codepoints_shared = [ chr(c) for c in sorted(symbols1 & symbols2)]
+    size = math.ceil(len(codepoints_shared)**0.5)
+
+    # NOTE: increasing bbox might find a better
+    bbox = search_space
+    total_search_space = (2*bbox)**2
 
-  diskCacheId = f'{CACHE_DIR}/{cacheId[0:2]}/{cacheId[2:]}.{CACHE_FORMAT}'
-  if os.path.isfile(diskCacheId):
-    return Image.open(diskCacheId)
+    # brute force search
+    for i, xoffset in enumerate(range(best_x-bbox, best_x+bbox)):
+      for j, yoffset in enumerate(range(best_y-bbox, best_y+bbox)):
+        n = i*(2*bbox) + j + 1
+        sys.stdout.write (f"\r[{n:2d}/{total_search_space:2d}] Best offsets found ({best_x}, {best_y}, score={best_score:.3f})               ")
+        sys.stdout.flush()
 
-  font = ImageFont.truetype(font_path, g_font_size)
-  image = Image.new("RGB", (image_width, image_height), "white")
-  draw = ImageDraw.Draw(image)
+        (sim_score, _) = self.getFontDiffScore(
+          codepoints_shared,
+          size,
+          font_path1,
+          font_path2,
+          xoffset,
+          yoffset,
+          metric = metric,
+          skip_identical = True,
+          with_diff = False
+        )
 
-  if title:
-    title_font = ImageFont.truetype("Arial.ttf", 16)
-    draw.text((8, 8), title, font=title_font, fill="black")
+        if best_score is None or sim_score > best_score:
+          best_score = sim_score
+          best_x = xoffset
+          best_y = yoffset
 
-  for i, symbol in enumerate(symbols):
-    x = xoffset + g_padding + (i%size)*g_font_size
-    y = yoffset + title_padding + g_padding + ((i-i%size)/size)*g_font_size
+    print("")
+    return (best_x, best_y, best_score)
 
-    draw.text((x,y), symbol, font=font, fill="black")
+# default context used by module level functions
+g_context = RenderContext()
 
-  g_imageCache[cacheId] = CachedImage(image)
+def drawText(*args, **kwargs):
+  return g_context.drawText(*args, **kwargs)
 
-  # purge every X seconds, to free memory
-  if (len(g_imageCache) > 100 and (time.time() - g_imageCacheLastPurge) > 30):
-    g_imageCache = {k:v for k, v in g_imageCache.items() if not v.isExpired() }
-    g_imageCacheLastPurge = time.time()
+def drawFullSymbolMatrix(*args, **kwargs):
+  return g_context.drawFullSymbolMatrix(*args, **kwargs)
 
-  image.save(diskCacheId)
+def getSymbolMatrixSize(*args, **kwargs):
+  return g_context.getSymbolMatrixSize(*args, **kwargs)
+
+def drawSymbolMatrix(*args, **kwargs):
+  return g_context.drawSymbolMatrix(*args, **kwargs)
+
+def saveTiledSymbolMatrix(*args, **kwargs):
+  return g_context.saveTiledSymbolMatrix(*args, **kwargs)
+
+def getSymbolIds(*args, **kwargs):
+  return g_context.getSymbolIds(*args, **kwargs)
+
+def getGlyphHashes(*args, **kwargs):
+  return g_context.getGlyphHashes(*args, **kwargs)
+
+def getSymbolInfo(*args, **kwargs):
+  return g_context.getSymbolInfo(*args, **kwargs)
+
+def getRenderKey(*args, **kwargs):
+  return g_context.getRenderKey(*args, **kwargs)
+
+def splitIdenticalGlyphs(*args, **kwargs):
+  return g_context.splitIdenticalGlyphs(*args, **kwargs)
+
+def getScriptProbes(*args, **kwargs):
+  return g_context.getScriptProbes(*args, **kwargs)
+
+def getProbeSymbols(*args, **kwargs):
+  return g_context.getProbeSymbols(*args, **kwargs)
+
+def getGlyphCells(*args, **kwargs):
+  return g_context.getGlyphCells(*args, **kwargs)
+
+def getInkBBox(*args, **kwargs):
+  return g_context.getInkBBox(*args, **kwargs)
+
+def getInkDiff(*args, **kwargs):
+  return g_context.getInkDiff(*args, **kwargs)
+
+def getGlyphCellPairs(*args, **kwargs):
+  return g_context.getGlyphCellPairs(*args, **kwargs)
+
+def getFontDiffScore(*args, **kwargs):
+  return g_context.getFontDiffScore(*args, **kwargs)
+
+def getTiledFontDiffScore(*args, **kwargs):
+  return g_context.getTiledFontDiffScore(*args, **kwargs)
+
+def getGlyphScores(*args, **kwargs):
+  return g_context.getGlyphScores(*args, **kwargs)
+
+def progressiveFontDiffScore(*args, **kwargs):
+  return g_context.progressiveFontDiffScore(*args, **kwargs)
+
+def fastSearchBestAlignment(*args, **kwargs):
+  return g_context.fastSearchBestAlignment(*args, **kwargs)
+
+def getAlignmentBounds(*args, **kwargs):
+  return g_context.getAlignmentBounds(*args, **kwargs)
+
+def refineAlignment(*args, **kwargs):
+  return g_context.refineAlignment(*args, **kwargs)
+
+def searchVariableAxes(*args, **kwargs):
+  return g_context.searchVariableAxes(*args, **kwargs)
+
+def searchBestAlignment(*args, **kwargs):
+  return g_context.searchBestAlignment(*args, **kwargs)
+
+def iterSymbolTiles(symbols, tile_size = MAX_MATRIX_SIZE):
+  """ Split symbols in chunks of tile_size x tile_size symbols, so each chunk
+  can be drawn as an independent matrix
+  """
+  per_tile = tile_size*tile_size
+  for start in range(0, len(symbols), per_tile):
+    yield symbols[start:start+per_tile]
+
+# codepoint ranges of the scripts we tell apart (names as in
+# phash.PROBE_TEXT_MAP). Anything else (punctuation, symbols, ...) is 'other'
+SCRIPT_RANGES = {
+  'latin': [(0x0030, 0x0039), (0x0041, 0x005A), (0x0061, 0x007A), (0x00C0, 0x024F), (0x1E00, 0x1EFF)],
+  'greek': [(0x0370, 0x03FF), (0x1F00, 0x1FFF)],
+  'cyrillic': [(0x0400, 0x052F), (0x2DE0, 0x2DFF), (0xA640, 0xA69F)],
+  'hebrew': [(0x0590, 0x05FF), (0xFB1D, 0xFB4F)],
+  'arabic': [(0x0600, 0x06FF), (0x0750, 0x077F), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF)],
+  'devanagari': [(0x0900, 0x097F)],
+  'thai': [(0x0E00, 0x0E7F)],
+  'korean': [(0x1100, 0x11FF), (0x3130, 0x318F), (0xAC00, 0xD7AF)],
+  'japanese': [(0x3040, 0x30FF), (0x31F0, 0x31FF)],
+  'chinese': [(0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF)],
+}
+
+# sorted (start, end, script) of all ranges, to look scripts up with bisect
+_SCRIPT_BOUNDS = sorted((start, end, script) for script, ranges in SCRIPT_RANGES.items() for (start, end) in ranges)
+_SCRIPT_STARTS = [start for (start, _end, _script) in _SCRIPT_BOUNDS]
+
+def getCodepointScript(codepoint):
+  i = bisect.bisect_right(_SCRIPT_STARTS, codepoint) - 1
+  if i >= 0 and codepoint <= _SCRIPT_BOUNDS[i][1]:
+    return _SCRIPT_BOUNDS[i][2]
+  return 'other'
+
+def getScriptCounts(codepoints):
+  """ Returns a Counter of {script: number of codepoints}
+  """
+  return collections.Counter(getCodepointScript(c) for c in codepoints)
+
+def getMainScript(codepoints):
+  """ Script most codepoints belong to, 'other' only if no codepoint is in a
+  known script, or None if there are no codepoints
+  """
+  counts = getScriptCounts(codepoints)
+  known = [(count, script) for script, count in counts.items() if script != 'other']
+  if known:
+    return max(known)[1]
+  return 'other' if counts else None
+
+def getPixels(image):
+  """ Read only numpy array with the pixels of an image. Images made with
+  pixelsImage share memory with their array, any other image is copied once
+  and keeps the copy.
+  """
+  pixels = getattr(image, 'pixels', None)
+  if pixels is None:
+    pixels = numpy.asarray(image)
+    image.pixels = pixels
+  return pixels
+
+def pixelsImage(pixels, info = None):
+  """ Image viewing the memory of a (height, width) uint8 array, without
+  copying it. The image is read only: drawing on it makes a copy first.
+  """
+  (height, width) = pixels.shape
+  image = Image.frombuffer(RENDER_MODE, (width, height), pixels, 'raw', RENDER_MODE, 0, 1)
+  image.pixels = pixels
+  if info:
+    image.info.update(info)
   return image
 
+def shiftPixels(pixels, xoffset, yoffset, out):
+  """ Write on out the pixels of a symbol matrix (without title) moved by
+  integer offsets, see RenderContext.isShiftable. Returns out
+  """
+  (height, width) = pixels.shape
+  out.fill(255)
+  if abs(xoffset) < width and abs(yoffset) < height:
+    out[max(0, yoffset):height + min(0, yoffset), max(0, xoffset):width + min(0, xoffset)] = \
+      pixels[max(0, -yoffset):height - max(0, yoffset), max(0, -xoffset):width - max(0, xoffset)]
+  return out
+
+def getPixelsInkBBox(pixels):
+  """ (left, top, right, bottom) of the pixels that are not white (or of
+  the True values of a mask), (0, 0, 0, 0) if there are none
+  """
+  ink = pixels if pixels.dtype == bool else pixels < 255
+  rows = numpy.flatnonzero(ink.any(axis=1))
+  if not len(rows):
+    return (0, 0, 0, 0)
+  cols = numpy.flatnonzero(ink.any(axis=0))
+  return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+def diffImage(diff, box, size):
+  """ Diff image of given (width, height) from a difference computed at box
+  (see getInkDiff), black everywhere else
+  """
+  (width, height) = size
+  (left, top, right, bottom) = box
+  pixels = numpy.zeros((height, width), dtype=numpy.uint8)
+  pixels[top:bottom, left:right] = diff
+  return pixelsImage(pixels)
+
+def unionBBox(bboxes):
+  """ Smallest (left, top, right, bottom) box holding all bboxes, or None
+  """
+  bboxes = list(bboxes)
+  if not bboxes:
+    return None
+  return (
+    min(bbox[0] for bbox in bboxes),
+    min(bbox[1] for bbox in bboxes),
+    max(bbox[2] for bbox in bboxes),
+    max(bbox[3] for bbox in bboxes)
+  )
+
+def offsetBBox(bbox, dx, dy):
+  (left, top, right, bottom) = bbox
+  return (left + dx, top + dy, right + dx, bottom + dy)
+
+def clipBBox(bbox, size):
+  """ Clip bbox to an image of size (width, height). Empty results are
+  returned as (0, 0, 0, 0)
+  """
+  if bbox is None:
+    return (0, 0, 0, 0)
+  (left, top, right, bottom) = bbox
+  (width, height) = size
+  bbox = (max(0, left), max(0, top), min(width, right), min(height, bottom))
+  return (0, 0, 0, 0) if isEmptyBBox(bbox) else bbox
+
+def isEmptyBBox(bbox):
+  return bbox[0] >= bbox[2] or bbox[1] >= bbox[3]
+
+def formatBBox(bbox):
+  return ','.join(str(round(value)) for value in bbox)
+
+def parseBBox(bbox):
+  """ bbox as a tuple, also when read from a PNG text chunk
+  """
+  if isinstance(bbox, str):
+    return tuple(int(value) for value in bbox.split(','))
+  return tuple(bbox)
+
+def getCellCrop(cell_bbox, cell_size):
+  """ Part of every glyph cell that can have ink, given the union of the
+  glyph bboxes relative to their cells. Glyphs overflowing their cell leave
+  ink on the next cells, next to the shared border, so the crop is extended
+  up to that border.
+  """
+  (left, top, right, bottom) = cell_bbox
+  if right > cell_size:
+    left = 0
+  if left < 0:
+    right = cell_size
+  if bottom > cell_size:
+    top = 0
+  if top < 0:
+    bottom = cell_size
+
+  crop = (max(0, left), max(0, top), min(cell_size, right), min(cell_size, bottom))
+  if isEmptyBBox(crop):
+    return (0, 0, cell_size, cell_size)
+  return crop
+
+def getFontMetricsKey(font):
+  """ Font wide values that change where/how big glyphs are rendered, so they
+  are part of every outline hash (glyphs are drawn anchored on the ascender)
+  """
+  os2 = font['OS/2'] if 'OS/2' in font else None
+  return (
+    f"{font['head'].unitsPerEm}-{font['hhea'].ascent}-"
+    f"{os2.sTypoAscender if os2 else ''}-{os2.usWinAscent if os2 else ''}"
+  ).encode()
+
+def getGlyphOutlineHash(glyph_set, glyph_name, font_metrics, glyph = None):
+  """ 64 bit hash of the decomposed outline of a glyph, plus its hinting
+  instructions (if glyph, from the glyf table, is given) and the font metrics
+  from getFontMetricsKey. Glyphs with the same hash on two fonts render to the
+  same pixels. Font wide hinting tables (fpgm, prep, cvt) are not hashed.
+  """
+  # components are expanded, so composites (accented letters...) change when
+  # any of their base glyphs does
+  pen = recordingPen.DecomposingRecordingPen(glyph_set)
+  glyph_set[glyph_name].draw(pen)
+
+  h = hashlib.blake2s(digest_size=8)
+  h.update(font_metrics)
+  h.update(repr(pen.value).encode())
+  if glyph is not None and hasattr(glyph, 'program'):
+    h.update(glyph.program.getBytecode())
+  return int.from_bytes(h.digest(), 'little')
+
 def fontSymbolIsEmpty(font, glyph_name):
   """ Returns True if given symbol/glyph is empty
   """
@@ -204,6 +1577,44 @@ def fontSymbolIsEmpty(font, glyph_name):
 
   return not (has_contours or has_components)
 
+# subfamily names preferred, in order, to represent a family
+REPRESENTATIVE_STYLES = ['regular', 'book', 'normal', 'roman', 'medium']
+
+def getFontFamily(font_path):
+  """ Returns (family, subfamily) from the name table, preferring typographic
+  names (IDs 16/17) over the legacy ones (IDs 1/2). Fonts without names are
+  grouped by folder.
+  """
+  try:
+    names = ttLib.TTFont(font_path, lazy=True, fontNumber=0)['name']
+    family = names.getDebugName(16) or names.getDebugName(1)
+    subfamily = names.getDebugName(17) or names.getDebugName(2) or ''
+  except Exception:
+    family = None
+    subfamily = ''
+
+  if not family:
+    family = os.path.dirname(os.path.abspath(font_path))
+  return (family.strip().lower(), subfamily.strip().lower())
+
+def groupFontFamilies(font_files):
+  """ Group font files by family. Returns a list of families, each one a list
+  of font files with the representative of the family (its regular style, if
+  any) first. Families keep the order in which they appear on font_files.
+  """
+  families = {}
+  styles = {}
+  for font_file in font_files:
+    (family, subfamily) = getFontFamily(font_file)
+    families.setdefault(family, []).append(font_file)
+    styles[font_file] = subfamily
+
+  def representativeKey(font_file):
+    style = styles[font_file]
+    rank = REPRESENTATIVE_STYLES.index(style) if style in REPRESENTATIVE_STYLES else len(REPRESENTATIVE_STYLES)
+    return (rank, len(os.path.basename(font_file)), font_file)
+
+  return [sorted(members, key=representativeKey) for members in families.values()]
 
 def log(f, message):
   print(message)
@@ -214,6 +1625,19 @@ def log(f, message):
   return
 
 
+def getFileStamp(file_path):
+  """ (mtime, size) of a file, to tell when what was cached about it is
+  outdated
+  """
+  stat = os.stat(file_path)
+  return (stat.st_mtime, stat.st_size)
+
+def getFileKey(file_path):
+  """ Path and stamp of a file, for cache keys of anything read from it, so
+  files edited in place are read again
+  """
+  return f"{file_path}-{getFileStamp(file_path)}"
+
 def getFileMd5(file_path):
   """ Generate the MD5 hash since it is later simpler to use it on the commandline
   """
@@ -223,161 +1647,88 @@ def getFileMd5(file_path):
       md5hash.update(chunk)
   return md5hash.hexdigest()
 
-def getSymbolIds(font_path):
-  """ Return non-empty symbol IDs. Please note that simple/composite glyphs
-  that contain no rendering will be skipped, since in the end, defining
-  a symbol only to be left empty, is like if it was not defined in the first
-  place.
+def goldenSectionSearch(f, lo, hi, tolerance):
+  """ Maximize f in [lo, hi], assuming it is unimodal, until the bracket is
+  smaller than tolerance. Returns the best point evaluated, since scores of
+  rendered glyphs are flat in steps and the middle of the final bracket may
+  fall past the edge of the best one.
   """
-  global g_symbolIdsCache
-  if font_path in g_symbolIdsCache:
-    return g_symbolIdsCache[font_path]
-
-  h = hashlib.blake2s()
-  h.update(f"font-{font_path}".encode())
-  cacheId = h.hexdigest()
-  diskCacheId = f'{CACHE_DIR}/symbols/{cacheId[2:]}.symbols'
-  if os.path.isfile(diskCacheId):
-    with open(diskCacheId, 'rb') as f:
-      return pickle.load(f)
-
-  font = ttLib.TTFont(font_path)
-  cmap = font.getBestCmap()
-
-  # Note: we can return all symbols by doing this: return set(cmap.keys())
-
-  glyph_set = font.getGlyphSet()
-
-  # we want to get all symbol ids that are not empty/blank, we want glyphs
-  # that draw something on the screen
-  symbols = set()
-  for char, name in cmap.items():
-    try:
-      glyph = font['glyf'][name]
-
-      if glyph.isComposite():
-        is_empty_glyph = glyph.components is None
-      else:
-        is_empty_glyph = glyph.numberOfContours <= 0
-
-      if is_empty_glyph:
-        continue
-    except:
-      pass
-
-    symbols.add(char)
-
-  g_symbolIdsCache = symbols
-
-  with open(diskCacheId, 'wb') as f:
-    pickle.dump(symbols, f)
-
-  return symbols
-
-
-def getFontDiffScore(
-  codepoints_shared,
-  size,
-  font_path1,
-  font_path2,
-  xoffset,
-  yoffset
-):
-  """ Compute diff score between two images
+  ratio = (5**0.5 - 1)/2
+  a = hi - ratio*(hi - lo)
+  b = lo + ratio*(hi - lo)
+  score_a = f(a)
+  score_b = f(b)
+  best = max((score_a, a), (score_b, b))
+  while (hi - lo) > tolerance:
+    if score_a > score_b:
+      (hi, b, score_b) = (b, a, score_a)
+      a = hi - ratio*(hi - lo)
+      score_a = f(a)
+      best = max(best, (score_a, a))
+    else:
+      (lo, a, score_a) = (a, b, score_b)
+      b = lo + ratio*(hi - lo)
+      score_b = f(b)
+      best = max(best, (score_b, b))
+  return best[1]
+
+def parabolicPeak(score_prev, score, score_next):
+  """ Given scores at -1, 0 and +1, return the position of the vertex of the
+  parabola going through them, or 0 if the middle point is not a maximum
   """
-  im1 = util.drawSymbolMatrix(codepoints_shared, size, font_path1)
-  im2 = util.drawSymbolMatrix(codepoints_shared, size, font_path2, xoffset = xoffset, yoffset = yoffset)
-
-  diff = ImageChops.difference(im1, im2)
-  #histogram = diff.histogram()
-
-  # we can also try to minimize this:
-  #sim_score = 1/sum(h * (i**2) for i, h in enumerate(histogram)) / (float(im1.size[0]) * im1.size[1])
-
-  # 1/LOG(MSE) since we want to maximize
-  diff = diff.convert("L")
-  mse = numpy.mean(numpy.array(diff)) ** 2
-  sim_score= 1/math.log(mse)
-
-  #sim_score = histogram[0] / (float(im1.size[0]) * im1.size[1])
-  return (sim_score, diff)
-
-def fastSearchBestAlignment (
-  font_path1,
-  font_path2,
-  step = 2,
-  search_space = 12,
-  x = 0,
-  y = 0
-):
-  """ Quickly render a predefined string in a small grid to try to find
-  a good alignment without having to render all similar simbols; this way, while
-  less accurate, might help rendering simbols and finding similarities much
-  faster
-  """
-  best_score = 0
-  best_x = 0
-  best_y = 0
-
-  # this way we can explore a lot in very little time
-  bbox = search_space
-  for xoffset in range(x-bbox, x+bbox, step):
-    for yoffset in range(y-bbox, y+bbox, step):
-      (sim_score, _) = getFontDiffScore(
-        'abjsAWM15', # 9 random letters - typical that are written different
-        3,           # 3x3 grid
-        font_path1,
-        font_path2,
-        xoffset,
-        yoffset
-      )
-      if sim_score > best_score:
-        best_score = sim_score
-        best_x = xoffset
-        best_y = yoffset
-
-  return (best_x, best_y, best_score)
-
-def searchBestAlignment(font_path1, font_path2, search_space = 1):
-  """ Brute force search of any x/y axis to see how to match the font in the
-  best possible way to previous one.
+  denominator = score_prev - 2*score + score_next
+  if denominator >= 0:
+    return 0
+  return max(-0.5, min(0.5, 0.5*(score_prev - score_next)/denominator))
+
+def getCmapCodepoints(font_path):
+  """ Codepoints mapped by the cmap of a font. Way cheaper than getSymbolIds
+  (no glyph is read), but empty glyphs are included
   """
-  (best_x, best_y, best_score) = fastSearchBestAlignment(font_path1, font_path2, step = 4)
-  (best_x, best_y, best_score) = fastSearchBestAlignment(font_path1, font_path2, step = 2, search_space = 4, x = best_x, y = best_y)
+  return set(ttLib.TTFont(font_path, lazy=True, fontNumber=0).getBestCmap())
 
-  symbols1 = util.getSymbolIds(font_path1)
-  symbols2 = util.getSymbolIds(font_path2)
-
-  codepoints_shared = [ chr(c) for c in sorted(symbols1 & symbols2)]
-  size = math.ceil(len(codepoints_shared)**0.5)
-
-  # NOTE: increasing bbox might find a better
-  bbox = search_space
-  total_search_space = (2*bbox)**2
+def getFontAxes(font_path):
+  """ Returns {axis_tag: (min, default, max)} of a variable font, or {} for
+  static fonts
+  """
+  font = ttLib.TTFont(font_path, lazy=True, fontNumber=0)
+  if 'fvar' not in font:
+    return {}
+  return {axis.axisTag: (axis.minValue, axis.defaultValue, axis.maxValue) for axis in font['fvar'].axes}
 
-  # brute force search
-  for i, xoffset in enumerate(range(best_x-bbox, best_x+bbox)):
-    for j, yoffset in enumerate(range(best_y-bbox, best_y+bbox)):
-      n = i*(2*bbox) + j + 1
-      sys.stdout.write (f"\r[{n:2d}/{total_search_space:2d}] Best offsets found ({best_x}, {best_y}, score={best_score:.3f})               ")
-      sys.stdout.flush()
+def formatLocation(location):
+  return ' '.join(f"{tag}={value:g}" for tag, value in sorted(location.items()))
 
-      (sim_score, _) = getFontDiffScore(
-        codepoints_shared,
-        size,
-        font_path1,
-        font_path2,
-        xoffset,
-        yoffset
-      )
+def subsetFont(font_path, unicodes):
+  """ Path to a copy of the font holding only given codepoints (variations
+  are kept). Cached on disk.
+  """
+  unicodes = sorted(unicodes)
+  ext = os.path.splitext(font_path)[1]
+  diskCacheId = cache.g_diskCache.path('instances', f"subset-{getFileKey(font_path)}-{unicodes}", ext)
+  if cache.g_diskCache.exists('instances', diskCacheId):
+    return diskCacheId
 
-      if best_score is None or sim_score > best_score:
-        best_score = sim_score
-        best_x = xoffset
-        best_y = yoffset
+  font = ttLib.TTFont(font_path)
+  subsetter = FontSubset.Subsetter()
+  subsetter.populate(unicodes=unicodes)
+  subsetter.subset(font)
+  cache.g_diskCache.save('instances', diskCacheId, font.save)
+  return diskCacheId
+
+def instantiateFont(font_path, location):
+  """ Path to a static instance of a variable font at location ({axis_tag:
+  value}, missing axes stay at their default). Cached on disk, so the same
+  instance is only built once.
+  """
+  ext = os.path.splitext(font_path)[1]
+  diskCacheId = cache.g_diskCache.path('instances', f"instance-{getFileKey(font_path)}-{formatLocation(location)}", ext)
+  if cache.g_diskCache.exists('instances', diskCacheId):
+    return diskCacheId
 
-  print("")
-  return (best_x, best_y, best_score)
+  font = instancer.instantiateVariableFont(ttLib.TTFont(font_path), location)
+  cache.g_diskCache.save('instances', diskCacheId, font.save)
+  return diskCacheId
 
 def copyFontGlyphs(
   base_font_file,
@@ -411,7 +1762,7 @@ def copyFontGlyphs(
       source_font.save(subset_file)
 
       # Merge the subset font with the target font
-      merger = FontMerger()
+      merger = FontMerge.Merger()
       merged_font = merger.merge([base_font_file, subset_file])
 
       # print (f"Merge into target: {merged_font_file}")